@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from .profiling import get_profiling_settings, install_profiling
+
+        if get_profiling_settings()["enabled"]:
+            install_profiling()
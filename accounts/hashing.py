@@ -0,0 +1,114 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class HashingPoolFull(Exception):
+    """Too many password hashing jobs are queued; the caller should shed the request"""
+
+
+def _init_process_worker():
+    # workers are spawned, not forked (a fork would copy the locks of the parent's threads),
+    # so they start without Django configured
+    import django
+
+    django.setup()
+
+
+class HashingPool:
+    """
+    Bounded pool for password hashing, which burns tens of ms of CPU per call.
+
+    At most `max_pending` jobs may be running or queued. Past that, and for jobs that
+    don't finish within `timeout` seconds, run() raises HashingPoolFull so views can
+    answer 503 instead of piling up behind a login burst. `workers=0` hashes inline.
+    """
+
+    def __init__(self, kind="thread", workers=4, max_pending=64, timeout=10):
+        self.timeout = timeout
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+        if workers == 0:
+            self.executor = None
+        elif kind == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_process_worker
+            )
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hashing")
+
+    def warm(self):
+        """Start every worker now rather than during the first logins (process workers set up Django)"""
+        if self.executor is None:
+            return
+        for future in [self.executor.submit(int) for _ in range(self.workers)]:
+            future.result(timeout=self.timeout)
+
+    def shutdown(self):
+        """Stop the workers once the jobs already submitted finish"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        if self.executor is None:
+            return fn(*args)
+
+        if not self.slots.acquire(blocking=False):
+            raise HashingPoolFull()
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise HashingPoolFull()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HashingPool(**getattr(settings, "PASSWORD_HASHING_POOL", {}))
+    return _pool
+
+
+def configure_pool(**config):
+    """Replace the pool, e.g. to compare configurations in one process"""
+    global _pool
+    with _pool_lock:
+        previous, _pool = _pool, HashingPool(**config)
+    if previous is not None:
+        previous.shutdown()
+    return _pool
+
+
+def make_password(raw_password):
+    return get_pool().run(hashers.make_password, raw_password)
+
+
+def check_password(raw_password, encoded):
+    """
+    Returns (is_valid, new_encoded). new_encoded is set when the password was correct
+    but stored with an outdated hasher or work factor, and should be saved.
+    """
+    if not get_pool().run(hashers.check_password, raw_password, encoded):
+        return False, None
+
+    hasher = hashers.identify_hasher(encoded)
+    if hasher.algorithm != hashers.get_hasher("default").algorithm or hasher.must_update(encoded):
+        return True, make_password(raw_password)
+    return True, None
@@ -0,0 +1,63 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from accounts import hashing
+
+User = get_user_model()
+
+USERNAME = "bench_login_user"
+PASSWORD = "bench-login-password"
+
+
+class Command(BaseCommand):
+    help = "Measure login throughput and latency under concurrent requests, inline vs with the hashing pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--concurrency", type=int, default=32)
+        parser.add_argument("--kind", choices=("thread", "process"), default="thread")
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--max-pending", type=int, default=64)
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        try:
+            configurations = {
+                "inline": {"workers": 0},
+                "pool": {"kind": options["kind"], "workers": options["workers"], "max_pending": options["max_pending"]},
+            }
+            for label, config in configurations.items():
+                hashing.configure_pool(**config)
+                self.run(label, options["requests"], options["concurrency"])
+        finally:
+            user.delete()
+
+    def run(self, label, count, concurrency):
+        def login(_):
+            started = time.perf_counter()
+            response = Client().post(
+                "/api/accounts/login/",
+                {"username": USERNAME, "password": PASSWORD},
+                content_type="application/json",
+            )
+            return response.status_code, time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(login, range(count)))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for code, latency in results if code == 200)
+        shed = sum(1 for code, _ in results if code == 503)
+        summary = f"{label:>6}: {len(latencies) / elapsed:7.1f} logins/s  ok={len(latencies)} shed={shed}"
+        if latencies:
+            summary += (
+                f"  p50={statistics.median(latencies) * 1000:.0f}ms"
+                f"  p99={latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000:.0f}ms"
+            )
+        self.stdout.write(summary)
@@ -0,0 +1,70 @@
+import random
+import statistics
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.search import search_users
+from chats.management.commands.seed_dataset import SEED_EMAIL_DOMAIN
+
+User = get_user_model()
+
+
+def typo(word, rng):
+    """The word with a letter slipped in past its first half, so its prefix matches nothing"""
+    at = rng.randrange(len(word) // 2 + 1, len(word) + 1)
+    return word[:at] + "q" + word[at:]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure user search latency for prefix queries and typo queries (which fall through to "
+        "the trigram index), with the per-trigram scan cap and without it. Run it against seeded "
+        "data (manage.py seed_dataset)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", type=int, default=200, help="queries per kind")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        seeded = User.objects.filter(email__endswith=f"@{SEED_EMAIL_DOMAIN}")
+        total = seeded.count()
+        if total == 0:
+            raise CommandError("No seeded users, run manage.py seed_dataset first")
+
+        rng = random.Random(options["seed"])
+        max_id = seeded.order_by("-id").values_list("id", flat=True).first()
+        sample = []
+        while len(sample) < options["queries"]:
+            user = seeded.filter(id__gte=rng.randrange(max_id + 1)).order_by("id").only("username", "first_name").first()
+            if user is not None:
+                sample.append(user)
+
+        self.stdout.write(f"{total} seeded users, {User.objects.count()} in all")
+        kinds = {
+            "prefix": [user.username[: max(3, len(user.username) // 2)] for user in sample],
+            "typo": [typo(user.username, rng) for user in sample] + [typo(user.first_name.lower(), rng) for user in sample if len(user.first_name) >= 3],
+        }
+        for label, queries in kinds.items():
+            self.measure(label, queries)
+        # as if every trigram were under the cap: each one's index range is read in full
+        with mock.patch("accounts.search.TRIGRAM_SCAN", total + 1):
+            self.measure("typo uncapped", kinds["typo"])
+
+    def measure(self, label, queries):
+        latencies, found = [], 0
+        for query in queries:
+            started = time.perf_counter()
+            found += len(search_users(query))
+            latencies.append(time.perf_counter() - started)
+
+        latencies.sort()
+        self.stdout.write(
+            f"{label:>13}: n={len(queries)}"
+            f"  p50={statistics.median(latencies) * 1000:.1f}ms"
+            f"  p99={latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000:.1f}ms"
+            f"  results/query={found / len(queries):.1f}"
+        )
@@ -1,25 +1,23 @@
 from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import TokenError
-
-User = get_user_model()
+from .session import SessionUser
 
 
 @database_sync_to_async
 def get_user_from_token(token):
+    """The connection's SessionUser (not a full User, sockets are long-lived), or AnonymousUser"""
     try:
         access_token = AccessToken(token)
         user_id = access_token["user_id"]
-        user = User.objects.get(id=user_id)
-
-        return user
-    except (TokenError, User.DoesNotExist, KeyError):
+    except (TokenError, KeyError):
         return AnonymousUser()
 
+    return SessionUser.load(user_id) or AnonymousUser()
+
 
 class TokenAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
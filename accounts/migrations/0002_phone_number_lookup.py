@@ -0,0 +1,63 @@
+# Generated by Django 5.2.8 on 2026-10-19 05:34
+
+import hashlib
+import re
+
+from django.db import migrations, models
+
+
+# copies of accounts.phones as it was when this migration was written, so later changes
+# there don't change what the migration does
+SEPARATORS = re.compile(r"[\s\-./()]")
+
+
+def normalize_phone(raw):
+    if not raw:
+        return None
+
+    number = SEPARATORS.sub("", str(raw))
+    if number.startswith("00"):
+        number = "+" + number[2:]
+
+    digits = number[1:] if number.startswith("+") else number
+    if not digits.isdigit() or not 4 <= len(digits) <= 15:
+        return None
+    return number
+
+
+def hash_phone(normalized):
+    return hashlib.sha256(normalized.encode("utf8")).hexdigest()
+
+
+def backfill_phone_lookup(apps, schema_editor):
+    User = apps.get_model("accounts", "User")
+    users = []
+    for user in User.objects.exclude(phone_number=None).only("id", "phone_number").iterator(chunk_size=2000):
+        user.phone_number_normalized = normalize_phone(user.phone_number)
+        user.phone_number_hash = hash_phone(user.phone_number_normalized) if user.phone_number_normalized else None
+        users.append(user)
+        if len(users) >= 2000:
+            User.objects.bulk_update(users, ["phone_number_normalized", "phone_number_hash"])
+            users = []
+    User.objects.bulk_update(users, ["phone_number_normalized", "phone_number_hash"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='phone_number_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='phone_number_normalized',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.RunPython(backfill_phone_lookup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.8 on 2026-10-19 05:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# copies of accounts.search as it was when this migration was written, so later changes
+# there don't change what the migration does
+def search_terms(user):
+    terms = {user.username.lower()}
+    for name in (user.first_name, user.last_name):
+        terms.update(word.lower() for word in name.split())
+    full_name = f"{user.first_name} {user.last_name}".strip().lower()
+    if " " in full_name:
+        terms.add(full_name)
+    return {term[:150] for term in terms if term}
+
+
+def trigrams_of_terms(terms):
+    trigrams = set()
+    for term in terms:
+        padded = f"  {term} "
+        trigrams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def backfill_search_index(apps, schema_editor):
+    User = apps.get_model("accounts", "User")
+    UserSearchTerm = apps.get_model("accounts", "UserSearchTerm")
+    UserTrigram = apps.get_model("accounts", "UserTrigram")
+
+    terms, user_trigrams = [], []
+    for user in User.objects.only("id", "username", "first_name", "last_name").iterator(chunk_size=2000):
+        user_terms = search_terms(user)
+        terms.extend(UserSearchTerm(user_id=user.id, term=term) for term in user_terms)
+        # distinct over all the user's terms, as index_user() stores them
+        user_trigrams.extend(UserTrigram(user_id=user.id, trigram=trigram) for trigram in trigrams_of_terms(user_terms))
+        if len(user_trigrams) >= 20000:
+            UserSearchTerm.objects.bulk_create(terms)
+            UserTrigram.objects.bulk_create(user_trigrams)
+            terms, user_trigrams = [], []
+    UserSearchTerm.objects.bulk_create(terms)
+    UserTrigram.objects.bulk_create(user_trigrams)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_phone_number_lookup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=150)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'user'], name='accounts_us_term_bbf685_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_trigrams', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['trigram', 'user'], name='accounts_us_trigram_2cd127_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_search_index, migrations.RunPython.noop),
+    ]
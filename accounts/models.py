@@ -1,5 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
+from .phones import hash_phone, normalize_phone
+from .snapshots import SNAPSHOT_FIELDS, user_snapshots
+
+# fields feeding the user search index
+SEARCH_FIELDS = {"username", "first_name", "last_name"}
 
 
 class User(AbstractUser):
@@ -8,6 +13,55 @@ class User(AbstractUser):
     bio = models.TextField(max_length=150, blank=True, null=True)
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(auto_now=True)
+    # derived from phone_number on save, for contact matching
+    phone_number_normalized = models.CharField(max_length=16, blank=True, null=True, db_index=True, editable=False)
+    phone_number_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True, editable=False)
 
     def __str__(self):
         return self.username
+
+    def save(self, *args, **kwargs):
+        self.phone_number_normalized = normalize_phone(self.phone_number)
+        self.phone_number_hash = hash_phone(self.phone_number_normalized) if self.phone_number_normalized else None
+
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "phone_number" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "phone_number_normalized", "phone_number_hash"}
+
+        super().save(*args, **kwargs)
+
+        if update_fields is None or SEARCH_FIELDS.intersection(update_fields):
+            from .search import index_user
+
+            index_user(self)
+
+        # the search index is written in the same transaction; the snapshot is shared with
+        # every worker, so it's only published once the save has committed
+        if update_fields is None or SNAPSHOT_FIELDS.intersection(update_fields):
+            transaction.on_commit(lambda: user_snapshots.update(self))
+
+
+class UserSearchTerm(models.Model):
+    """
+    Lowercased username and name words of a user, for prefix search by index range scan.
+    Maintained by User.save(), see accounts.search.
+    """
+
+    user = models.ForeignKey(User, related_name="search_terms", on_delete=models.CASCADE)
+    term = models.CharField(max_length=150)
+
+    class Meta:
+        indexes = [models.Index(fields=["term", "user"])]
+
+
+class UserTrigram(models.Model):
+    """
+    Distinct trigrams of a user's search terms, for typo-tolerant search.
+    Maintained by User.save(), see accounts.search.
+    """
+
+    user = models.ForeignKey(User, related_name="search_trigrams", on_delete=models.CASCADE)
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        indexes = [models.Index(fields=["trigram", "user"])]
@@ -0,0 +1,36 @@
+import hashlib
+import re
+
+# everything people put between digits: spaces, dashes, dots, brackets, slashes
+SEPARATORS = re.compile(r"[\s\-./()]")
+
+
+def normalize_phone(raw):
+    """
+    Canonical form used for contact matching: digits only, with a leading "+" when the
+    number carries a country code ("+" or "00" prefix). Returns None for anything that
+    isn't a plausible phone number.
+
+    Numbers without a country code can't be expanded server-side, so clients should
+    normalize address-book entries to E.164 with the user's region before sending.
+    """
+    if not raw:
+        return None
+
+    number = SEPARATORS.sub("", str(raw))
+    if number.startswith("00"):
+        number = "+" + number[2:]
+
+    digits = number[1:] if number.startswith("+") else number
+    if not digits.isdigit() or not 4 <= len(digits) <= 15:
+        return None
+    return number
+
+
+def hash_phone(normalized):
+    """
+    Hex SHA-256 of a normalized number, what clients send when they'd rather not upload
+    plain numbers. The phone number space is small enough to brute force, so this keeps
+    numbers out of logs and payloads, it doesn't make them secret.
+    """
+    return hashlib.sha256(normalized.encode("utf8")).hexdigest()
@@ -0,0 +1,272 @@
+import contextvars
+import cProfile
+import functools
+import inspect
+import io
+import json
+import logging
+import pstats
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from asgiref.sync import SyncToAsync, iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from django.utils.decorators import sync_and_async_middleware
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ID = re.compile(r"^\d{8}T\d{6}-[0-9a-f]{12}$")
+
+# parameters of the asgiref internal install_thread_profiling() wraps (asgiref 3.12), which
+# SyncToAsync calls as thread_handler(loop, exc_info, task_context, func, child)
+THREAD_HANDLER_PARAMETERS = ["self", "loop", "exc_info", "task_context", "func", "args", "kwargs"]
+
+# SQL run in the context of the profile being captured; None when nothing is profiled
+query_log = contextvars.ContextVar("query_log", default=None)
+
+# the Profile being captured in this context, seen by sync_to_async threads too
+active_profile = contextvars.ContextVar("active_profile", default=None)
+
+# cProfile can only trace one profile per process at a time
+profiler_lock = threading.Lock()
+
+
+def get_profiling_settings():
+    return {
+        "enabled": False,
+        "directory": settings.BASE_DIR / "profiles",
+        "header": "X-Profile",
+        "query_param": "_profile",
+        "top": 40,
+        **getattr(settings, "PROFILING", {}),
+    }
+
+
+def log_queries(execute, sql, params, many, context):
+    """Execute wrapper on every connection: a ContextVar lookup unless a profile is capturing"""
+    queries = query_log.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.append({"sql": sql, "params": repr(params)[:500], "many": many, "ms": round((time.perf_counter() - started) * 1000, 3)})
+
+
+def install_query_logging(sender, connection, **kwargs):
+    """connection_created receiver, connected when profiling is enabled"""
+    if log_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_queries)
+
+
+def run_profiled(child):
+    """Run a sync_to_async call on its thread, traced into the profile capturing in its context"""
+    profile = active_profile.get()
+    if profile is None:
+        return child()
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+: the profile's own profiler already traces every thread
+        return child()
+    try:
+        return child()
+    finally:
+        profiler.disable()
+        profile.thread_profilers.append(profiler)
+
+
+def install_thread_profiling():
+    """
+    cProfile traces the thread that enabled it, but under ASGI sync views and
+    database_sync_to_async work run on executor threads. Wrap what SyncToAsync runs
+    there, so those calls are traced into the capturing profile as well.
+
+    thread_handler is asgiref internals: with a signature other than the one this was
+    written against, nothing is patched and False is returned.
+    """
+    thread_handler = SyncToAsync.thread_handler
+    if getattr(thread_handler, "profiled", False):
+        return True
+    if list(inspect.signature(thread_handler).parameters) != THREAD_HANDLER_PARAMETERS:
+        logger.warning(
+            "SyncToAsync.thread_handler%s isn't the signature profiling wraps; profiles won't include sync_to_async threads",
+            inspect.signature(thread_handler),
+        )
+        return False
+
+    def profiled_thread_handler(self, loop, exc_info, task_context, func, child):
+        return thread_handler(self, loop, exc_info, task_context, func, functools.partial(run_profiled, child))
+
+    profiled_thread_handler.profiled = True
+    SyncToAsync.thread_handler = profiled_thread_handler
+    return True
+
+
+def install_profiling():
+    """Install the query logging and thread tracing profiles need; run at startup when enabled"""
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+
+    connection_created.connect(install_query_logging, dispatch_uid="accounts.profiling")
+    for connection in connections.all(initialized_only=True):
+        install_query_logging(None, connection)
+    install_thread_profiling()
+
+
+def profile_path(profile_id, suffix):
+    return Path(get_profiling_settings()["directory"]) / f"{profile_id}{suffix}"
+
+
+def load_profile(profile_id):
+    """The saved summary of a profile, or None"""
+    if not PROFILE_ID.match(profile_id):
+        return None
+    try:
+        return json.loads(profile_path(profile_id, ".json").read_text())
+    except FileNotFoundError:
+        return None
+
+
+class Profile:
+    """
+    One profiled request or websocket event: a cProfile of this thread and of the
+    sync_to_async calls made in its context (sync views, the ORM), and every SQL query
+    run in its context.
+    Saved as <id>.prof (pstats, for snakeviz and friends) and <id>.json (summary,
+    top functions, queries) in PROFILING["directory"].
+
+    Profiles taken on an event loop also trace whatever else the loop runs meanwhile.
+    """
+
+    def __init__(self, label, user_id=None):
+        self.label = label
+        self.user_id = user_id
+
+    def start(self):
+        """False if another profile is running in this process"""
+        if not profiler_lock.acquire(blocking=False):
+            return False
+        self.queries = []
+        self.thread_profilers = []
+        self.token = query_log.set(self.queries)
+        self.profile_token = active_profile.set(self)
+        self.profiler = cProfile.Profile()
+        self.started = time.perf_counter()
+        self.profiler.enable()
+        return True
+
+    def stop(self):
+        """Save the profile and return its id"""
+        self.profiler.disable()
+        duration = time.perf_counter() - self.started
+        query_log.reset(self.token)
+        active_profile.reset(self.profile_token)
+        profiler_lock.release()
+        return self.save(duration)
+
+    def save(self, duration):
+        config = get_profiling_settings()
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:12]}"
+        Path(config["directory"]).mkdir(parents=True, exist_ok=True)
+
+        stats = io.StringIO()
+        merged = pstats.Stats(self.profiler, *list(self.thread_profilers), stream=stats)
+        merged.dump_stats(profile_path(profile_id, ".prof"))
+        merged.sort_stats("cumulative").print_stats(config["top"])
+
+        profile_path(profile_id, ".json").write_text(
+            json.dumps(
+                {
+                    "id": profile_id,
+                    "label": self.label,
+                    "user_id": self.user_id,
+                    "created_at": timezone.now().isoformat(),
+                    "duration_ms": round(duration * 1000, 3),
+                    "query_count": len(self.queries),
+                    "query_ms": round(sum(query["ms"] for query in self.queries), 3),
+                    "queries": self.queries,
+                    "stats": stats.getvalue(),
+                }
+            )
+        )
+        logger.info("Profiled %s: %s", self.label, profile_id)
+        return profile_id
+
+
+def is_staff_request(request):
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return bool(authenticated and authenticated[0].is_staff)
+
+
+@sync_and_async_middleware
+def ProfilingMiddleware(get_response):
+    """
+    Profiles a single request when a staff user sends the PROFILING["header"] header or
+    the PROFILING["query_param"] query parameter; the response carries X-Profile-Id. Other
+    requests cost a header and a query parameter lookup; with profiling disabled the
+    middleware isn't loaded at all.
+    """
+    config = get_profiling_settings()
+    if not config["enabled"]:
+        raise MiddlewareNotUsed()
+
+    header = "HTTP_" + config["header"].upper().replace("-", "_")
+
+    def requested(request):
+        return bool(request.META.get(header) or request.GET.get(config["query_param"]))
+
+    def finish(profile, response):
+        response["X-Profile-Id"] = profile.stop()
+        return response
+
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            if not requested(request) or not await sync_to_async(is_staff_request)(request):
+                return await get_response(request)
+
+            profile = Profile(f"{request.method} {request.path}")
+            if not profile.start():
+                return await get_response(request)
+            try:
+                response = await get_response(request)
+            except BaseException:
+                profile.stop()
+                raise
+            return finish(profile, response)
+
+    else:
+
+        def middleware(request):
+            if not requested(request) or not is_staff_request(request):
+                return get_response(request)
+
+            profile = Profile(f"{request.method} {request.path}")
+            if not profile.start():
+                return get_response(request)
+            try:
+                response = get_response(request)
+            except BaseException:
+                profile.stop()
+                raise
+            return finish(profile, response)
+
+    return middleware
@@ -0,0 +1,133 @@
+from collections import Counter, defaultdict
+from .models import User, UserSearchTerm, UserTrigram
+
+# index rows a prefix lookup reads before giving up on filling the page
+PREFIX_SCAN = 500
+
+# users with the most shared trigrams that get scored as typo matches
+TYPO_CANDIDATES = 100
+
+# index rows read per query trigram; a trigram held by more users than this ("an ", " jo")
+# says little about who was meant, and is left out rather than scanned
+TRIGRAM_SCAN = 2000
+
+# longest query looked up: terms are indexed truncated to this length
+MAX_QUERY_LENGTH = 150
+
+# query trigrams looked up in the index, one query each, the ones nearest the start first
+TYPO_TRIGRAMS = 24
+
+# trigram similarity (shared / all distinct, as pg_trgm) a term needs to count as a typo match
+TRIGRAM_THRESHOLD = 0.3
+
+# a term's trigrams are padded like pg_trgm, so word starts weigh more than middles
+PADDING = "  "
+
+
+def search_terms(user):
+    terms = {user.username.lower()}
+    for name in (user.first_name, user.last_name):
+        terms.update(word.lower() for word in name.split())
+    full_name = f"{user.first_name} {user.last_name}".strip().lower()
+    if " " in full_name:
+        terms.add(full_name)
+    return {term[:150] for term in terms if term}
+
+
+def trigrams(term):
+    return set(ordered_trigrams(term))
+
+
+def ordered_trigrams(term):
+    """The term's distinct trigrams in the order they appear"""
+    padded = f"{PADDING}{term} "
+    return list(dict.fromkeys(padded[i : i + 3] for i in range(len(padded) - 2)))
+
+
+def trigrams_of_terms(terms):
+    """The distinct trigrams over all of a user's terms, as stored in UserTrigram"""
+    return set().union(*(trigrams(term) for term in terms))
+
+
+def similarity(a, b):
+    return len(a & b) / len(a | b)
+
+
+def index_user(user):
+    """Rebuild a user's search terms and trigrams"""
+    terms = search_terms(user)
+    user_trigrams = trigrams_of_terms(terms)
+
+    UserSearchTerm.objects.filter(user=user).delete()
+    UserTrigram.objects.filter(user=user).delete()
+    UserSearchTerm.objects.bulk_create([UserSearchTerm(user=user, term=term) for term in terms])
+    UserTrigram.objects.bulk_create([UserTrigram(user=user, trigram=trigram) for trigram in user_trigrams])
+
+
+def search_users(query, excluded_ids=(), limit=20):
+    """
+    Users whose username or name starts with `query`, topped up with close typo matches.
+
+    Prefix matches come from a range scan over the term index (term >= q AND term < q + U+FFFF),
+    which any B-tree serves without LIKE support. Only if that leaves the page short are typo
+    matches added, see typo_matches(). `excluded_ids` are filtered in Python so large
+    exclusion sets never reach the SQL.
+    """
+    query = query.strip().lower()[:MAX_QUERY_LENGTH]
+    excluded_ids = set(excluded_ids)
+    found = []
+
+    prefix_ids = (
+        UserSearchTerm.objects.filter(term__gte=query, term__lt=query + "\uffff")
+        .order_by("term")
+        .values_list("user_id", flat=True)[:PREFIX_SCAN]
+    )
+    for user_id in prefix_ids:
+        if user_id not in excluded_ids and user_id not in found:
+            found.append(user_id)
+            if len(found) == limit:
+                break
+
+    if len(found) < limit and len(query) >= 3:
+        for user_id in typo_matches(query, excluded_ids | set(found)):
+            found.append(user_id)
+            if len(found) == limit:
+                break
+
+    users = User.objects.in_bulk(found)
+    return [users[user_id] for user_id in found if user_id in users]
+
+
+def typo_matches(query, excluded_ids):
+    """
+    Ids of users with a term within TRIGRAM_THRESHOLD similarity of `query`, most similar first.
+
+    The trigram index narrows the field to the TYPO_CANDIDATES users sharing the most trigrams
+    with the query (summed over all their terms), then each candidate's terms are scored
+    one by one so trigrams spread across a username and a surname don't add up to a match.
+
+    Each of the first TYPO_TRIGRAMS query trigrams is an index range scan capped at
+    TRIGRAM_SCAN rows, so the work is bounded however long the query and however many users
+    there are. Trigrams over the cap are too common to count and are dropped; a query made
+    only of common trigrams finds no typo matches.
+    """
+    looked_up = ordered_trigrams(query)[:TYPO_TRIGRAMS]
+    query_trigrams = trigrams(query)
+    hits, counted = Counter(), 0
+    for trigram in looked_up:
+        user_ids = list(UserTrigram.objects.filter(trigram=trigram).values_list("user_id", flat=True)[: TRIGRAM_SCAN + 1])
+        if len(user_ids) <= TRIGRAM_SCAN:
+            hits.update(user_ids)
+            counted += 1
+
+    min_hits = max(1, int(counted * TRIGRAM_THRESHOLD))
+    candidate_ids = [
+        user_id for user_id, count in hits.most_common() if count >= min_hits and user_id not in excluded_ids
+    ][:TYPO_CANDIDATES]
+
+    scores = defaultdict(float)
+    for user_id, term in UserSearchTerm.objects.filter(user_id__in=candidate_ids).values_list("user_id", "term"):
+        scores[user_id] = max(scores[user_id], similarity(query_trigrams, trigrams(term)))
+
+    matches = [user_id for user_id, score in scores.items() if score >= TRIGRAM_THRESHOLD]
+    return sorted(matches, key=lambda user_id: -scores[user_id])
@@ -1,6 +1,7 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
+from .hashing import make_password
 
 User = get_user_model()
 
@@ -15,7 +16,7 @@ class UserSerializer(serializers.ModelSerializer):
         password = validated_data.pop("password", None)
         instance = self.Meta.model(**validated_data)
         if password is not None:
-            instance.set_password(password)
+            instance.password = make_password(password)
         instance.save()
         return instance
 
@@ -0,0 +1,46 @@
+from django.contrib.auth import get_user_model
+
+
+class SessionUser:
+    """
+    What a websocket connection keeps of its user for the life of the socket: the
+    fields routing and frames need, in slots, instead of a full User instance (every
+    AbstractUser field, the password hash, model state). fetch() loads anything else
+    from the database when it's actually needed.
+    """
+
+    __slots__ = ("id", "username", "profile_picture", "last_seen")
+
+    # the User fields a session is loaded with
+    FIELDS = ("id", "username", "profile_picture", "last_seen")
+
+    is_anonymous = False
+    is_authenticated = True
+
+    def __init__(self, id, username, profile_picture, last_seen):
+        self.id = id
+        self.username = username
+        self.profile_picture = profile_picture
+        self.last_seen = last_seen
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(*(getattr(user, field) for field in cls.FIELDS))
+
+    @classmethod
+    def load(cls, user_id):
+        """The session of an active user, or None"""
+        row = get_user_model().objects.filter(id=user_id, is_active=True).values_list(*cls.FIELDS).first()
+        return cls(*row) if row else None
+
+    @property
+    def pk(self):
+        return self.id
+
+    async def fetch(self, *fields):
+        """The User itself, with just `fields` loaded if given"""
+        users = get_user_model().objects.filter(id=self.id)
+        return await (users.only(*fields) if fields else users).aget()
+
+    def __repr__(self):
+        return f"<SessionUser {self.id} {self.username}>"
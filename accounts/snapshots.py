@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+
+# User fields a snapshot is built from; saving any of them refreshes it
+SNAPSHOT_FIELDS = {"username", "profile_picture"}
+
+# version of snapshots filled from the database rather than written by a save
+FILLED = 0
+
+
+def get_snapshot_settings():
+    return {
+        "cache": "default",
+        "ttl": 3600,
+        "local_ttl": 10,
+        "local_max_entries": 50000,
+        **getattr(settings, "USER_SNAPSHOT_CACHE", {}),
+    }
+
+
+def snapshot_of(user):
+    """The {id, username, profile_picture} summary sent wherever a user is shown next to content"""
+    return {"id": user.id, "username": user.username, "profile_picture": user.profile_picture}
+
+
+class UserSnapshotCache:
+    """
+    User snapshots in two tiers: a process-local LRU (entries live `local_ttl` seconds)
+    in front of a shared Django cache (entries live `ttl` seconds), in front of the database.
+
+    Every entry carries a version. User.save() writes the new snapshot to both tiers under
+    a fresh time-based version; fills from the database use version FILLED and only go
+    into the shared cache with add(), so a slow fill can never replace a saved snapshot.
+    The local tier never swaps an entry for a lower version. Other workers see a change
+    once their local entry expires, so `local_ttl` bounds how stale a snapshot can be.
+
+    The shared cache is an optimisation: if it is unreachable, lookups fall through to
+    the database and saves only update this process.
+    """
+
+    def __init__(self, cache="default", ttl=3600, local_ttl=10, local_max_entries=50000):
+        self.cache_alias = cache
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.local_max_entries = local_max_entries
+        # user id -> (version, snapshot, expires_at)
+        self.local = OrderedDict()
+        # request threads and the event loop share the local tier
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def key(user_id):
+        return f"user_snapshot:{user_id}"
+
+    def get(self, user_id):
+        return self.get_many([user_id]).get(user_id)
+
+    def get_many(self, user_ids):
+        """{user_id: snapshot} for the given ids; unknown users are left out"""
+        snapshots, missing = self.get_local(user_ids)
+        if missing:
+            snapshots.update(self.fetch(missing))
+        return snapshots
+
+    async def aget(self, user_id):
+        return (await self.aget_many([user_id])).get(user_id)
+
+    async def aget_many(self, user_ids):
+        # local hits don't leave the event loop
+        snapshots, missing = self.get_local(user_ids)
+        if missing:
+            snapshots.update(await database_sync_to_async(self.fetch)(missing))
+        return snapshots
+
+    def update(self, user):
+        """Called once a User save commits: publish the new snapshot to both tiers"""
+        version = time.time_ns()
+        snapshot = snapshot_of(user)
+        self.store_local(user.id, version, snapshot)
+        try:
+            self.shared.set(self.key(user.id), (version, snapshot), self.ttl)
+        except Exception as e:
+            print(f"⚠️ Could not publish snapshot of user {user.id}: {e}")
+
+    def get_local(self, user_ids):
+        now = time.monotonic()
+        snapshots, missing = {}, set()
+        with self.lock:
+            for user_id in set(user_ids):
+                entry = self.local.get(user_id)
+                if entry is not None and entry[2] > now:
+                    self.local.move_to_end(user_id)
+                    snapshots[user_id] = entry[1]
+                else:
+                    missing.add(user_id)
+        return snapshots, missing
+
+    def store_local(self, user_id, version, snapshot):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.local.get(user_id)
+            if entry is not None and entry[0] > version and entry[2] > now:
+                return
+            self.local[user_id] = (version, snapshot, now + self.local_ttl)
+            self.local.move_to_end(user_id)
+            while len(self.local) > self.local_max_entries:
+                self.local.popitem(last=False)
+
+    def fetch(self, user_ids):
+        snapshots = {}
+
+        try:
+            shared = self.shared.get_many([self.key(user_id) for user_id in user_ids])
+        except Exception as e:
+            print(f"⚠️ User snapshot cache unavailable: {e}")
+            shared = None
+
+        for user_id in user_ids:
+            entry = shared.get(self.key(user_id)) if shared else None
+            if entry is not None:
+                self.store_local(user_id, *entry)
+                snapshots[user_id] = entry[1]
+
+        missing = set(user_ids) - snapshots.keys()
+        if not missing:
+            return snapshots
+
+        filled = {}
+        for user in get_user_model().objects.filter(id__in=missing).only("id", "username", "profile_picture"):
+            filled[user.id] = snapshot_of(user)
+            self.store_local(user.id, FILLED, filled[user.id])
+        snapshots.update(filled)
+
+        if shared is not None:
+            try:
+                for user_id, snapshot in filled.items():
+                    self.shared.add(self.key(user_id), (FILLED, snapshot), self.ttl)
+            except Exception as e:
+                print(f"⚠️ User snapshot cache unavailable: {e}")
+
+        return snapshots
+
+
+user_snapshots = UserSnapshotCache(**get_snapshot_settings())
@@ -1,3 +1,312 @@
-from django.test import TestCase
+import tempfile
+import threading
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import SyncToAsync, sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts import hashing
+from accounts.models import UserSearchTerm, UserTrigram
+from accounts.phones import normalize_phone
+from accounts.profiling import install_profiling, install_thread_profiling, load_profile
+from accounts.search import MAX_QUERY_LENGTH, TYPO_TRIGRAMS, search_terms, search_users, trigrams, trigrams_of_terms, typo_matches
+from accounts.snapshots import FILLED, UserSnapshotCache, snapshot_of, user_snapshots
+from chats.models import Message
+from friends.models import FriendRequest, Friendship
+
+User = get_user_model()
+
+
+class BootstrapTests(TestCase):
+    """bootstrap answers in a fixed number of queries however many friends, requests and chats"""
+
+    # friends, pending requests, conversations, last messages, their attachments, suggestions
+    QUERY_BUDGET = 6
+
+    def setUp(self):
+        self.me = User.objects.create(username="me")
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+        self.created = 0
+
+    def add_people(self, count):
+        for _ in range(count):
+            friend, requester, stranger = (User.objects.create(username=f"{kind}{self.created}") for kind in ("friend", "requester", "stranger"))
+            self.created += 1
+            Friendship.objects.create(user1=self.me, user2=friend)
+            FriendRequest.objects.create(from_user=requester, to_user=self.me)
+            Message.objects.create(sender=friend, recipient=self.me, message="hi")
+            Message.objects.create(sender=self.me, recipient=friend, message="hello")
+
+    def test_query_budget(self):
+        for count in (1, 10):
+            self.add_people(count)
+            with self.assertNumQueries(self.QUERY_BUDGET):
+                response = self.client.get("/api/accounts/bootstrap/", {"suggestions": 5})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data["friends"]["results"]), self.created)
+            self.assertEqual(len(response.data["friend_requests"]["results"]), self.created)
+            self.assertEqual(len(response.data["recent_chats"]), self.created)
+            self.assertEqual({chat["unread_count"] for chat in response.data["recent_chats"]}, {1})
+            self.assertEqual({chat["last_message"]["sender"]["username"] for chat in response.data["recent_chats"]}, {"me"})
+            self.assertTrue(all(user["username"].startswith("stranger") for user in response.data["suggestions"]))
+            self.assertEqual(len(response.data["suggestions"]), min(5, self.created))
+
+    def test_suggestions_are_optional(self):
+        self.add_people(1)
+        with self.assertNumQueries(self.QUERY_BUDGET - 1):
+            response = self.client.get("/api/accounts/bootstrap/")
+        self.assertNotIn("suggestions", response.data)
+        self.assertEqual(response.data["profile"]["username"], "me")
+
+
+class HashingPoolTests(SimpleTestCase):
+    def test_replacing_the_pool_stops_its_workers(self):
+        self.addCleanup(hashing.configure_pool, **settings.PASSWORD_HASHING_POOL)
+        pool = hashing.configure_pool(kind="process", workers=1)
+        pool.warm()
+        workers = list(pool.executor._processes.values())
+        self.assertEqual([worker._start_method for worker in workers], ["spawn"])
+
+        hashing.configure_pool(kind="thread", workers=1)
+        for worker in workers:
+            worker.join(timeout=10)
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+
+class HashingPoolSaturationTests(TestCase):
+    def test_login_is_shed_with_retry_after_while_the_pool_is_full(self):
+        User.objects.create_user(username="me", password="password123")
+        self.addCleanup(hashing.configure_pool, **settings.PASSWORD_HASHING_POOL)
+        pool = hashing.configure_pool(kind="thread", workers=1, max_pending=1)
+
+        # a slow hash holds the only slot
+        release, started = threading.Event(), threading.Event()
+        blocker = threading.Thread(target=pool.run, args=(lambda: started.set() or release.wait(10),))
+        blocker.start()
+        self.addCleanup(blocker.join)
+        self.addCleanup(release.set)
+        started.wait(10)
+
+        response = APIClient().post("/api/accounts/login/", {"username": "me", "password": "password123"}, format="json")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+
+        release.set()
+        blocker.join()
+        response = APIClient().post("/api/accounts/login/", {"username": "me", "password": "password123"}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+
+class PhoneNormalizationTests(SimpleTestCase):
+    def test_variants_of_one_number_normalize_alike(self):
+        for raw in ("+44 20 7946 0958", "0044 20 7946 0958", "+44 (20) 7946-0958", "+44.20.7946.0958", "00 44 20/7946 0958"):
+            self.assertEqual(normalize_phone(raw), "+442079460958", raw)
+        # no country code: kept as digits, expanding it is the client's job
+        self.assertEqual(normalize_phone("(020) 7946-0958"), "02079460958")
+
+    def test_implausible_numbers_are_rejected(self):
+        for raw in (None, "", "+", "123", "+1234567890123456", "call me", "+44 20 7946 095x", "++442079460958"):
+            self.assertIsNone(normalize_phone(raw), raw)
+
+
+class UserSnapshotCacheTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        user_snapshots.local.clear()
+        self.user = User.objects.create(username="before")
+
+    def shared_entry(self):
+        return caches["default"].get(UserSnapshotCache.key(self.user.id))
+
+    def save(self, **kwargs):
+        # snapshots are published on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(**kwargs)
+
+    def test_save_publishes_a_newer_version_to_both_tiers(self):
+        # as if the snapshot published by create() had expired
+        caches["default"].clear()
+        user_snapshots.local.clear()
+        self.assertEqual(user_snapshots.get(self.user.id)["username"], "before")
+        self.assertEqual(self.shared_entry()[0], FILLED)
+
+        self.user.username = "after"
+        self.save()
+        version, snapshot = self.shared_entry()
+        self.assertGreater(version, FILLED)
+        self.assertEqual(snapshot["username"], "after")
+        with self.assertNumQueries(0):
+            self.assertEqual(user_snapshots.get(self.user.id)["username"], "after")
+
+    def test_a_fill_never_replaces_a_saved_snapshot(self):
+        stale = snapshot_of(self.user)
+        self.user.username = "after"
+        self.save()
+
+        # a fill that read the row before the save finishes after it
+        user_snapshots.store_local(self.user.id, FILLED, stale)
+        caches["default"].add(UserSnapshotCache.key(self.user.id), (FILLED, stale))
+        self.assertEqual(user_snapshots.get(self.user.id)["username"], "after")
+        self.assertEqual(self.shared_entry()[1]["username"], "after")
+
+    def test_other_workers_see_a_save_once_their_local_entry_expires(self):
+        worker = UserSnapshotCache(local_ttl=60)
+        self.assertEqual(worker.get(self.user.id)["username"], "before")
+
+        self.user.username = "after"
+        self.save()
+        self.assertEqual(worker.get(self.user.id)["username"], "before")
+        worker.local_ttl = 0
+        worker.local.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(worker.get(self.user.id)["username"], "after")
+
+    def test_saves_that_dont_touch_snapshot_fields_publish_nothing(self):
+        entry = self.shared_entry()
+        self.user.bio = "hi"
+        self.save(update_fields=["bio"])
+        self.assertEqual(self.shared_entry(), entry)
+
+    def test_a_rolled_back_save_publishes_nothing(self):
+        self.save()
+        entry = self.shared_entry()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.user.username = "after"
+                self.user.save()
+                raise RuntimeError("profile edit failed")
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.shared_entry(), entry)
+        self.assertEqual(user_snapshots.get(self.user.id)["username"], "before")
+
+
+class UserSearchTests(TestCase):
+    def test_search_terms(self):
+        user = User(username="JDoe", first_name="Jane Mary", last_name="Doe")
+        self.assertEqual(search_terms(user), {"jdoe", "jane", "mary", "doe", "jane mary doe"})
+
+    def test_backfill_indexes_like_save(self):
+        saved = User.objects.create(username="annabel", first_name="Anna", last_name="Annabel")
+        indexed = set(UserTrigram.objects.filter(user=saved).values_list("trigram", flat=True))
+        self.assertEqual(UserTrigram.objects.filter(user=saved).count(), len(indexed))
+        self.assertEqual(indexed, trigrams_of_terms(search_terms(saved)))
+
+        UserSearchTerm.objects.all().delete()
+        UserTrigram.objects.all().delete()
+        import_module("accounts.migrations.0003_user_search_index").backfill_search_index(apps, None)
+        self.assertEqual(sorted(UserTrigram.objects.filter(user=saved).values_list("trigram", flat=True)), sorted(indexed))
+
+    def test_prefix_matches_then_typos_ranked_by_similarity(self):
+        jonathan = User.objects.create(username="jonathan")
+        User.objects.create(username="jonas")
+        User.objects.create(username="zed", first_name="Jonathan")
+        barbara = User.objects.create(username="barbara")
+
+        self.assertEqual([user.username for user in search_users("jona")], ["jonas", "jonathan", "zed"])
+        self.assertEqual(typo_matches("jonathon", excluded_ids=set())[:1], [jonathan.id])
+        self.assertNotIn(barbara.id, typo_matches("jonathon", excluded_ids=set()))
+        self.assertEqual([user.username for user in search_users("jonathon", excluded_ids={jonathan.id})][:1], ["zed"])
+
+
+    def test_trigrams_too_common_to_narrow_the_search_are_not_scanned(self):
+        jonathan = User.objects.create(username="jonathan")
+        jonas = User.objects.create(username="jonas")
+        User.objects.create(username="jonny")
+
+        # "  j", " jo" and "jon" are held by all three users: over the cap they're dropped,
+        # and jonny, who shares nothing else with the query, isn't even scored
+        with mock.patch("accounts.search.TRIGRAM_SCAN", 2), self.assertNumQueries(len(trigrams("jonathon")) + 1):
+            matches = typo_matches("jonathon", excluded_ids=set())
+        self.assertEqual(matches, [jonathan.id, jonas.id])
+
+    def test_overlong_queries_are_refused_or_cut_short(self):
+        me = User.objects.create(username="me")
+        client = APIClient()
+        client.force_authenticate(me)
+        self.assertEqual(client.get("/api/friends/search/", {"q": "a" * (MAX_QUERY_LENGTH + 1)}).status_code, 400)
+        self.assertEqual(client.get("/api/friends/search/", {"q": "a" * MAX_QUERY_LENGTH}).status_code, 200)
+
+        # called directly, the query is truncated and only TYPO_TRIGRAMS trigrams are looked up
+        query = " ".join(f"word{n}" for n in range(2000))
+        with CaptureQueriesContext(connection) as queries:
+            search_users(query)
+        self.assertLessEqual(len(queries), 1 + TYPO_TRIGRAMS + 2)
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(PROFILING={**settings.PROFILING, "enabled": True, "directory": directory.name})
+        override.enable()
+        self.addCleanup(override.disable)
+        install_profiling()
+
+        self.admin = User.objects.create(username="admin", is_staff=True)
+        self.user = User.objects.create(username="user")
+
+    def client_for(self, user):
+        return APIClient(headers={"Authorization": f"Bearer {RefreshToken.for_user(user).access_token}"})
+
+    def test_staff_request_is_profiled_and_retrievable(self):
+        client = self.client_for(self.admin)
+        with self.assertLogs("accounts.profiling", "INFO") as logs:
+            response = client.get("/api/accounts/bootstrap/", headers={"X-Profile": "1"})
+        profile_id = response["X-Profile-Id"]
+        self.assertEqual(logs.output, [f"INFO:accounts.profiling:Profiled GET /api/accounts/bootstrap/: {profile_id}"])
+
+        profile = client.get(f"/api/accounts/profiles/{profile_id}/").json()
+        self.assertEqual(profile["label"], "GET /api/accounts/bootstrap/")
+        self.assertEqual(profile["query_count"], len(profile["queries"]))
+        self.assertTrue(any("friends_friendship" in query["sql"] for query in profile["queries"]))
+        self.assertIn("bootstrap", profile["stats"])
+
+        response = client.get(f"/api/accounts/profiles/{profile_id}/", {"pstats": "1"})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_request_profiles_the_view_thread(self):
+        # under ASGI the sync view runs on an executor thread, not the one that started the profile
+        token = await sync_to_async(lambda: str(RefreshToken.for_user(self.admin).access_token))()
+        response = await AsyncClient().get("/api/accounts/bootstrap/", headers={"Authorization": f"Bearer {token}", "X-Profile": "1"})
+
+        profile = await sync_to_async(load_profile)(response["X-Profile-Id"])
+        self.assertIn("(bootstrap)", profile["stats"])
+        self.assertTrue(any("friends_friendship" in query["sql"] for query in profile["queries"]))
+
+    def test_thread_handler_with_another_signature_is_left_alone(self):
+        def thread_handler(self, loop, source_task, exc_info, func, *args, **kwargs):
+            pass
+
+        with mock.patch.object(SyncToAsync, "thread_handler", thread_handler):
+            with self.assertLogs("accounts.profiling", "WARNING"):
+                self.assertFalse(install_thread_profiling())
+            self.assertIs(SyncToAsync.thread_handler, thread_handler)
+
+    def test_profiling_is_off_unless_enabled(self):
+        with override_settings(PROFILING={**settings.PROFILING, "enabled": False}):
+            response = self.client_for(self.admin).get("/api/accounts/bootstrap/", headers={"X-Profile": "1"})
+            self.assertNotIn("X-Profile-Id", response)
+            response = self.client_for(self.admin).post("/api/accounts/profiles/websocket/", {"user_id": self.user.id}, format="json")
+            self.assertEqual(response.status_code, 404)
+
+    def test_only_staff_can_profile(self):
+        client = self.client_for(self.user)
+        response = client.get("/api/accounts/bootstrap/", {"_profile": "1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Profile-Id", response)
+
+        response = self.client_for(self.admin).get("/api/accounts/bootstrap/")
+        self.assertNotIn("X-Profile-Id", response)
+
+        self.assertEqual(client.get("/api/accounts/profiles/20260101T000000-000000000000/").status_code, 403)
@@ -1,11 +1,14 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
 from rest_framework_simplejwt.views import TokenRefreshView, TokenVerifyView
-from .views import user_signup, user_login
+from .views import bootstrap, profile_detail, user_signup, user_login, websocket_profiling
 
 urlpatterns = [
     path("signup/", user_signup, name="signup"),
     path("login/", user_login, name="login"),
     path("token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     path("token/verify/", TokenVerifyView.as_view(), name="token_verify"),
+    path("bootstrap/", bootstrap, name="bootstrap"),
+    path("profiles/websocket/", websocket_profiling, name="websocket_profiling"),
+    path("profiles/<str:profile_id>/", profile_detail, name="profile_detail"),
 ]
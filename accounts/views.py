@@ -1,12 +1,26 @@
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.http import FileResponse
 from rest_framework import permissions, status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
+from chats.outbox import publish
+from chats.views import build_recent_chats, recent_conversations
+from friends.models import FriendRequest, Friendship
+from friends.serializers import SlimFriendRequestSerializer, SlimFriendSerializer, SlimFriendshipSerializer
+from .hashing import HashingPoolFull, check_password
+from .profiling import get_profiling_settings, load_profile, profile_path
 from .serializers import UserSerializer
+from .snapshots import snapshot_of
 
 User = get_user_model()
 
+# friends and pending requests returned by bootstrap; the paginated lists have the rest
+BOOTSTRAP_LIMIT = 200
+BOOTSTRAP_SUGGESTIONS_LIMIT = 50
+
 
 @api_view(["POST"])
 @permission_classes([permissions.AllowAny])
@@ -21,11 +35,17 @@ def user_signup(request):
     Returns:
     - 201 response object containing user data and JWT tokens upon successful signup.
     - 400 response object containing error details if signup fails.
+    - 503 response object if the password hashing pool is saturated.
     """
 
     serializer = UserSerializer(data=request.data)
     if serializer.is_valid():
-        if user := serializer.save():
+        try:
+            user = serializer.save()
+        except HashingPoolFull:
+            return hashing_pool_busy()
+
+        if user:
             user_profile = serializer.data
             refresh = RefreshToken.for_user(user)
             return Response(
@@ -52,6 +72,7 @@ def user_login(request):
     Returns:
     - 200 response object containing user data and JWT tokens upon successful login.
     - 400 response object containing error details if login fails.
+    - 503 response object if the password hashing pool is saturated.
     """
 
     username = request.data.get("username")
@@ -60,17 +81,25 @@ def user_login(request):
     if username is None or password is None:
         return Response({"error": "Both username/phone-number and password are required."}, status=status.HTTP_400_BAD_REQUEST)
 
-    user = User.objects.filter(username=username).first()
-
-    if user is None:
-        user = User.objects.filter(phone_number=username).first()
+    # one lookup for both; a username match wins over someone else's phone number
+    users = list(User.objects.filter(Q(username=username) | Q(phone_number=username))[:2])
+    user = next((u for u in users if u.username == username), users[0] if users else None)
 
     if user is None:
         return Response({"error": "Invalid login details."}, status=status.HTTP_400_BAD_REQUEST)
 
-    if not user.check_password(password):
+    try:
+        is_valid, new_password = check_password(password, user.password)
+    except HashingPoolFull:
+        return hashing_pool_busy()
+
+    if not is_valid:
         return Response({"error": "Invalid login details."}, status=status.HTTP_400_BAD_REQUEST)
 
+    if new_password:
+        user.password = new_password
+        user.save(update_fields=["password"])
+
     user_profile = UserSerializer(user).data
 
     refresh = RefreshToken.for_user(user)
@@ -82,7 +111,124 @@ def user_login(request):
     return Response(data, status=status.HTTP_200_OK)
 
 
+def hashing_pool_busy():
+    return Response(
+        {"error": "Server is busy, please try again."},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"},
+    )
+
+
 @api_view(["GET"])
 @permission_classes([permissions.IsAuthenticated])
 def get_user_profile(request):
     pass
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def bootstrap(request):
+    """
+    Everything the app shows on launch, in one round trip and a fixed number of queries.
+
+    Arguments:
+    - suggestions (query, optional): how many friend suggestions to include, up to BOOTSTRAP_SUGGESTIONS_LIMIT.
+
+    Returns:
+    - profile: the user's profile
+    - friends: newest BOOTSTRAP_LIMIT friends with presence; has_more when the friends list has more pages
+    - friend_requests: newest BOOTSTRAP_LIMIT pending requests received, same shape
+    - recent_chats: as GET /api/chat/recent/
+    - suggestions: only when asked for
+    """
+    user = request.user
+
+    friendships = list(
+        Friendship.objects.filter(Q(user1=user) | Q(user2=user)).select_related("user1", "user2").order_by("-created_at")[: BOOTSTRAP_LIMIT + 1]
+    )
+    friend_requests = list(
+        FriendRequest.objects.filter(to_user=user, status="pending").select_related("from_user").order_by("-created_at")[: BOOTSTRAP_LIMIT + 1]
+    )
+
+    conversations = recent_conversations(user)
+    # every sender is the user or a friend the conversations query already loaded
+    known_users = [user] + [f.user2 if f.user1_id == user.id else f.user1 for f in conversations]
+    snapshots = {known.id: snapshot_of(known) for known in known_users}
+
+    data = {
+        "profile": UserSerializer(user).data,
+        "friends": {
+            "results": SlimFriendshipSerializer(friendships[:BOOTSTRAP_LIMIT], many=True, context={"request": request}).data,
+            "has_more": len(friendships) > BOOTSTRAP_LIMIT,
+        },
+        "friend_requests": {
+            "results": SlimFriendRequestSerializer(friend_requests[:BOOTSTRAP_LIMIT], many=True).data,
+            "has_more": len(friend_requests) > BOOTSTRAP_LIMIT,
+        },
+        "recent_chats": build_recent_chats(user, conversations, {"user_snapshots": snapshots}),
+    }
+
+    try:
+        suggestions = min(int(request.query_params.get("suggestions", 0)), BOOTSTRAP_SUGGESTIONS_LIMIT)
+    except ValueError:
+        return Response({"error": "suggestions must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+    if suggestions > 0:
+        data["suggestions"] = SlimFriendSerializer(suggested_users(user)[:suggestions], many=True).data
+
+    return Response(data)
+
+
+# ==================== PROFILING ====================
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAdminUser])
+def profile_detail(request, profile_id):
+    """
+    A saved profile: summary, top functions and SQL queries as JSON, or with
+    ?pstats=1 the raw cProfile dump (for snakeviz or pstats).
+    """
+    profile = load_profile(profile_id)
+    if profile is None:
+        return Response({"error": "Profile not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.query_params.get("pstats"):
+        return FileResponse(profile_path(profile_id, ".prof").open("rb"), as_attachment=True, filename=f"{profile_id}.prof")
+    return Response(profile)
+
+
+@api_view(["POST"])
+@permission_classes([permissions.IsAdminUser])
+def websocket_profiling(request):
+    """
+    Turn profiling of a user's websocket frames on or off, on the connections they have open.
+    Expects {"user_id": int, "enabled": bool}; each profiled frame is answered with a
+    {"type": "profile", "profile_id": ...} frame.
+    """
+    if not get_profiling_settings()["enabled"]:
+        return Response({"error": "Profiling is disabled."}, status=status.HTTP_404_NOT_FOUND)
+
+    user_id = request.data.get("user_id")
+    enabled = request.data.get("enabled", True)
+    if not isinstance(user_id, int) or not isinstance(enabled, bool):
+        return Response({"error": "user_id (int) and enabled (bool) are required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    with transaction.atomic():
+        publish(f"user_{user_id}", {"type": "profiling_handler", "enabled": enabled})
+
+    return Response({"user_id": user_id, "enabled": enabled})
+
+
+# ==================== HELPERS ====================
+
+
+def suggested_users(user):
+    """friend_suggestions' users (not friends, no pending request either way) as one query"""
+    pending = FriendRequest.objects.filter(status="pending")
+    return (
+        User.objects.exclude(id=user.id)
+        .exclude(id__in=Friendship.objects.filter(user1=user).values("user2_id"))
+        .exclude(id__in=Friendship.objects.filter(user2=user).values("user1_id"))
+        .exclude(id__in=pending.filter(from_user=user).values("to_user_id"))
+        .exclude(id__in=pending.filter(to_user=user).values("from_user_id"))
+    )
@@ -0,0 +1,76 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from attachments import storage
+from attachments.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete resumable uploads that were abandoned before their last chunk: unfinished upload "
+        "sessions untouched for ATTACHMENTS_UPLOAD_EXPIRY, their partial files, and partial or "
+        "staged chunk files no session owns (left by a crash). Run it periodically, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=float,
+            default=None,
+            help="hours without a chunk before an upload counts as abandoned (default: ATTACHMENTS_UPLOAD_EXPIRY)",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="count what would be deleted without deleting it")
+
+    def handle(self, *args, **options):
+        expiry = timedelta(hours=options["older_than"]) if options["older_than"] is not None else settings.ATTACHMENTS_UPLOAD_EXPIRY
+        cutoff = timezone.now() - expiry
+        dry_run = options["dry_run"]
+
+        abandoned = UploadSession.objects.filter(attachment__isnull=True, updated_at__lt=cutoff)
+        session_ids = list(abandoned.values_list("id", flat=True))
+        if not dry_run:
+            for session_id in session_ids:
+                storage.upload_path(session_id).unlink(missing_ok=True)
+            abandoned.filter(id__in=session_ids).delete()
+
+        files = self.prune_orphan_files(cutoff, dry_run)
+
+        verb = "would delete" if dry_run else "deleted"
+        self.stdout.write(f"🧹 {verb} {len(session_ids):,} abandoned uploads and {files:,} orphaned files")
+
+    def prune_orphan_files(self, cutoff, dry_run):
+        directory = storage.root() / "uploads"
+        if not directory.exists():
+            return 0
+
+        unfinished = {str(session_id) for session_id in UploadSession.objects.filter(attachment__isnull=True).values_list("id", flat=True)}
+        cutoff = cutoff.timestamp()
+        pruned = 0
+        for path in directory.iterdir():
+            # <session>.part is a live upload's; <session>.<random>.chunk only lives for one request
+            session_id = path.name.split(".", 1)[0]
+            if path.suffix == ".part" and session_id in unfinished:
+                continue
+            if path.suffix not in (".part", ".chunk") or not self.is_uuid(session_id):
+                continue
+            try:
+                if path.stat().st_mtime >= cutoff:
+                    continue
+                if not dry_run:
+                    path.unlink()
+            except FileNotFoundError:
+                continue
+            pruned += 1
+        return pruned
+
+    @staticmethod
+    def is_uuid(value):
+        try:
+            uuid.UUID(value)
+        except ValueError:
+            return False
+        return True
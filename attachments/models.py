@@ -0,0 +1,51 @@
+import uuid
+from django.db import models
+from django.contrib.auth import get_user_model
+
+User = get_user_model()
+
+
+class Attachment(models.Model):
+    """
+    A file shared in chat. Content is stored once per sha256 (see storage.blob_path),
+    so several attachments can point at the same blob.
+    """
+
+    owner = models.ForeignKey(User, related_name="attachments", on_delete=models.CASCADE)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.filename} ({self.size} bytes)"
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload: chunks are appended to a partial file on disk until `received == size`,
+    then the file is hashed and turned into an Attachment.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, related_name="upload_sessions", on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    attachment = models.OneToOneField(Attachment, related_name="upload", null=True, blank=True, on_delete=models.SET_NULL)
+    # set while a chunk request copies its bytes into the partial file, see views.upload_chunk
+    writing_since = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def is_complete(self):
+        return self.received == self.size
+
+    def __str__(self):
+        return f"{self.filename}: {self.received}/{self.size}"
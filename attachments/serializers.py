@@ -0,0 +1,25 @@
+from django.conf import settings
+from rest_framework import serializers
+from .models import Attachment, UploadSession
+
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Attachment
+        fields = ["id", "filename", "content_type", "size", "sha256", "created_at"]
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    attachment = AttachmentSerializer(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ["id", "filename", "content_type", "size", "received", "attachment"]
+        read_only_fields = ["id", "received", "attachment"]
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("Size must be positive.")
+        if value > settings.ATTACHMENT_MAX_SIZE:
+            raise serializers.ValidationError(f"Files are limited to {settings.ATTACHMENT_MAX_SIZE} bytes.")
+        return value
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+# bytes moved per read/write: bounds memory per upload/download regardless of file size
+BLOCK_SIZE = 1024 * 1024
+
+
+def root():
+    return Path(settings.ATTACHMENTS_ROOT)
+
+
+def upload_path(session_id):
+    return root() / "uploads" / f"{session_id}.part"
+
+
+def staging_path(session_id):
+    """A file of one chunk request's own, copied into the upload once the request owns its offset"""
+    return root() / "uploads" / f"{session_id}.{uuid.uuid4().hex}.chunk"
+
+
+def blob_path(sha256):
+    return root() / "blobs" / sha256[:2] / sha256
+
+
+def write_chunk(path, offset, stream, length):
+    """
+    Copy `length` bytes from a file-like `stream` into `path` at `offset`, one block at a time.
+    Returns the number of bytes written (short if the stream ended early).
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    with open(path, "r+b" if path.exists() else "wb") as f:
+        f.seek(offset)
+        while written < length:
+            block = stream.read(min(BLOCK_SIZE, length - written))
+            if not block:
+                break
+            f.write(block)
+            written += len(block)
+        f.truncate(offset + written)
+    return written
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(BLOCK_SIZE):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def store_blob(path, sha256):
+    """
+    Move a finished upload to its content-addressed location.
+    If the same content is already stored, the upload is discarded instead.
+    """
+    target = blob_path(sha256)
+    if target.exists():
+        path.unlink()
+        return target
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(path, target)
+    return target
+
+
+def iter_range(path, start, end):
+    """Yield bytes start..end (inclusive) of a file in BLOCK_SIZE pieces"""
+    remaining = end - start + 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+async def aiter_range(path, start, end):
+    """
+    Async twin of iter_range() for ASGI, where Django would otherwise drain a
+    sync iterator into a list (i.e. the whole file into memory) before sending it.
+    """
+    remaining = end - start + 1
+    f = await sync_to_async(open)(path, "rb")
+    try:
+        await sync_to_async(f.seek)(start)
+        while remaining > 0:
+            block = await sync_to_async(f.read)(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        await sync_to_async(f.close)()
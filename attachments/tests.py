@@ -0,0 +1,267 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import tracemalloc
+import uuid
+from datetime import timedelta
+from io import StringIO
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.management import call_command
+from django.test import AsyncClient, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import storage
+from .models import Attachment, UploadSession
+from .views import CHUNK_LEASE, upload_chunk
+
+User = get_user_model()
+
+MB = 1024 * 1024
+
+
+class PatternStream:
+    """File-like request body of `size` bytes generated on the fly"""
+
+    def __init__(self, size, seed=b"konvo"):
+        self.remaining = size
+        self.block = (hashlib.sha256(seed).digest() * (MB // 32 + 1))[:MB]
+
+    def read(self, n=-1):
+        n = self.remaining if n is None or n < 0 else min(n, self.remaining)
+        n = min(n, len(self.block))
+        self.remaining -= n
+        return self.block[:n]
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def pattern_sha256(size):
+    sha256 = hashlib.sha256()
+    stream = PatternStream(size)
+    while block := stream.read(MB):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+class AttachmentTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings_override = override_settings(ATTACHMENTS_ROOT=self.root, ATTACHMENT_MAX_SIZE=1024 * MB)
+        self.settings_override.enable()
+
+        self.user = User.objects.create_user(username="alice", password="password123", phone_number="+15550000001")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def start_upload(self, size, filename="file.bin"):
+        response = self.client.post("/api/attachments/uploads/", {"filename": filename, "content_type": "application/octet-stream", "size": size}, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.json()["id"]
+
+    def put_chunk(self, session_id, start, end, size, body):
+        return self.client.generic(
+            "PUT",
+            f"/api/attachments/uploads/{session_id}/",
+            body,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{end}/{size}",
+        )
+
+    def stream_chunk(self, session_id, start, end, size):
+        """PUT a chunk whose body is generated while the view reads it, like a real socket"""
+        length = end - start + 1
+        environ = APIRequestFactory()._base_environ(
+            PATH_INFO=f"/api/attachments/uploads/{session_id}/",
+            REQUEST_METHOD="PUT",
+            CONTENT_TYPE="application/octet-stream",
+            CONTENT_LENGTH=str(length),
+            HTTP_CONTENT_RANGE=f"bytes {start}-{end}/{size}",
+            **{"wsgi.input": PatternStream(length)},
+        )
+        request = WSGIRequest(environ)
+        force_authenticate(request, user=self.user)
+        return upload_chunk(request, session_id=session_id)
+
+
+class ResumableUploadTests(AttachmentTestCase):
+    def test_chunks_resume_from_received_offset(self):
+        data = b"0123456789" * 10
+        session_id = self.start_upload(len(data))
+
+        response = self.put_chunk(session_id, 0, 39, len(data), data[:40])
+        self.assertEqual(response.json()["received"], 40)
+
+        # a retry of an old chunk is rejected with the offset to resume from
+        response = self.put_chunk(session_id, 0, 39, len(data), data[:40])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(f"/api/attachments/uploads/{session_id}/").json()["received"], 40)
+
+        response = self.put_chunk(session_id, 40, 99, len(data), data[40:])
+        attachment = response.json()["attachment"]
+        self.assertEqual(attachment["sha256"], hashlib.sha256(data).hexdigest())
+
+        download = self.client.get(f"/api/attachments/{attachment['id']}/")
+        self.assertEqual(b"".join(download.streaming_content), data)
+
+        partial = self.client.get(f"/api/attachments/{attachment['id']}/", HTTP_RANGE="bytes=10-19")
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial["Content-Range"], f"bytes 10-19/{len(data)}")
+        self.assertEqual(b"".join(partial.streaming_content), data[10:20])
+
+    def test_losing_duplicate_chunk_leaves_the_winners_bytes(self):
+        data = b"0123456789" * 4
+        session_id = self.start_upload(len(data))
+
+        class DuplicateBody:
+            """A retry of the first chunk whose body is still arriving when the original lands"""
+
+            def __init__(body):
+                body.sent = False
+
+            def read(body, n=-1):
+                if body.sent:
+                    return b""
+                body.sent = True
+                self.assertEqual(self.put_chunk(session_id, 0, 19, len(data), data[:20]).status_code, 200)
+                return b"x" * 20
+
+            readline = read
+
+        environ = APIRequestFactory()._base_environ(
+            PATH_INFO=f"/api/attachments/uploads/{session_id}/",
+            REQUEST_METHOD="PUT",
+            CONTENT_TYPE="application/octet-stream",
+            CONTENT_LENGTH="20",
+            HTTP_CONTENT_RANGE=f"bytes 0-19/{len(data)}",
+            **{"wsgi.input": DuplicateBody()},
+        )
+        request = WSGIRequest(environ)
+        force_authenticate(request, user=self.user)
+        self.assertEqual(upload_chunk(request, session_id=session_id).status_code, 409)
+
+        response = self.put_chunk(session_id, 20, 39, len(data), data[20:])
+        self.assertEqual(response.json()["attachment"]["sha256"], hashlib.sha256(data).hexdigest())
+
+    def test_chunk_larger_than_the_limit_is_rejected(self):
+        data = b"0123456789" * 4
+        session_id = self.start_upload(len(data))
+        with self.settings(ATTACHMENTS_MAX_CHUNK=16):
+            response = self.put_chunk(session_id, 0, 19, len(data), data[:20])
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(response.json()["received"], 0)
+
+            self.assertEqual(self.put_chunk(session_id, 0, 15, len(data), data[:16]).status_code, 200)
+
+    def test_offset_being_written_is_not_claimed_twice_until_the_lease_lapses(self):
+        data = b"0123456789" * 4
+        session_id = self.start_upload(len(data))
+
+        # another request is copying the first chunk in
+        UploadSession.objects.filter(id=session_id).update(writing_since=timezone.now())
+        self.assertEqual(self.put_chunk(session_id, 0, 19, len(data), data[:20]).status_code, 409)
+
+        # ...or died doing so
+        UploadSession.objects.filter(id=session_id).update(writing_since=timezone.now() - CHUNK_LEASE - timedelta(seconds=1))
+        self.assertEqual(self.put_chunk(session_id, 0, 19, len(data), data[:20]).json()["received"], 20)
+        self.assertIsNone(UploadSession.objects.get(id=session_id).writing_since)
+
+    def test_identical_uploads_share_one_blob(self):
+        data = b"same bytes"
+        for _ in range(2):
+            session_id = self.start_upload(len(data))
+            self.put_chunk(session_id, 0, len(data) - 1, len(data), data)
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.assertEqual(Attachment.objects.filter(sha256=sha256).count(), 2)
+        self.assertEqual(len(list(storage.blob_path(sha256).parent.iterdir())), 1)
+        self.assertFalse(any((storage.root() / "uploads").iterdir()))
+
+
+class PruneUploadsTests(AttachmentTestCase):
+    def test_abandoned_uploads_and_orphaned_files_are_deleted(self):
+        data = b"0123456789" * 4
+        abandoned = self.start_upload(len(data))
+        self.put_chunk(abandoned, 0, 19, len(data), data[:20])
+        active = self.start_upload(len(data))
+        self.put_chunk(active, 0, 19, len(data), data[:20])
+        UploadSession.objects.filter(id=abandoned).update(updated_at=timezone.now() - timedelta(days=2))
+
+        # a staged chunk left by a crashed request, and one still being received
+        crashed = storage.staging_path(active)
+        crashed.write_bytes(b"x")
+        os.utime(crashed, (0, 0))
+        receiving = storage.staging_path(active)
+        receiving.write_bytes(b"x")
+
+        out = StringIO()
+        call_command("prune_uploads", stdout=out)
+        self.assertIn("deleted 1 abandoned uploads and 1 orphaned files", out.getvalue())
+
+        self.assertEqual(list(UploadSession.objects.values_list("id", flat=True)), [uuid.UUID(active)])
+        self.assertFalse(storage.upload_path(abandoned).exists())
+        self.assertTrue(storage.upload_path(active).exists())
+        self.assertFalse(crashed.exists())
+        self.assertTrue(receiving.exists())
+
+
+class BoundedMemoryTests(AttachmentTestCase):
+    SIZE = 300 * MB
+    CHUNK = 100 * MB
+    # peak Python allocations while moving SIZE bytes through upload, hashing and download
+    MEMORY_BUDGET = 16 * MB
+
+    def test_large_upload_and_download_use_bounded_memory(self):
+        session_id = self.start_upload(self.SIZE)
+
+        tracemalloc.start()
+        try:
+            for start in range(0, self.SIZE, self.CHUNK):
+                response = self.stream_chunk(session_id, start, start + self.CHUNK - 1, self.SIZE)
+                self.assertEqual(response.status_code, 200)
+            upload_peak = tracemalloc.get_traced_memory()[1]
+
+            tracemalloc.reset_peak()
+            attachment_id = UploadSession.objects.get(id=session_id).attachment_id
+            download = self.client.get(f"/api/attachments/{attachment_id}/")
+            downloaded = sum(len(block) for block in download.streaming_content)
+            download_peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(Attachment.objects.get(id=attachment_id).sha256, pattern_sha256(self.SIZE))
+        self.assertEqual(downloaded, self.SIZE)
+        self.assertLess(upload_peak, self.MEMORY_BUDGET)
+        self.assertLess(download_peak, self.MEMORY_BUDGET)
+
+    async def test_asgi_download_streams_without_buffering(self):
+        path = storage.upload_path("asgi")
+        await sync_to_async(storage.write_chunk)(path, 0, PatternStream(self.CHUNK), self.CHUNK)
+        sha256 = await sync_to_async(storage.hash_file)(path)
+        await sync_to_async(storage.store_blob)(path, sha256)
+        attachment = await Attachment.objects.acreate(owner=self.user, sha256=sha256, size=self.CHUNK, filename="a.bin", content_type="application/octet-stream")
+
+        token = str(AccessToken.for_user(self.user))
+
+        tracemalloc.start()
+        try:
+            response = await AsyncClient().get(f"/api/attachments/{attachment.id}/", headers={"Authorization": f"Bearer {token}"})
+            downloaded = 0
+            async for block in response:
+                downloaded += len(block)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(downloaded, self.CHUNK)
+        self.assertLess(peak, self.MEMORY_BUDGET)
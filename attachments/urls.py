@@ -0,0 +1,8 @@
+from django.urls import path
+from .views import create_upload, upload_chunk, download_attachment
+
+urlpatterns = [
+    path("uploads/", create_upload, name="create_upload"),
+    path("uploads/<uuid:session_id>/", upload_chunk, name="upload_chunk"),
+    path("<int:attachment_id>/", download_attachment, name="download_attachment"),
+]
@@ -0,0 +1,228 @@
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from . import storage
+from .models import Attachment, UploadSession
+from .serializers import UploadSessionSerializer
+
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# how long a chunk request may hold the upload's offset while copying its bytes in
+CHUNK_LEASE = timedelta(minutes=5)
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def create_upload(request):
+    """
+    Start a resumable upload.
+    Expects {"filename": str, "content_type": str, "size": int}.
+
+    Returns:
+    - 201 with the upload session; its "id" is used for the chunk uploads and "received" is the offset to send next.
+    - 400 with error details if the metadata is invalid or the file is too large.
+    """
+    serializer = UploadSessionSerializer(data=request.data)
+    if serializer.is_valid():
+        session = serializer.save(owner=request.user)
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_201_CREATED)
+
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["GET", "PUT"])
+@permission_classes([IsAuthenticated])
+def upload_chunk(request, session_id):
+    """
+    GET: the upload session; "received" is where to resume after a dropped connection.
+
+    PUT: the raw request body is the chunk, placed by a "Content-Range: bytes start-end/size" header.
+    Chunks must be sent in order, starting at "received". The body is copied to disk block by
+    block and never read into memory as a whole. Once the last byte arrives, the file is hashed
+    and stored (deduplicated by sha256), and the session's "attachment" is filled in.
+
+    Returns:
+    - 200 with the updated session.
+    - 400 if Content-Range is missing/invalid or the body is shorter than the range.
+    - 404 if the session doesn't exist or belongs to someone else.
+    - 409 if "start" isn't the session's current offset, or another request is writing it; resume from "received".
+    - 413 if the chunk is larger than settings.ATTACHMENTS_MAX_CHUNK.
+    """
+    session = UploadSession.objects.filter(id=session_id, owner=request.user).select_related("attachment").first()
+    if session is None:
+        return Response({"error": "Upload does not exist."}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == "GET" or session.attachment_id:
+        return Response(UploadSessionSerializer(session).data)
+
+    match = CONTENT_RANGE_RE.match(request.headers.get("Content-Range", ""))
+    if not match:
+        return Response({"error": "A 'Content-Range: bytes start-end/size' header is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    start, end, total = map(int, match.groups())
+    if total != session.size or start > end or end >= total:
+        return Response({"error": "Invalid Content-Range."}, status=status.HTTP_400_BAD_REQUEST)
+
+    if start != session.received:
+        return Response({"error": "Upload offset mismatch.", "received": session.received}, status=status.HTTP_409_CONFLICT)
+
+    length = end - start + 1
+    if length > settings.ATTACHMENTS_MAX_CHUNK:
+        return Response(
+            {"error": f"Chunks are limited to {settings.ATTACHMENTS_MAX_CHUNK} bytes.", "received": session.received},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        )
+
+    written = 0
+    # the body is received into a file of this request's own: only the request that claims the
+    # offset below may write to the upload, or a losing duplicate could overwrite the winner's bytes
+    staged = storage.staging_path(session.id)
+    try:
+        if request.stream is not None:
+            written = storage.write_chunk(staged, 0, request.stream, length)
+
+        # claimed in a statement of its own and copied with no transaction open: the copy takes as long
+        # as the chunk is big, and SQLite would hold its write lock for all of it. A claim left
+        # by a request that died mid-copy lapses after CHUNK_LEASE.
+        claimed_at = timezone.now()
+        claimed = (
+            UploadSession.objects.filter(id=session.id, received=start)
+            .filter(Q(writing_since__isnull=True) | Q(writing_since__lt=claimed_at - CHUNK_LEASE))
+            .update(writing_since=claimed_at)
+        )
+        if claimed:
+            try:
+                if written:
+                    with open(staged, "rb") as chunk:
+                        storage.write_chunk(storage.upload_path(session.id), start, chunk, written)
+            except BaseException:
+                UploadSession.objects.filter(id=session.id, writing_since=claimed_at).update(writing_since=None)
+                raise
+            # still ours unless the lease ran out and another request took over the offset
+            claimed = UploadSession.objects.filter(id=session.id, writing_since=claimed_at).update(
+                received=start + written, writing_since=None, updated_at=timezone.now()
+            )
+    finally:
+        staged.unlink(missing_ok=True)
+
+    if not claimed:
+        session.refresh_from_db()
+        return Response({"error": "Upload offset mismatch.", "received": session.received}, status=status.HTTP_409_CONFLICT)
+    session.received = start + written
+
+    if written != length:
+        return Response({"error": "Incomplete chunk.", "received": session.received}, status=status.HTTP_400_BAD_REQUEST)
+
+    if session.is_complete:
+        finish_upload(session)
+
+    return Response(UploadSessionSerializer(session).data)
+
+
+def finish_upload(session):
+    path = storage.upload_path(session.id)
+    sha256 = storage.hash_file(path)
+    storage.store_blob(path, sha256)
+
+    with transaction.atomic():
+        session.attachment = Attachment.objects.create(
+            owner_id=session.owner_id,
+            sha256=sha256,
+            size=session.size,
+            filename=session.filename,
+            content_type=session.content_type,
+        )
+        session.save(update_fields=["attachment", "updated_at"])
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def download_attachment(request, attachment_id):
+    """
+    Stream an attachment to its owner or to either side of a message it was sent with.
+
+    Supports single "Range: bytes=..." requests (206). With ATTACHMENTS_SENDFILE_HEADER set
+    (e.g. "X-Accel-Redirect"), the file is handed to the reverse proxy to send with sendfile.
+    """
+    from chats.models import Message
+    from chats.sharding import get_message_shards
+
+    user = request.user
+    attachment = Attachment.objects.filter(id=attachment_id).first()
+    if attachment is None or (
+        attachment.owner_id != user.id
+        and not any(
+            Message.objects.using(shard).filter(Q(sender=user) | Q(recipient=user), attachments=attachment.id).exists() for shard in get_message_shards()
+        )
+    ):
+        return Response({"error": "Attachment does not exist."}, status=status.HTTP_404_NOT_FOUND)
+
+    path = storage.blob_path(attachment.sha256)
+
+    if header := getattr(settings, "ATTACHMENTS_SENDFILE_HEADER", None):
+        response = HttpResponse(content_type=attachment.content_type)
+        response[header] = settings.ATTACHMENTS_SENDFILE_PREFIX + path.relative_to(storage.root()).as_posix()
+        response["Content-Disposition"] = content_disposition_header(True, attachment.filename)
+        return response
+
+    start, end = 0, attachment.size - 1
+    partial = False
+    if range_header := request.headers.get("Range"):
+        byte_range = parse_range(range_header, attachment.size)
+        if byte_range is None:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response["Content-Range"] = f"bytes */{attachment.size}"
+            return response
+        start, end = byte_range
+        partial = True
+
+    # Django drains sync iterators into memory under ASGI and async ones under WSGI
+    if isinstance(request._request, ASGIRequest):
+        content = storage.aiter_range(path, start, end)
+    else:
+        content = storage.iter_range(path, start, end)
+
+    response = StreamingHttpResponse(
+        content,
+        status=status.HTTP_206_PARTIAL_CONTENT if partial else status.HTTP_200_OK,
+        content_type=attachment.content_type,
+    )
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = f'"{attachment.sha256}"'
+    response["Content-Disposition"] = content_disposition_header(True, attachment.filename)
+    if partial:
+        response["Content-Range"] = f"bytes {start}-{end}/{attachment.size}"
+    return response
+
+
+def parse_range(header, size):
+    """
+    Parse a single "bytes=start-end" / "bytes=start-" / "bytes=-suffix" range.
+    Returns (start, end) inclusive, or None if it can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start > end or start >= size:
+        return None
+    return start, end
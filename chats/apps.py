@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import pre_delete
 
 
 class ChatsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chats'
+
+    def ready(self):
+        from .sharding import delete_user_messages
+
+        pre_delete.connect(delete_user_messages, sender=settings.AUTH_USER_MODEL, dispatch_uid="chats.sharding.delete_user_messages")
@@ -0,0 +1,91 @@
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+
+from accounts.async_auth import async_api_view
+from accounts.snapshots import user_snapshots
+from .history import PAGE_SIZE, conversation_history, with_senders
+from .models import Message
+from .serializers import MessageSerializer
+from .sharding import conversation_messages, is_sharded, partners_by_shard, prefetch_attachments, shard_for
+from .views import (
+    build_recent_chats,
+    friendships_with_friend_id,
+    recent_chats_queryset,
+    shard_last_messages,
+    shard_unread_counts,
+    with_last_message,
+)
+
+# Async twins of the direct-chat views in views.py, served instead of them when
+# settings.ASYNC_API_VIEWS is on. Same URLs, same responses; the queries run on the async
+# ORM and sender snapshots come from the local cache tier without leaving the event loop.
+
+
+@async_api_view(["GET"])
+async def chat_history(request, friend_id):
+    """
+    Get last 50 messages between current user and friend_id
+    """
+    user = request.user
+
+    rows, version = await conversation_history.aget(user.id, friend_id)
+    if rows is not None:
+        snapshots = await user_snapshots.aget_many({sender_id for sender_id, _ in rows})
+        return JsonResponse({"messages": with_senders(rows, snapshots)})
+
+    messages = [message async for message in conversation_messages(user.id, friend_id).order_by("-timestamp")[:PAGE_SIZE]]
+    messages.reverse()  # oldest first
+    await sync_to_async(prefetch_attachments)(messages)
+
+    snapshots = await user_snapshots.aget_many({message.sender_id for message in messages})
+    serializer = MessageSerializer(messages, many=True, context={"user_snapshots": snapshots})
+    conversation_history.store(user.id, friend_id, version, messages, serializer.data)
+
+    return JsonResponse({"messages": serializer.data})
+
+
+@async_api_view(["GET"])
+async def recent_chats(request):
+    """
+    Get list of friends user has chatted with, ordered by last message
+    """
+    user = request.user
+
+    conversations = await recent_conversations(user)
+    snapshots = await user_snapshots.aget_many({conversation.last_message.sender_id for conversation in conversations})
+
+    return JsonResponse({"chats": build_recent_chats(user, conversations, {"user_snapshots": snapshots})})
+
+
+async def recent_conversations(user):
+    """views.recent_conversations() on the async ORM"""
+    if not is_sharded():
+        conversations = [conversation async for conversation in recent_chats_queryset(user)]
+        last_messages = await Message.objects.ain_bulk([conversation.last_message_id for conversation in conversations])
+        for conversation in conversations:
+            conversation.last_message = last_messages[conversation.last_message_id]
+    else:
+        friendships = {friendship.friend_id: friendship async for friendship in friendships_with_friend_id(user)}
+        conversations = []
+        for shard, friend_ids in partners_by_shard(user.id, friendships).items():
+            unread_counts = {sender_id: count async for sender_id, count in shard_unread_counts(user, shard, friend_ids)}
+            async for message in shard_last_messages(user, shard, friend_ids):
+                conversations.append(with_last_message(friendships[message.friend_id], message, unread_counts))
+
+    # prefetch_related_objects() has no async form
+    await sync_to_async(prefetch_attachments)([conversation.last_message for conversation in conversations])
+    return conversations
+
+
+@async_api_view(["POST"])
+async def mark_messages_read(request, friend_id):
+    """
+    Mark all messages from friend_id as read
+    """
+    user = request.user
+
+    updated = await Message.objects.using(shard_for(user.id, friend_id)).filter(sender_id=friend_id, recipient=user, is_read=False).aupdate(is_read=True)
+    if updated:
+        await sync_to_async(conversation_history.mark_read)(user.id, friend_id)
+
+    return JsonResponse({"marked_read": updated})
@@ -0,0 +1,75 @@
+import uuid
+from collections import OrderedDict
+
+from django.utils import timezone
+
+# every RealtimeConsumer joins this group; HybridChannelLayer joins it once per worker
+BROADCAST_GROUP = "broadcast"
+
+AUDIENCE_FIELDS = {"user_ids", "exclude_user_ids", "percent"}
+
+
+def parse_audience(value):
+    """
+    Validate an audience filter, or raise ValueError. An empty filter means everyone
+    connected; otherwise a connection must pass every given field:
+    - user_ids: only these users
+    - exclude_user_ids: not these users
+    - percent: users whose id % 100 falls below it, the same users each time (rollouts)
+    """
+    if value is None:
+        return {}
+    if not isinstance(value, dict) or not value.keys() <= AUDIENCE_FIELDS:
+        raise ValueError(f"'audience' must be an object with any of: {', '.join(sorted(AUDIENCE_FIELDS))}.")
+
+    for field in ("user_ids", "exclude_user_ids"):
+        if field in value and (not isinstance(value[field], list) or not all(type(user_id) is int for user_id in value[field])):
+            raise ValueError(f"'{field}' must be a list of user IDs.")
+
+    percent = value.get("percent")
+    if percent is not None and (isinstance(percent, bool) or not isinstance(percent, (int, float)) or not 0 <= percent <= 100):
+        raise ValueError("'percent' must be a number from 0 to 100.")
+
+    return value
+
+
+def broadcast_event(kind, payload=None, audience=None):
+    """
+    The channel-layer message for BROADCAST_GROUP: clients in the audience get
+    {"type": "broadcast", "kind", "payload", "timestamp"}.
+    """
+    return {
+        "type": "broadcast_handler",
+        "broadcast_id": uuid.uuid4().hex,
+        "audience": parse_audience(audience),
+        "data": {"type": "broadcast", "kind": kind, "payload": payload or {}, "timestamp": timezone.now().isoformat()},
+    }
+
+
+class Audience:
+    """An audience filter with its id lists as sets, built once per broadcast and worker"""
+
+    def __init__(self, spec):
+        self.user_ids = set(spec["user_ids"]) if "user_ids" in spec else None
+        self.exclude_user_ids = set(spec.get("exclude_user_ids", ()))
+        self.percent = spec.get("percent")
+
+    def includes(self, user_id):
+        if self.user_ids is not None and user_id not in self.user_ids:
+            return False
+        if user_id in self.exclude_user_ids:
+            return False
+        return self.percent is None or user_id % 100 < self.percent
+
+
+# broadcast id -> Audience; each local member of a broadcast looks the same one up
+_audiences = OrderedDict()
+
+
+def audience_of(event):
+    audience = _audiences.get(event["broadcast_id"])
+    if audience is None:
+        audience = _audiences[event["broadcast_id"]] = Audience(event.get("audience") or {})
+        while len(_audiences) > 64:
+            _audiences.popitem(last=False)
+    return audience
@@ -0,0 +1,190 @@
+import json
+import zlib
+from datetime import datetime
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # channels_redis depends on msgpack, but the in-memory layer doesn't
+    msgpack = None
+
+COMPACT_SUBPROTOCOL = "konvo.compact.v1"
+
+# compact frames start with one flag byte
+RAW = 0x00
+DEFLATED = 0x01
+
+# largest inbound frame we'll inflate, client frames are small
+MAX_INFLATED_SIZE = 64 * 1024
+
+# Short ids for every key sent over the wire. Append only: ids are part of the protocol.
+FIELD_IDS = {
+    "type": 0,
+    "id": 1,
+    "message": 2,
+    "sender": 3,
+    "recipient_id": 4,
+    "timestamp": 5,
+    "is_read": 6,
+    "temp_id": 7,
+    "username": 8,
+    "profile_picture": 9,
+    "user_id": 10,
+    "is_online": 11,
+    "status": 12,
+    "code": 13,
+    "retry_after": 14,
+    "count": 15,
+    "from_user": 16,
+    "accepted_by": 17,
+    "rejected_by": 18,
+    "room_id": 19,
+    "attachments": 20,
+    "filename": 21,
+    "content_type": 22,
+    "size": 23,
+    "outbox_id": 24,
+    "statuses": 25,
+    "kind": 26,
+    "payload": 27,
+}
+FIELD_NAMES = {field_id: name for name, field_id in FIELD_IDS.items()}
+
+# Short ids for frame types. Append only.
+TYPE_IDS = {
+    "connection": 0,
+    "chat_message": 1,
+    "message_sent": 2,
+    "error": 3,
+    "user_status": 4,
+    "friend_request": 5,
+    "friend_request_accepted": 6,
+    "friend_request_rejected": 7,
+    "frames_dropped": 8,
+    "typing": 9,
+    "stopped_typing": 10,
+    "viewing": 11,
+    "stopped_viewing": 12,
+    "room_message": 13,
+    "room_joined": 14,
+    "room_left": 15,
+    "user_status_batch": 16,
+    "broadcast": 17,
+}
+TYPE_NAMES = {type_id: name for name, type_id in TYPE_IDS.items()}
+
+# ISO 8601 strings sent as integer epoch milliseconds
+TIMESTAMP_FIELDS = {"timestamp"}
+
+# free-form values (broadcast payloads) sent exactly as given: their keys aren't
+# ours to shorten and a "timestamp" in them needn't be a date
+OPAQUE_FIELDS = {"payload"}
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JsonCodec:
+    """Default text protocol: one JSON object per text frame"""
+
+    subprotocol = None
+
+    def encode(self, data):
+        return {"text_data": json.dumps(data)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            return json.loads(text_data if text_data is not None else bytes_data)
+        except ValueError:
+            raise CodecError("Invalid JSON")
+
+
+class CompactCodec:
+    """
+    Binary protocol: MessagePack with short ids for keys and frame types and
+    epoch-millisecond timestamps, deflated when the packed frame reaches
+    `compress_threshold` bytes (None disables compression).
+    """
+
+    subprotocol = COMPACT_SUBPROTOCOL
+
+    def __init__(self, compress_threshold=512, compress_level=6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, data):
+        payload = msgpack.packb(compact(data), use_bin_type=True)
+
+        if self.compress_threshold is not None and len(payload) >= self.compress_threshold:
+            deflated = zlib.compress(payload, self.compress_level)
+            if len(deflated) < len(payload):
+                return {"bytes_data": bytes((DEFLATED,)) + deflated}
+
+        return {"bytes_data": bytes((RAW,)) + payload}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return JsonCodec().decode(text_data)
+
+        if not bytes_data:
+            raise CodecError("Empty frame")
+
+        flag, payload = bytes_data[0], bytes_data[1:]
+        if flag not in (RAW, DEFLATED):
+            raise CodecError("Unknown frame flag")
+
+        if flag == DEFLATED:
+            inflater = zlib.decompressobj()
+            try:
+                payload = inflater.decompress(payload, MAX_INFLATED_SIZE)
+            except zlib.error:
+                raise CodecError("Invalid frame")
+            if inflater.unconsumed_tail:
+                raise CodecError("Frame too large")
+
+        try:
+            return expand(msgpack.unpackb(payload, raw=False, strict_map_key=False))
+        except ValueError:
+            raise CodecError("Invalid frame")
+
+
+def compact(value, key=None):
+    if key in OPAQUE_FIELDS:
+        return value
+    if isinstance(value, dict):
+        return {FIELD_IDS.get(k, k): compact(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    if key == "type" and value in TYPE_IDS:
+        return TYPE_IDS[value]
+    if key in TIMESTAMP_FIELDS and isinstance(value, str):
+        try:
+            return int(datetime.fromisoformat(value).timestamp() * 1000)
+        except ValueError:
+            # not ISO 8601: the client gets the string
+            return value
+    return value
+
+
+def expand(value, key=None):
+    if key in OPAQUE_FIELDS:
+        return value
+    if isinstance(value, dict):
+        expanded = {}
+        for k, v in value.items():
+            name = FIELD_NAMES.get(k, k)
+            expanded[name] = expand(v, name)
+        return expanded
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    if key == "type" and isinstance(value, int):
+        return TYPE_NAMES.get(value, value)
+    return value
+
+
+def negotiate(subprotocols):
+    """Pick the codec for a connection from the client's offered subprotocols"""
+    if msgpack is not None and COMPACT_SUBPROTOCOL in subprotocols:
+        return CompactCodec(**getattr(settings, "REALTIME_COMPACT_CODEC", {}))
+    return JsonCodec()
@@ -1,13 +1,36 @@
-import json
+import asyncio
+import time
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .models import Message
+from accounts.profiling import Profile, get_profiling_settings
+from accounts.snapshots import user_snapshots
+from attachments.models import Attachment
+from .broadcast import BROADCAST_GROUP, audience_of
+from .codecs import CodecError, negotiate
+from .ephemeral import EPHEMERAL_EVENTS, EXPIRES_TO, coalescer, get_ephemeral_settings
+from .heartbeat import heartbeats
+from .history import conversation_history
+from .idempotency import recent_sends, send_key
+from .models import Message, RoomMembership, RoomMessage
+from .outbound import EPHEMERAL, KEEP, LANE_CHAT, LANE_EVENTS, LANE_PRESENCE, OutboundQueue
+from .serializers import MessageSerializer
+from .sharding import message_ids, set_prefetched_attachments, shard_for
+from .throttling import FrameThrottle, check_throttles, get_throttle_rates, user_throttles
 
 User = get_user_model()
 
+# close code sent to clients that fall too far behind on reading
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# close code sent to connections that stopped answering pings
+HEARTBEAT_TIMEOUT_CLOSE_CODE = 4009
+# close code (internal error) when writing to the socket failed; clients reconnect
+WRITE_FAILED_CLOSE_CODE = 1011
+
 
 class RealtimeConsumer(AsyncWebsocketConsumer):
     """
@@ -16,6 +39,7 @@ class RealtimeConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
         """Called when WebSocket connection is established"""
+        # a SessionUser (accounts/session.py), not a User: it's kept for the life of the socket
         self.user = self.scope["user"]
 
         if self.user.is_anonymous:
@@ -24,169 +48,445 @@ class RealtimeConsumer(AsyncWebsocketConsumer):
 
         self.user_channel = f"user_{self.user.id}"
 
+        self.connection_throttle = FrameThrottle(get_throttle_rates("connection"))
+        self.user_throttle = user_throttles.acquire(self.user.id, get_throttle_rates("user"))
+        self.outbound = OutboundQueue(**getattr(settings, "REALTIME_OUTBOUND_QUEUE", {}))
+        self.closing = False
+        self.cleaned_up = False
+        # set by profiling_handler: profile every frame this connection handles
+        self.profiling = False
+        # sender id -> timer that tells the client their typing/viewing event expired
+        self.ephemeral_timers = {}
+
+        # JSON text frames unless the client offers the compact binary subprotocol
+        self.codec = negotiate(self.scope.get("subprotocols", []))
+
         await self.channel_layer.group_add(self.user_channel, self.channel_name)
-        await self.accept()
+        await self.channel_layer.group_add(BROADCAST_GROUP, self.channel_name)
+
+        # one group per room, so a room message is a single group_send however many members it has
+        self.room_ids = await self.get_room_ids()
+        await asyncio.gather(*(self.channel_layer.group_add(f"room_{room_id}", self.channel_name) for room_id in self.room_ids))
+
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.writer = asyncio.ensure_future(self.drain_outbound())
+        heartbeats.register(self)
 
         # set user as online and broadcast to friends
         await self.set_user_online(True)
         await self.broadcast_online_status(True)
 
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "connection",
-                    "status": "connected",
-                    "is_online": True,
-                    "timestamp": timezone.now().isoformat(),
-                }
-            )
+        await self.send_frame(
+            {
+                "type": "connection",
+                "status": "connected",
+                "is_online": True,
+                "timestamp": timezone.now().isoformat(),
+            }
         )
         print(f"✅ {self.user.username} connected to realtime channel")
 
     async def disconnect(self, close_code):
         """Called when WebSocket connection is closed"""
+        await self.cleanup()
+
+    async def reap(self):
+        """Called by the heartbeat monitor when the client stopped answering pings"""
+        print(f"🧟 {self.user.username} stopped answering pings, closing")
+        await self.cleanup()
+        self.closing = True
+        await self.close(code=HEARTBEAT_TIMEOUT_CLOSE_CODE)
+
+    async def cleanup(self):
+        """
+        Leave groups and go offline, once: a reaped connection still gets its
+        disconnect() whenever the server notices the socket is gone.
+        """
+        if getattr(self, "cleaned_up", True):
+            return
+        self.cleaned_up = True
+
+        last_connection = heartbeats.unregister(self)
+
         if hasattr(self, "user_channel"):
             await self.channel_layer.group_discard(self.user_channel, self.channel_name)
+            await self.channel_layer.group_discard(BROADCAST_GROUP, self.channel_name)
+            user_throttles.release(self.user.id)
+
+        if room_ids := getattr(self, "room_ids", None):
+            await asyncio.gather(*(self.channel_layer.group_discard(f"room_{room_id}", self.channel_name) for room_id in room_ids))
+
+        if hasattr(self, "writer"):
+            self.writer.cancel()
 
-        if not self.user.is_anonymous:
+        for timer in getattr(self, "ephemeral_timers", {}).values():
+            timer.cancel()
+
+        # the user's other connections on this worker keep them online
+        if last_connection:
             await self.set_user_online(False)
             await self.broadcast_online_status(False)
-            print(f"❌ {self.user.username} disconnected from realtime channel")
+        print(f"❌ {self.user.username} disconnected from realtime channel")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        heartbeats.heard_from(self)
 
-    async def receive(self, text_data):
-        """Route different message types"""
+        if self.profiling:
+            await self.receive_profiled(text_data, bytes_data)
+        else:
+            await self.handle_frame(text_data, bytes_data)
+
+    async def receive_profiled(self, text_data, bytes_data):
+        profile = Profile(f"websocket frame from {self.user.username}", self.user.id)
+        if not profile.start():
+            await self.handle_frame(text_data, bytes_data)
+            return
 
         try:
-            data = json.loads(text_data)
+            message_type = await self.handle_frame(text_data, bytes_data)
+        finally:
+            profile.label = f"websocket {message_type} frame from {self.user.username}"
+            profile_id = profile.stop()
+        await self.send_frame({"type": "profile", "profile_id": profile_id, "event": message_type})
+
+    async def handle_frame(self, text_data, bytes_data):
+        """Route different message types; returns the frame's type"""
+        message_type = None
+
+        try:
+            data = self.codec.decode(text_data, bytes_data)
             message_type = data.get("type")
 
+            # heartbeat frames are never throttled; any frame already counted as one
+            if message_type == "ping":
+                await self.send_frame({"type": "pong"})
+                return message_type
+            if message_type == "pong":
+                return message_type
+
+            retry_after = check_throttles(message_type, self.connection_throttle, self.user_throttle)
+            if retry_after and message_type in EPHEMERAL_EVENTS:
+                return message_type
+            if retry_after:
+                await self.send_frame(
+                    {
+                        "type": "error",
+                        "code": "throttled",
+                        "message": f"Too many {message_type} frames",
+                        "retry_after": round(retry_after, 3),
+                        "temp_id": data.get("temp_id"),
+                    }
+                )
+                return message_type
+
             if message_type == "chat_message":
                 await self.handle_chat_message(data)
+            elif message_type == "room_message":
+                await self.handle_room_message(data)
+            elif message_type in EPHEMERAL_EVENTS:
+                await self.handle_ephemeral(data)
             # add more client-sent message types here if needed
             else:
-                await self.send(text_data=json.dumps({"type": "error", "message": f"Unknown message type: {message_type}"}))
+                await self.send_frame({"type": "error", "message": f"Unknown message type: {message_type}"})
 
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({"type": "error", "message": "Invalid JSON"}))
+        except CodecError as e:
+            await self.send_frame({"type": "error", "message": str(e)})
         except Exception as e:
-            await self.send(text_data=json.dumps({"type": "error", "message": str(e)}))
+            await self.send_frame({"type": "error", "message": str(e)})
+
+        return message_type
 
     async def handle_chat_message(self, data):
         message_text = data.get("message", "").strip()
         recipient_id = data.get("recipient_id")
         temp_id = data.get("temp_id")
+        attachment_ids = data.get("attachment_ids") or []
 
-        if not message_text:
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "error",
-                        "message": "Message cannot be empty",
-                        "temp_id": temp_id,
-                    }
-                )
+        # a retry of a send this worker already handled: same ack, nothing stored or delivered
+        key = send_key(temp_id)
+        if key is not None and (ack := recent_sends.get(self.user.id, recipient_id, key)) is not None:
+            await self.send_frame({**ack, "temp_id": temp_id})
+            return
+
+        if not message_text and not attachment_ids:
+            await self.send_frame(
+                {
+                    "type": "error",
+                    "message": "Message cannot be empty",
+                    "temp_id": temp_id,
+                }
             )
             return
 
         if not recipient_id:
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "error",
-                        "message": "Recipient ID required",
-                        "temp_id": temp_id,
-                    }
-                )
+            await self.send_frame(
+                {
+                    "type": "error",
+                    "message": "Recipient ID required",
+                    "temp_id": temp_id,
+                }
             )
             return
 
+        attachments = await self.get_own_attachments(attachment_ids)
+        if attachments is None:
+            await self.send_frame({"type": "error", "message": "Attachment not found", "temp_id": temp_id})
+            return
+
         # check if recipient exists and is friend with sender
         recipient = await self.get_user(recipient_id)
         if not recipient:
             if not message_text:
-                await self.send(
-                    text_data=json.dumps(
-                        {
-                            "type": "error",
-                            "message": "Recipient not found",
-                            "temp_id": temp_id,
-                        }
-                    )
+                await self.send_frame(
+                    {
+                        "type": "error",
+                        "message": "Recipient not found",
+                        "temp_id": temp_id,
+                    }
                 )
                 return
 
         # save message to database
-        message = await self.save_message(sender=self.user, recipient=recipient, message_text=message_text)
+        message, created = await self.save_message(
+            sender_id=self.user.id, recipient=recipient, message_text=message_text, attachments=attachments, temp_id=key
+        )
+        ack = {"type": "message_sent", "id": message.id, "timestamp": message.timestamp.isoformat()}
+        if key is not None:
+            recent_sends.add(self.user.id, recipient_id, key, ack)
+
+        if not created:
+            # stored by an earlier attempt, which also delivered it
+            await self.send_frame({**ack, "temp_id": temp_id})
+            return
 
         message_data = {
             "type": "chat_message",
             "id": message.id,
             "message": message.message,
-            "sender": {
-                "id": self.user.id,
-                "username": self.user.username,
-                "profile_picture": self.user.profile_picture,
-            },
+            "sender": await user_snapshots.aget(self.user.id),
             "recipient_id": recipient.id,
             "timestamp": message.timestamp.isoformat(),
             "is_read": False,
             "temp_id": temp_id,
+            "attachments": [
+                {
+                    "id": attachment.id,
+                    "filename": attachment.filename,
+                    "content_type": attachment.content_type,
+                    "size": attachment.size,
+                }
+                for attachment in attachments
+            ],
         }
 
         # send confirmation to sender
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "message_sent",
-                    "id": message.id,
-                    "timestamp": message.timestamp.isoformat(),
-                    "temp_id": temp_id,
-                }
-            )
-        )
+        await self.send_frame({**ack, "temp_id": temp_id})
 
         # send message to recipient (if they're online)
         await self.channel_layer.group_send(f"user_{recipient.id}", {"type": "chat_message_handler", "data": message_data})
 
         print(f"📨 {self.user.username} → {recipient.username}: {message_text[:30]}")
 
+    async def handle_room_message(self, data):
+        message_text = data.get("message", "").strip()
+        room_id = data.get("room_id")
+        temp_id = data.get("temp_id")
+
+        if not message_text:
+            await self.send_frame({"type": "error", "message": "Message cannot be empty", "temp_id": temp_id})
+            return
+
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            room_id = None
+
+        if room_id not in self.room_ids:
+            await self.send_frame({"type": "error", "message": "Room not found", "temp_id": temp_id})
+            return
+
+        message = await self.save_room_message(room_id=room_id, message_text=message_text)
+        timestamp = message.timestamp.isoformat()
+
+        await self.send_frame({"type": "message_sent", "id": message.id, "room_id": room_id, "timestamp": timestamp, "temp_id": temp_id})
+
+        # one publish for the whole room; the sending connection already has its ack
+        await self.channel_layer.group_send(
+            f"room_{room_id}",
+            {
+                "type": "room_message_handler",
+                "origin": self.channel_name,
+                "data": {
+                    "type": "room_message",
+                    "id": message.id,
+                    "room_id": room_id,
+                    "message": message.message,
+                    "sender": await user_snapshots.aget(self.user.id),
+                    "timestamp": timestamp,
+                    "temp_id": temp_id,
+                },
+            },
+        )
+
+    async def handle_ephemeral(self, data):
+        """Relay typing/viewing events to the recipient without touching the DB"""
+        event = data["type"]
+        recipient_id = data.get("recipient_id")
+
+        if not recipient_id:
+            await self.send_frame({"type": "error", "message": "Recipient ID required"})
+            return
+
+        if not coalescer.should_send(self.user.id, recipient_id, event):
+            return
+
+        await self.channel_layer.group_send(
+            f"user_{recipient_id}",
+            {
+                "type": "ephemeral_handler",
+                "event": event,
+                "user_id": self.user.id,
+                "expires_at": time.time() + get_ephemeral_settings()["ttl"],
+            },
+        )
+
     # ==================== HANDLERS (called by channel_layer.group_send) ====================
 
     async def chat_message_handler(self, event):
         """Handler for sending chat messages to WebSocket"""
         message_data = event["data"]
-        await self.send(text_data=json.dumps(message_data))
+        await self.send_frame(message_data)
+
+    async def room_message_handler(self, event):
+        """Handler for messages published to a room this connection is in"""
+        if event["origin"] != self.channel_name:
+            await self.send_frame(event["data"])
+
+    async def room_joined_handler(self, event):
+        """Handler for being added to a room: start receiving its messages"""
+        room_id = event["room_id"]
+        if room_id not in self.room_ids:
+            self.room_ids.add(room_id)
+            await self.channel_layer.group_add(f"room_{room_id}", self.channel_name)
+        await self.send_frame({"type": "room_joined", "room_id": room_id})
+
+    async def room_left_handler(self, event):
+        """Handler for leaving a room"""
+        room_id = event["room_id"]
+        if room_id in self.room_ids:
+            self.room_ids.discard(room_id)
+            await self.channel_layer.group_discard(f"room_{room_id}", self.channel_name)
+        await self.send_frame({"type": "room_left", "room_id": room_id})
 
     async def friend_request_handler(self, event):
         """Handler for friend request notifications"""
-        request_data = event["data"]
+        request_data = with_outbox_id(event)
         print(f"Friend request sent: {request_data}")
-        await self.send(text_data=json.dumps(request_data))
+        await self.send_frame(request_data, lane=LANE_EVENTS)
 
     async def friend_request_accepted_handler(self, event):
         """Handler for accepted friend request notifications"""
-        request_data = event["data"]
+        request_data = with_outbox_id(event)
         print(f"Friend request accepted: {request_data}")
-        await self.send(text_data=json.dumps(request_data))
+        await self.send_frame(request_data, lane=LANE_EVENTS)
 
     async def friend_request_rejected_handler(self, event):
         """Handler for rejected friend request notifications"""
-        request_data = event["data"]
-        await self.send(text_data=json.dumps(request_data))
+        request_data = with_outbox_id(event)
+        await self.send_frame(request_data, lane=LANE_EVENTS)
+
+    async def profiling_handler(self, event):
+        """Handler for an admin turning profiling of this user's frames on or off"""
+        self.profiling = event["enabled"] and get_profiling_settings()["enabled"]
+
+    async def broadcast_handler(self, event):
+        """A system-wide notice (maintenance, feature flags) for the connections in its audience"""
+        if audience_of(event).includes(self.user.id):
+            await self.send_frame(event["data"], lane=LANE_EVENTS)
 
     async def user_status_handler(self, event):
         """Handler for online status broadcasts from other users"""
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "user_status",
-                    "user_id": event["user_id"],
-                    "is_online": event["is_online"],
-                    "timestamp": event["timestamp"],
-                }
-            )
+        await self.send_frame(
+            {
+                "type": "user_status",
+                "user_id": event["user_id"],
+                "is_online": event["is_online"],
+                "timestamp": event["timestamp"],
+            },
+            lane=LANE_PRESENCE,
         )
 
+    async def ephemeral_handler(self, event):
+        """Handler for typing/viewing events, expired server-side if not refreshed"""
+        remaining = event["expires_at"] - time.time()
+        if remaining <= 0:
+            return
+
+        sender_id = event["user_id"]
+        if timer := self.ephemeral_timers.pop(sender_id, None):
+            timer.cancel()
+
+        if expired_event := EXPIRES_TO.get(event["event"]):
+            self.ephemeral_timers[sender_id] = asyncio.get_running_loop().call_later(
+                remaining, lambda: asyncio.ensure_future(self.expire_ephemeral(sender_id, expired_event))
+            )
+
+        await self.send_frame({"type": event["event"], "user_id": sender_id}, shed=EPHEMERAL)
+
+    async def expire_ephemeral(self, sender_id, expired_event):
+        self.ephemeral_timers.pop(sender_id, None)
+        await self.send_frame({"type": expired_event, "user_id": sender_id}, shed=EPHEMERAL)
+
+    # ==================== OUTBOUND ====================
+
+    async def send_frame(self, data, shed=KEEP, lane=LANE_CHAT):
+        """
+        Queue a frame for the client. Frames the client can do without (typing,
+        presence) carry a shed level and are dropped first when it falls behind.
+        Friend events and presence go in lower-priority lanes, see OutboundQueue.
+        """
+        if self.closing:
+            return
+
+        if not self.outbound.put(data, shed=shed, lane=lane):
+            self.closing = True
+            print(f"🐢 {self.user.username} is too slow ({len(self.outbound)} frames queued), closing")
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def drain_outbound(self):
+        """Writer task: the only place that writes to the websocket"""
+        while True:
+            data = await self.outbound.get()
+            if not await self.write_frame(data):
+                return
+
+            if dropped := self.outbound.take_dropped():
+                if not await self.write_frame({"type": "frames_dropped", "count": dropped}):
+                    return
+
+    async def write_frame(self, data):
+        """
+        Encode and send one frame. A frame that can't be encoded is dropped; if the
+        transport fails the socket is closed so the client reconnects, and this returns False.
+        """
+        try:
+            frame = self.codec.encode(data)
+        except Exception as e:
+            print(f"⚠️ Dropped a {data.get('type')} frame for {self.user.username} that could not be encoded: {e}")
+            return True
+
+        try:
+            await self.send(**frame)
+        except Exception as e:
+            print(f"⚠️ Writing to {self.user.username}'s socket failed, closing: {e}")
+            self.closing = True
+            try:
+                await self.close(code=WRITE_FAILED_CLOSE_CODE)
+            except Exception:
+                pass
+            return False
+        return True
+
     # ==================== DATABASE OPERATIONS ====================
 
     @database_sync_to_async
@@ -197,38 +497,84 @@ class RealtimeConsumer(AsyncWebsocketConsumer):
             return None
 
     @database_sync_to_async
-    def get_user_friends(self):
-        """Get list of user's friends"""
+    def get_friend_ids(self):
+        """Ids of the user's friends"""
         try:
             from friends.models import Friendship
 
-            friend_pairs = Friendship.objects.filter(Q(user1=self.user) | Q(user2=self.user)).values_list("user1_id", "user2_id")
+            friend_pairs = Friendship.objects.filter(Q(user1_id=self.user.id) | Q(user2_id=self.user.id)).values_list("user1_id", "user2_id")
             friend_ids = set()
             for user1, user2 in friend_pairs:
                 friend_ids.add(user1)
                 friend_ids.add(user2)
 
-            friends = list(User.objects.filter(id__in=friend_ids).exclude(id=self.user.id))
-            return friends
+            friend_ids.discard(self.user.id)
+            return friend_ids
         except Exception as e:
             print(f"Error fetching friends: {e}")
             return []
 
     @database_sync_to_async
-    def save_message(self, sender, recipient, message_text):
-        return Message.objects.create(sender=sender, recipient=recipient, message=message_text)
+    def get_own_attachments(self, attachment_ids):
+        """Attachments uploaded by this user, or None if any id is malformed or someone else's"""
+        if not attachment_ids:
+            return []
+        if not isinstance(attachment_ids, list) or not all(isinstance(i, int) for i in attachment_ids):
+            return None
+
+        attachments = list(Attachment.objects.filter(id__in=attachment_ids, owner_id=self.user.id))
+        if len(attachments) != len(set(attachment_ids)):
+            return None
+        return attachments
+
+    @database_sync_to_async
+    def save_message(self, sender_id, recipient, message_text, attachments=(), temp_id=None):
+        """(message, created); created is False when `temp_id` was already used in this conversation"""
+        shard = shard_for(sender_id, recipient.id)
+        # reserved outside the transaction, see IdAllocator
+        message_id = message_ids.next()
+        try:
+            with transaction.atomic(using=shard):
+                message = Message.objects.using(shard).create(
+                    id=message_id, sender_id=sender_id, recipient=recipient, message=message_text, temp_id=temp_id
+                )
+                if attachments:
+                    message.attachments.add(*attachments)
+        except IntegrityError:
+            if temp_id is None:
+                raise
+            return Message.objects.using(shard).get(sender_id=sender_id, recipient=recipient, temp_id=temp_id), False
+
+        set_prefetched_attachments(message, attachments)
+        conversation_history.append(message, MessageSerializer(message).data)
+        return message, True
+
+    @database_sync_to_async
+    def get_room_ids(self):
+        return set(RoomMembership.objects.filter(user_id=self.user.id).values_list("room_id", flat=True))
+
+    @database_sync_to_async
+    def save_room_message(self, room_id, message_text):
+        return RoomMessage.objects.create(room_id=room_id, sender_id=self.user.id, message=message_text)
 
     @database_sync_to_async
     def set_user_online(self, is_online):
+        # self.user is a SessionUser, see accounts/session.py
         self.user.last_seen = timezone.now()
-        self.user.is_online = is_online
-        self.user.save(update_fields=["is_online", "last_seen"])
+        User.objects.filter(id=self.user.id).update(is_online=is_online, last_seen=self.user.last_seen)
 
     async def broadcast_online_status(self, is_online):
         """Broadcast user's online status to all friends"""
-        friends = await self.get_user_friends()
+        friend_ids = await self.get_friend_ids()
 
         status_data = {"type": "user_status_handler", "user_id": self.user.id, "is_online": is_online, "timestamp": self.user.last_seen.isoformat()}
 
-        for friend in friends:
-            await self.channel_layer.group_send(f"user_{friend.id}", status_data)
+        for friend_id in friend_ids:
+            await self.channel_layer.group_send(f"user_{friend_id}", status_data)
+
+
+def with_outbox_id(event):
+    """The event's frame, plus the outbox id clients use to drop a redelivered notification"""
+    if "outbox_id" in event:
+        return {**event["data"], "outbox_id": event["outbox_id"]}
+    return event["data"]
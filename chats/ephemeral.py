@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+# client-sent events that are relayed to the recipient and never stored
+EPHEMERAL_EVENTS = {"typing", "stopped_typing", "viewing", "stopped_viewing"}
+
+# what the recipient is sent when an event isn't refreshed within its ttl
+EXPIRES_TO = {"typing": "stopped_typing", "viewing": "stopped_viewing"}
+
+
+def get_ephemeral_settings():
+    return {"min_interval": 3, "ttl": 6, "max_entries": 10000, **getattr(settings, "REALTIME_EPHEMERAL", {})}
+
+
+class EphemeralCoalescer:
+    """
+    Decides which ephemeral events from a sender to a recipient get published.
+
+    Repeats of the same event (a "typing" per keystroke) go out at most once per
+    `min_interval`; a change of event ("typing" -> "stopped_typing") always goes out.
+    Process-local and LRU-bounded to `max_entries` (sender, recipient) pairs.
+    """
+
+    def __init__(self, min_interval, max_entries):
+        self.min_interval = min_interval
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def should_send(self, sender_id, recipient_id, event):
+        key = (sender_id, recipient_id)
+        now = time.monotonic()
+
+        last = self.entries.get(key)
+        if last is not None and last[0] == event and now - last[1] < self.min_interval:
+            return False
+
+        self.entries[key] = (event, now)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return True
+
+
+_config = get_ephemeral_settings()
+coalescer = EphemeralCoalescer(_config["min_interval"], _config["max_entries"])
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from django.conf import settings
+
+
+def get_heartbeat_settings():
+    return {"interval": 25, "timeout": 60, "reap_batch": 500, **getattr(settings, "REALTIME_HEARTBEAT", {})}
+
+
+class HeartbeatMonitor:
+    """
+    Per-worker liveness of websocket connections.
+
+    Any frame from the client counts as a sign of life. Every `interval` seconds one
+    task per worker sends {"type": "ping"} to connections that have been quiet for an
+    interval (clients answer {"type": "pong"}) and reaps those quiet for `timeout`
+    seconds, `reap_batch` at a time, via consumer.reap(). Half-open connections
+    (a phone that lost its radio, a NAT entry that timed out) never send anything
+    again, so they are reaped instead of staying subscribed and online until the OS
+    gives up on the socket.
+
+    `reaped` and `pinged` count since the worker started.
+    """
+
+    def __init__(self, interval, timeout, reap_batch):
+        self.interval = interval
+        self.timeout = timeout
+        self.reap_batch = reap_batch
+        # consumer -> when it was last heard from (monotonic)
+        self.connections = {}
+        # user id -> live connections on this worker
+        self.user_connections = {}
+        self.task = None
+        self.reaped = 0
+        self.pinged = 0
+
+    def register(self, consumer):
+        self.connections[consumer] = time.monotonic()
+        self.user_connections[consumer.user.id] = self.user_connections.get(consumer.user.id, 0) + 1
+
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    def unregister(self, consumer):
+        """Forget a connection; True if it was its user's last one on this worker"""
+        if self.connections.pop(consumer, None) is None:
+            return False
+
+        user_id = consumer.user.id
+        self.user_connections[user_id] -= 1
+        if self.user_connections[user_id] > 0:
+            return False
+        del self.user_connections[user_id]
+        return True
+
+    def heard_from(self, consumer):
+        if consumer in self.connections:
+            self.connections[consumer] = time.monotonic()
+
+    async def run(self):
+        while self.connections:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"⚠️ Heartbeat sweep failed: {e}")
+        self.task = None
+
+    async def sweep(self):
+        now = time.monotonic()
+        quiet, stale = [], []
+        for consumer, heard_at in self.connections.items():
+            if now - heard_at >= self.timeout:
+                stale.append(consumer)
+            elif now - heard_at >= self.interval:
+                quiet.append(consumer)
+
+        for consumer in quiet:
+            await consumer.send_frame({"type": "ping"})
+        self.pinged += len(quiet)
+
+        for start in range(0, len(stale), self.reap_batch):
+            batch = stale[start : start + self.reap_batch]
+            self.reaped += len(batch)
+            await asyncio.gather(*(consumer.reap() for consumer in batch), return_exceptions=True)
+
+        if stale:
+            print(f"🧟 Reaped {len(stale)} unresponsive connections ({self.reaped} since start, {len(self.connections)} live)")
+
+
+_config = get_heartbeat_settings()
+heartbeats = HeartbeatMonitor(_config["interval"], _config["timeout"], _config["reap_batch"])
@@ -0,0 +1,188 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .sharding import conversation_key
+
+# messages in the first page of chat history, and what each cached conversation holds
+PAGE_SIZE = 50
+
+
+def get_history_settings():
+    return {
+        "cache": "default",
+        "max_conversations": 10000,
+        "version_ttl": 86400,
+        "report_every": 1000,
+        **getattr(settings, "CHAT_HISTORY_CACHE", {}),
+    }
+
+
+def with_senders(rows, snapshots):
+    """Serialized messages from cached rows, with the current snapshot of each sender"""
+    return [dict(data, sender=snapshots.get(sender_id, data["sender"])) for sender_id, data in rows]
+
+
+class ConversationHistoryCache:
+    """
+    The newest PAGE_SIZE messages of recently opened conversations, serialized, kept in
+    a process-local ring per conversation (LRU over `max_conversations`). A hit serves
+    the first page of chat_history without touching the database; sender snapshots are
+    looked up at serve time so renames show up as they do elsewhere.
+
+    Every conversation has a version in the shared cache (started from the clock, so a
+    version that expired is never reused) and every change bumps it: a stored message or
+    messages marked read. A ring is only served while its version matches the shared one,
+    so each lookup costs one cache GET and a change made through another worker is a miss
+    here, not a stale page. The worker making a change applies it to its own ring (append,
+    read flags) when its ring was at the version just before, and drops the ring otherwise.
+
+    Without the shared cache nothing can be validated: lookups miss and rings are dropped.
+    """
+
+    def __init__(self, cache="default", max_conversations=10000, version_ttl=86400, report_every=1000):
+        self.cache_alias = cache
+        self.max_conversations = max_conversations
+        self.version_ttl = version_ttl
+        self.report_every = report_every
+        # conversation key -> (version, deque of (sender_id, serialized message), oldest first)
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def key(conversation):
+        return f"chat_history_version:{conversation}"
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, user_id, friend_id):
+        """
+        (rows, version): the cached rows of the conversation, or None on a miss. Pass
+        `version` to store() along with what was loaded instead.
+        """
+        conversation = conversation_key(user_id, friend_id)
+        try:
+            version = self.current_version(conversation)
+        except Exception as e:
+            print(f"⚠️ Chat history cache unavailable: {e}")
+            version = None
+        return self.lookup(conversation, version), version
+
+    async def aget(self, user_id, friend_id):
+        conversation = conversation_key(user_id, friend_id)
+        try:
+            version = await self.shared.aget(self.key(conversation))
+            if version is None:
+                version = await self.astart_version(conversation)
+        except Exception as e:
+            print(f"⚠️ Chat history cache unavailable: {e}")
+            version = None
+        return self.lookup(conversation, version), version
+
+    def lookup(self, conversation, version):
+        rows = None
+        with self.lock:
+            entry = self.local.get(conversation)
+            if entry is not None and version is not None and entry[0] == version:
+                self.local.move_to_end(conversation)
+                rows = list(entry[1])
+            self.hits += rows is not None
+            self.misses += rows is None
+            lookups = self.hits + self.misses
+
+        if self.report_every and lookups % self.report_every == 0:
+            print(f"📚 Chat history cache: {self.hit_rate():.1%} hits over {lookups} lookups, {len(self.local)} conversations")
+        return rows
+
+    def store(self, user_id, friend_id, version, messages, serialized):
+        """Keep the first page loaded from the database under the version get() returned"""
+        if version is None:
+            return
+        rows = deque(((message.sender_id, dict(data)) for message, data in zip(messages, serialized)), maxlen=PAGE_SIZE)
+        conversation = conversation_key(user_id, friend_id)
+        with self.lock:
+            entry = self.local.get(conversation)
+            # a ring that already moved past this version is newer than what was loaded
+            if entry is not None and entry[0] > version:
+                return
+            self.local[conversation] = (version, rows)
+            self.local.move_to_end(conversation)
+            while len(self.local) > self.max_conversations:
+                self.local.popitem(last=False)
+
+    def append(self, message, serialized):
+        """Call once a new message is committed"""
+
+        def apply(rows):
+            # a page loaded between the commit and this call already holds the message
+            if not any(data["id"] == message.id for _, data in rows):
+                rows.append((message.sender_id, dict(serialized)))
+
+        self.change(message.sender_id, message.recipient_id, apply)
+
+    def mark_read(self, user_id, friend_id):
+        """Call once the messages from friend_id to user_id are marked read"""
+
+        def apply(rows):
+            for index, (sender_id, data) in enumerate(rows):
+                if sender_id == friend_id and not data["is_read"]:
+                    rows[index] = (sender_id, dict(data, is_read=True))
+
+        self.change(user_id, friend_id, apply)
+
+    def invalidate(self, user_id, friend_id):
+        self.change(user_id, friend_id, None)
+
+    def change(self, user_id, friend_id, apply):
+        conversation = conversation_key(user_id, friend_id)
+        try:
+            version = self.bump(conversation)
+        except Exception as e:
+            print(f"⚠️ Could not bump chat history version of {conversation}: {e}")
+            version = None
+
+        with self.lock:
+            entry = self.local.pop(conversation, None)
+            if entry is not None and apply is not None and version is not None and entry[0] == version - 1:
+                apply(entry[1])
+                self.local[conversation] = (version, entry[1])
+
+    def current_version(self, conversation):
+        version = self.shared.get(self.key(conversation))
+        if version is None:
+            version = self.start_version(conversation)
+        return version
+
+    def start_version(self, conversation):
+        version = time.time_ns()
+        if self.shared.add(self.key(conversation), version, self.version_ttl):
+            return version
+        return self.shared.get(self.key(conversation))
+
+    async def astart_version(self, conversation):
+        version = time.time_ns()
+        if await self.shared.aadd(self.key(conversation), version, self.version_ttl):
+            return version
+        return await self.shared.aget(self.key(conversation))
+
+    def bump(self, conversation):
+        try:
+            return self.shared.incr(self.key(conversation))
+        except ValueError:
+            # no version yet, or it expired
+            self.start_version(conversation)
+            return self.shared.incr(self.key(conversation))
+
+
+conversation_history = ConversationHistoryCache(**get_history_settings())
@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+# longest temp_id stored on a Message; longer ones are sent without idempotency
+TEMP_ID_MAX_LENGTH = 64
+
+
+def get_idempotency_settings():
+    return {"ttl": 300, "max_entries": 50000, **getattr(settings, "REALTIME_IDEMPOTENCY", {})}
+
+
+def send_key(temp_id):
+    """The temp_id as stored on Message, or None when it can't key a send"""
+    if isinstance(temp_id, bool) or not isinstance(temp_id, (str, int)):
+        return None
+    key = str(temp_id)
+    return key if 0 < len(key) <= TEMP_ID_MAX_LENGTH else None
+
+
+class RecentSends:
+    """
+    (sender_id, recipient_id, temp_id) -> the message_sent ack of messages sent through this worker.
+
+    A client that lost its connection before the ack arrived retries with the same
+    temp_id; a hit here answers with the original ack without touching the database
+    or the channel layer. Entries live `ttl` seconds and at most `max_entries` are
+    kept (LRU). Retries this map can't see (another worker, an evicted entry) are
+    caught by the unique (sender, recipient, temp_id) constraint on Message.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.replayed = 0
+
+    def get(self, sender_id, recipient_id, temp_id):
+        key = (sender_id, str(recipient_id), temp_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        self.replayed += 1
+        return entry[0]
+
+    def add(self, sender_id, recipient_id, temp_id, ack):
+        key = (sender_id, str(recipient_id), temp_id)
+        self.entries[key] = (ack, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+recent_sends = RecentSends(**get_idempotency_settings())
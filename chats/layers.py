@@ -0,0 +1,317 @@
+import asyncio
+import bisect
+import hashlib
+import time
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+
+# same script channels_redis runs per shard in group_send()
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class HashRing:
+    """
+    Consistent hash ring (with virtual nodes) mapping names to shard indexes.
+    Adding or removing a host only moves the keys that land on its points.
+    """
+
+    def __init__(self, hosts, virtual_nodes=64):
+        points = []
+        for index, host in enumerate(hosts):
+            name = host.get("address", repr(sorted(host.items()))) if isinstance(host, dict) else repr(host)
+            for replica in range(virtual_nodes):
+                points.append((self.hash(f"{name}#{replica}"), index))
+        points.sort()
+        self.points = [point for point, _ in points]
+        self.indexes = [index for _, index in points]
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+    def get(self, value):
+        position = bisect.bisect(self.points, self.hash(value)) % len(self.points)
+        return self.indexes[position]
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that delivers to channels living in this process directly.
+
+    Group membership is still stored in Redis so other workers can reach our channels,
+    but group_send() hands messages for local members straight to their receive buffers
+    (no serialize, publish, BZPOPMIN and backup cleanup) from an index of this process's
+    memberships, and only runs the Redis delivery script for members owned by other
+    workers. The other workers' members of a group are read from Redis on every send;
+    a positive `membership_ttl` reuses that list for as long, so sends to a group with
+    none skip Redis, but a channel joining on another worker (a reconnect) then misses up
+    to that long of the group's messages. Only set it for groups that can tolerate that:
+    it can be a {group name prefix: seconds} dict, the longest matching prefix applying.
+
+    With `hash_ring`, groups and process channels are placed on hosts with a consistent
+    hash ring instead of channels_redis' crc32 modulo the host count, so adding a host only
+    moves the groups that land on it. The two place keys differently: switch only while
+    no worker of the other kind is running, or their groups won't meet.
+
+    Local channels are fed by one router task per process channel rather than the upstream
+    receive-lock hand-off, where the lock holder sits in BZPOPMIN and would not notice a
+    message delivered to its own buffer in-process.
+
+    Broadcast groups (every connection joins them) are joined once per process rather
+    than once per channel: Redis only lists one channel per worker, and a group_send()
+    reaching a worker is handed to each of its local members in-process. A broadcast to
+    every connected client is one Redis message per worker, whatever the member count.
+
+    The process's listing in a broadcast group is refreshed every group_expiry / 2 while it
+    has local members, so it doesn't expire on a worker that stops getting new connections.
+
+    Extra CONFIG options:
+    - hash_ring: place keys with a consistent hash ring (default False: channels_redis' crc32)
+    - virtual_nodes: ring points per host (default 64)
+    - broadcast_groups: groups joined per process (default ["broadcast"])
+    - membership_ttl: seconds a group's remote member list is reused, or {group prefix: seconds}
+      (default 0: read every send)
+    """
+
+    # remote member lists kept before expired ones are dropped
+    MAX_CACHED_GROUPS = 10000
+
+    def __init__(self, *args, hash_ring=False, virtual_nodes=64, broadcast_groups=("broadcast",), membership_ttl=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = HashRing(self.hosts, virtual_nodes) if hash_ring else None
+        self.broadcast_groups = set(broadcast_groups)
+        # broadcast group -> task keeping this process listed in it
+        self.broadcast_refreshers = {}
+        self.membership_ttl = membership_ttl
+        # group name -> (monotonic time read, channels of other processes in that group)
+        self.remote_members = {}
+        # group name -> channels of this process in that group
+        self.local_groups = defaultdict(set)
+        # process channel ("specific.<client_prefix>!") -> task moving its Redis messages into buffers
+        self.routers = {}
+        self.local_deliveries = 0
+        self.remote_deliveries = 0
+
+    def consistent_hash(self, value):
+        if self.ring is None:
+            return super().consistent_hash(value)
+        return self.ring.get(value)
+
+    def is_local(self, channel):
+        return "!" in channel and self.non_local_name(channel).endswith(self.client_prefix + "!")
+
+    def deliver_local(self, channel, message):
+        # BoundedQueue drops the oldest message when a channel is over capacity,
+        # same as messages routed in from Redis
+        self.receive_buffer[channel].put_nowait(dict(message))
+        self.local_deliveries += 1
+
+    def broadcast_channel(self, group):
+        """The channel this process is listed under in a broadcast group"""
+        return f"specific.{self.client_prefix}!group.{group}"
+
+    def deliver_broadcast(self, channel, message):
+        """Hand a broadcast that reached this process to the group's local members, or return False"""
+        group = channel.partition("!group.")[2]
+        if group not in self.broadcast_groups or channel != self.broadcast_channel(group):
+            return False
+        for member in self.local_group_channels(group):
+            self.deliver_local(member, message)
+        return True
+
+    ### Channel layer API ###
+
+    async def send(self, channel, message):
+        if not self.is_local(channel):
+            return await super().send(channel, message)
+
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.require_valid_channel_name(channel), "Channel name not valid"
+        if self.receive_buffer[channel].qsize() >= self.get_capacity(channel):
+            raise ChannelFull()
+        self.deliver_local(channel, message)
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+
+        assert self.require_valid_channel_name(channel)
+        self.ensure_router(self.non_local_name(channel))
+
+        buffer = self.receive_buffer[channel]
+        try:
+            return await buffer.get()
+        finally:
+            if buffer.empty() and self.receive_buffer.get(channel) is buffer:
+                del self.receive_buffer[channel]
+
+    def ensure_router(self, real_channel):
+        loop = asyncio.get_running_loop()
+        router = self.routers.get(real_channel)
+        if router is None or router.done() or router.get_loop() is not loop:
+            self.routers[real_channel] = loop.create_task(self.route(real_channel))
+
+    async def route(self, real_channel):
+        """Move messages for this process from Redis into the per-channel receive buffers"""
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error receiving from {real_channel}: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for channel in message_channel if isinstance(message_channel, list) else [message_channel]:
+                if not self.deliver_broadcast(channel, message):
+                    self.receive_buffer[channel].put_nowait(message)
+
+    async def close_pools(self):
+        for task in (*self.routers.values(), *self.broadcast_refreshers.values()):
+            task.cancel()
+        self.routers.clear()
+        self.broadcast_refreshers.clear()
+        await super().close_pools()
+
+    ### Groups extension ###
+
+    async def group_add(self, group, channel):
+        if group in self.broadcast_groups and self.is_local(channel):
+            self.local_groups[group].add(channel)
+            await self.join_broadcast(group)
+            return
+
+        await super().group_add(group, channel)
+        if self.is_local(channel):
+            self.local_groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        if group not in self.broadcast_groups or not self.is_local(channel):
+            await super().group_discard(group, channel)
+        channels = self.local_groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.local_groups[group]
+                if group in self.broadcast_groups:
+                    await self.leave_broadcast(group)
+
+    async def join_broadcast(self, group):
+        refresher = self.broadcast_refreshers.get(group)
+        if refresher is not None and not refresher.done() and refresher.get_loop() is asyncio.get_running_loop():
+            return
+        self.broadcast_refreshers[group] = asyncio.get_running_loop().create_task(self.refresh_broadcast(group))
+        await super().group_add(group, self.broadcast_channel(group))
+
+    async def refresh_broadcast(self, group):
+        # memberships expire after group_expiry like any other
+        while True:
+            await asyncio.sleep(self.group_expiry / 2)
+            try:
+                await super().group_add(group, self.broadcast_channel(group))
+            except Exception as e:
+                print(f"⚠️ Could not refresh broadcast group {group}: {e}")
+
+    async def leave_broadcast(self, group):
+        refresher = self.broadcast_refreshers.pop(group, None)
+        if refresher is not None:
+            refresher.cancel()
+        await super().group_discard(group, self.broadcast_channel(group))
+        # a member that arrived while Redis was answering must not be left out
+        if self.local_groups.get(group):
+            await self.join_broadcast(group)
+
+    def membership_ttl_for(self, group):
+        if not isinstance(self.membership_ttl, dict):
+            return self.membership_ttl
+        prefixes = [prefix for prefix in self.membership_ttl if group.startswith(prefix)]
+        return self.membership_ttl[max(prefixes, key=len)] if prefixes else 0
+
+    def local_group_channels(self, group):
+        return set(self.local_groups.get(group, ()))
+
+    async def remote_group_channels(self, group):
+        """Members of the group owned by other processes, read from Redis at most every membership_ttl"""
+        now = time.monotonic()
+        ttl = self.membership_ttl_for(group)
+        cached = self.remote_members.get(group)
+        if cached is not None and now - cached[0] < ttl:
+            return cached[1]
+
+        key = self._group_key(group)
+        pipe = self.connection(self.consistent_hash(group)).pipeline()
+        # Discard old channels based on group_expiry
+        pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+        pipe.zrange(key, 0, -1)
+        _, members = await pipe.execute()
+        # our own listings, the broadcast one included, are covered by local_groups
+        remote = [channel for channel in (x.decode("utf8") for x in members) if not self.is_local(channel)]
+
+        if ttl > 0:
+            if len(self.remote_members) >= self.MAX_CACHED_GROUPS:
+                self.remote_members = {
+                    name: entry for name, entry in self.remote_members.items() if now - entry[0] < self.membership_ttl_for(name)
+                }
+            self.remote_members[group] = (now, remote)
+        return remote
+
+    async def group_send(self, group, message):
+        """
+        Sends a message to the entire group, in-process for local members
+        """
+        assert self.require_valid_group_name(group), "Group name not valid"
+        for channel in self.local_group_channels(group):
+            self.deliver_local(channel, message)
+
+        remote_channels = await self.remote_group_channels(group)
+        if remote_channels:
+            await self.send_to_remote_channels(group, remote_channels, message)
+
+    async def send_to_remote_channels(self, group, channel_names, message):
+        """
+        The Redis half of RedisChannelLayer.group_send(), for an already resolved member list
+        """
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
+            connection = self.connection(connection_index)
+
+            # Discard old messages based on expiry
+            pipe = connection.pipeline()
+            for key in channel_redis_keys:
+                pipe.zremrangebyscore(key, min=0, max=int(time.time()) - int(self.expiry))
+            await pipe.execute()
+
+            args = [channel_keys_to_message[channel_key] for channel_key in channel_redis_keys]
+            args += [channel_keys_to_capacity[channel_key] for channel_key in channel_redis_keys]
+            args += [time.time(), self.expiry]
+
+            channels_over_capacity = await connection.eval(GROUP_SEND_LUA, len(channel_redis_keys), *channel_redis_keys, *args)
+            if channels_over_capacity > 0:
+                print(f"⚠️ {channels_over_capacity} of {len(channel_names)} channels over capacity in group {group}")
+
+        self.remote_deliveries += len(channel_names)
+
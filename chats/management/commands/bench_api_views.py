@@ -0,0 +1,156 @@
+import asyncio
+import statistics
+import time
+from functools import partial
+from types import ModuleType
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q
+from django.test import AsyncClient, override_settings
+from django.urls import path
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chats import async_views as chats_async
+from chats import views as chats_sync
+from chats.models import Message
+from chats.sharding import shard_for
+from friends import async_views as friends_async
+from friends.views import FriendshipListView
+
+User = get_user_model()
+
+# messages set back to unread before each timed mark-read request, so it has rows to update
+MARK_READ_SAMPLE = 50
+
+
+def urlconf():
+    """Both implementations side by side, whatever ASYNC_API_VIEWS says"""
+    patterns = []
+    for mode, chats, friends_list in (
+        ("sync", chats_sync, FriendshipListView.as_view()),
+        ("async", chats_async, friends_async.friends_list),
+    ):
+        patterns += [
+            path(f"{mode}/chat/recent/", chats.recent_chats),
+            path(f"{mode}/chat/<int:friend_id>/", chats.chat_history),
+            path(f"{mode}/chat/<int:friend_id>/mark-read/", chats.mark_messages_read),
+            path(f"{mode}/friends/", friends_list),
+        ]
+    module = ModuleType("bench_api_views_urls")
+    module.urlpatterns = patterns
+    return module
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure requests/s and latency of the chat and friends list endpoints under concurrent "
+        "requests, DRF sync views vs the async views, within one ASGI worker. Run it against "
+        "seeded data (manage.py seed_dataset)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="requests per endpoint and mode")
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--username", default=None, help="user to request as (default: the one with the most messages)")
+
+    def handle(self, *args, **options):
+        user = self.pick_user(options["username"])
+        friend_id = self.busiest_partner(user)
+        self.stdout.write(f"as {user.username}, history with user {friend_id}")
+
+        # (method, url, coroutine run before each timed request, outside the timing)
+        endpoints = {
+            "history": ("get", f"chat/{friend_id}/", None),
+            "recent": ("get", "chat/recent/", None),
+            "friends": ("get", "friends/?slim=1", None),
+        }
+        mark_unread = self.mark_unread(user, friend_id)
+        if mark_unread is None:
+            # nothing from friend_id to user: every request updates no rows
+            endpoints["mark-read no-op"] = ("post", f"chat/{friend_id}/mark-read/", None)
+        else:
+            endpoints["mark-read"] = ("post", f"chat/{friend_id}/mark-read/", mark_unread)
+        token = str(RefreshToken.for_user(user).access_token)
+
+        with override_settings(ROOT_URLCONF=urlconf()):
+            asyncio.run(self.run(endpoints, token, options["requests"], options["concurrency"]))
+
+    def pick_user(self, username):
+        if username:
+            user = User.objects.filter(username=username).first()
+        else:
+            busiest = Message.objects.values("sender").annotate(count=Count("id")).order_by("-count").first()
+            user = busiest and User.objects.get(id=busiest["sender"])
+        if user is None:
+            raise CommandError("No user to benchmark with, seed some data first (manage.py seed_dataset)")
+        return user
+
+    def busiest_partner(self, user):
+        partner = (
+            Message.objects.filter(Q(sender=user) | Q(recipient=user))
+            .values("sender", "recipient")
+            .annotate(count=Count("id"))
+            .order_by("-count")
+            .first()
+        )
+        if partner is None:
+            raise CommandError(f"{user.username} has no messages")
+        return partner["recipient"] if partner["sender"] == user.id else partner["sender"]
+
+    def mark_unread(self, user, friend_id):
+        """A coroutine function setting the latest messages from friend_id to user back to unread, or None"""
+        messages = Message.objects.using(shard_for(user.id, friend_id))
+        ids = list(messages.filter(sender_id=friend_id, recipient=user).order_by("-id").values_list("id", flat=True)[:MARK_READ_SAMPLE])
+        if not ids:
+            return None
+        return sync_to_async(lambda: messages.filter(id__in=ids).update(is_read=False))
+
+    async def run(self, endpoints, token, count, concurrency):
+        client = AsyncClient()
+        headers = {"Authorization": f"Bearer {token}"}
+        for label, (method, url, before) in endpoints.items():
+            for mode in ("sync", "async"):
+                request = partial(getattr(client, method), headers=headers)
+                await self.measure(f"{label} {mode}", request, f"/{mode}/{url}", count, concurrency, before)
+
+    async def measure(self, label, request, url, count, concurrency, before=None):
+        # warm up: connections, snapshot cache, url resolver
+        response = await request(url)
+        if response.status_code != 200:
+            raise CommandError(f"{url} answered {response.status_code}: {response.content[:200]!r}")
+
+        queue = asyncio.Queue()
+        for _ in range(count):
+            queue.put_nowait(None)
+        latencies, failures = [], []
+
+        async def worker():
+            while not queue.empty():
+                queue.get_nowait()
+                if before is not None:
+                    await before()
+                started = time.perf_counter()
+                response = await request(url)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    failures.append(response)
+
+        # latencies leave out before(), req/s doesn't: it's over the wall time of the run
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+        if failures:
+            raise CommandError(
+                f"{url}: {len(failures)} of {count} timed requests failed, "
+                f"the first with {failures[0].status_code}: {failures[0].content[:200]!r}"
+            )
+
+        latencies.sort()
+        self.stdout.write(
+            f"{label:>21}: {count / elapsed:7.1f} req/s"
+            f"  p50={statistics.median(latencies) * 1000:.1f}ms"
+            f"  p99={latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000:.1f}ms"
+        )
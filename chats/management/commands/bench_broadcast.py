@@ -0,0 +1,101 @@
+import asyncio
+import statistics
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.broadcast import BROADCAST_GROUP, audience_of, broadcast_event
+from chats.layers import HybridChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure time-to-deliver of one notice to every connection: a single group_send to the "
+        "broadcast group vs one group_send per user group. Connections are channels spread over "
+        "--workers layer instances sharing the configured Redis, each read by its own task that "
+        "evaluates the audience like RealtimeConsumer.broadcast_handler. --local-only skips Redis "
+        "and times what each worker does once the broadcast reaches it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=100000)
+        parser.add_argument("--workers", type=int, default=4, help="layer instances standing in for worker processes")
+        parser.add_argument("--percent", type=float, default=None, help="audience: only users whose id %% 100 is below this")
+        parser.add_argument("--local-only", action="store_true", help="only the in-process fan-out, no Redis needed")
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        if not isinstance(layer, HybridChannelLayer):
+            raise CommandError("CHANNEL_LAYERS['default'] must use chats.layers.HybridChannelLayer")
+
+        asyncio.run(self.run(layer, options))
+
+    async def run(self, sender, options):
+        # the full CONFIG, so the workers place the broadcast group (hash_ring) where the sender publishes
+        config = settings.CHANNEL_LAYERS["default"].get("CONFIG", {})
+        workers = [type(sender)(**config) for _ in range(options["workers"])]
+        local_only = options["local_only"]
+
+        members = []
+        for index in range(options["connections"]):
+            worker = workers[index % len(workers)]
+            members.append((worker, await worker.new_channel(), index + 1))
+
+        for worker, channel, user_id in members:
+            if local_only:
+                worker.local_groups[BROADCAST_GROUP].add(channel)
+            else:
+                await worker.group_add(BROADCAST_GROUP, channel)
+                await worker.group_add(f"bench_user_{user_id}", channel)
+        self.stdout.write(f"{len(members):,} connections on {len(workers)} worker(s)")
+
+        audience = {"percent": options["percent"]} if options["percent"] is not None else {}
+        for mode in ("fan-out",) if local_only else ("broadcast", "per-user"):
+            await self.measure(mode, sender, workers, members, audience)
+
+        if not local_only:
+            for worker, channel, user_id in members:
+                await worker.group_discard(BROADCAST_GROUP, channel)
+                await worker.group_discard(f"bench_user_{user_id}", channel)
+            for worker in workers:
+                await worker.close_pools()
+
+    async def measure(self, mode, sender, workers, members, audience):
+        delivered = []
+
+        async def connection(worker, channel, user_id):
+            # receive() would start the Redis router, the local buffer is all fan-out fills
+            event = await (worker.receive_buffer[channel].get() if mode == "fan-out" else worker.receive(channel))
+            if audience_of(event).includes(user_id):
+                delivered.append(time.perf_counter())
+
+        receivers = [asyncio.ensure_future(connection(*member)) for member in members]
+        await asyncio.sleep(0.5)
+
+        event = broadcast_event("maintenance", {"message": "Back in 10 minutes"}, audience)
+        started = time.perf_counter()
+        if mode == "fan-out":
+            # what each worker's router does with the one message Redis hands it
+            for worker in workers:
+                worker.deliver_broadcast(worker.broadcast_channel(BROADCAST_GROUP), event)
+            publishes = 0
+        elif mode == "broadcast":
+            await sender.group_send(BROADCAST_GROUP, event)
+            publishes = 1
+        else:
+            for _, _, user_id in members:
+                await sender.group_send(f"bench_user_{user_id}", event)
+            publishes = len(members)
+        sent = time.perf_counter() - started
+        await asyncio.gather(*receivers)
+
+        latencies = sorted(at - started for at in delivered)
+        summary = f"{mode:>9}: {publishes:,} group_send, sent in {sent:.3f}s, delivered to {len(latencies):,}"
+        if latencies:
+            summary += (
+                f": p50 {statistics.median(latencies):.3f}s, "
+                f"p99 {latencies[max(int(len(latencies) * 0.99) - 1, 0)]:.3f}s, last {latencies[-1]:.3f}s"
+            )
+        self.stdout.write(summary)
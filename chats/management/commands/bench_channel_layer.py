@@ -0,0 +1,61 @@
+import asyncio
+import statistics
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.layers import HybridChannelLayer
+
+
+class Command(BaseCommand):
+    help = "Compare group_send delivery latency to a local member vs a member on another worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        if not isinstance(layer, HybridChannelLayer):
+            raise CommandError("CHANNEL_LAYERS['default'] must use chats.layers.HybridChannelLayer")
+
+        asyncio.run(self.run(options["messages"]))
+
+    async def run(self, count):
+        # two layer instances stand in for two workers sharing the same Redis; the second is
+        # built from the full CONFIG so it places groups (hash_ring) the way the sender does
+        sender = get_channel_layer()
+        other_worker = type(sender)(**settings.CHANNEL_LAYERS["default"].get("CONFIG", {}))
+
+        for label, receiver in (("local", sender), ("remote", other_worker)):
+            latencies = await self.measure(sender, receiver, count)
+            latencies.sort()
+            self.stdout.write(
+                f"{label:>6}: n={count} "
+                f"p50={statistics.median(latencies) * 1e6:.0f}µs "
+                f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1e6:.0f}µs "
+                f"total={sum(latencies):.3f}s"
+            )
+
+        # only the bench_* groups were touched, and measure() leaves them; never flush() here,
+        # it deletes every key under the prefix, live groups and queued messages included
+        await other_worker.close_pools()
+        await sender.close_pools()
+
+    async def measure(self, sender, receiver, count):
+        group = f"bench_{receiver.client_prefix}"
+        channel = await receiver.new_channel()
+        await receiver.group_add(group, channel)
+
+        latencies = []
+        try:
+            for i in range(count):
+                started = time.perf_counter()
+                await sender.group_send(group, {"type": "bench.message", "seq": i})
+                await receiver.receive(channel)
+                latencies.append(time.perf_counter() - started)
+        finally:
+            await receiver.group_discard(group, channel)
+
+        return latencies
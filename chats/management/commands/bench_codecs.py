@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chats import codecs
+
+
+def sample_frames():
+    now = timezone.now().isoformat()
+    sender = {"id": 18342, "username": "ada_lovelace", "profile_picture": "https://cdn.example.com/avatars/18342/profile.jpg"}
+    return {
+        "chat_message": {
+            "type": "chat_message",
+            "id": 9812345,
+            "message": "On my way, should be there in about ten minutes. Want me to grab coffee?",
+            "sender": sender,
+            "recipient_id": 20411,
+            "timestamp": now,
+            "is_read": False,
+            "temp_id": "tmp-1712345678901-4821",
+        },
+        "message_sent": {"type": "message_sent", "id": 9812345, "timestamp": now, "temp_id": "tmp-1712345678901-4821"},
+        "user_status": {"type": "user_status", "user_id": 20411, "is_online": True, "timestamp": now},
+        "long_chat_message": {
+            "type": "chat_message",
+            "id": 9812346,
+            "message": "Meeting notes: " + " ".join(f"item {i} agreed and assigned;" for i in range(60)),
+            "sender": sender,
+            "recipient_id": 20411,
+            "timestamp": now,
+            "is_read": False,
+            "temp_id": "tmp-1712345678901-4822",
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare bytes per frame and encode/decode CPU cost of the JSON and compact websocket codecs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        if codecs.msgpack is None:
+            raise CommandError("msgpack is not installed")
+
+        candidates = {
+            "json": codecs.JsonCodec(),
+            "compact": codecs.CompactCodec(compress_threshold=None),
+            "compact+deflate": codecs.CompactCodec(compress_threshold=512),
+        }
+        iterations = options["iterations"]
+
+        for frame_name, frame in sample_frames().items():
+            self.stdout.write(frame_name)
+            for codec_name, codec in candidates.items():
+                encoded = codec.encode(frame)
+                wire = encoded.get("bytes_data") or encoded["text_data"].encode("utf8")
+
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    codec.encode(frame)
+                encode_cost = (time.perf_counter() - started) / iterations
+
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    codec.decode(**encoded)
+                decode_cost = (time.perf_counter() - started) / iterations
+
+                self.stdout.write(
+                    f"  {codec_name:>16}: {len(wire):>5} bytes  encode {encode_cost * 1e6:6.1f}µs  decode {decode_cost * 1e6:6.1f}µs"
+                )
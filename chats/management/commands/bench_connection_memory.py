@@ -0,0 +1,115 @@
+import asyncio
+import gc
+import os
+import resource
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from accounts.session import SessionUser
+from chats.consumers import RealtimeConsumer
+from chats.heartbeat import heartbeats
+
+User = get_user_model()
+
+MODES = ("model", "session")
+
+
+def rss_kb():
+    """Resident set size of this process in KB"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        # peak rather than current, but connections are only ever added here
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure resident memory per idle websocket connection with a full User per connection "
+        "(model) vs a SessionUser (session). Each mode runs in its own process, opening connections "
+        "in-process against an in-memory channel layer. Run it against seeded data (manage.py seed_dataset)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", default="1000,10000,50000", help="comma-separated connection counts, measured cumulatively")
+        parser.add_argument("--mode", choices=MODES, default=None, help="run one mode in this process (default: each in a subprocess)")
+
+    def handle(self, *args, **options):
+        counts = sorted(int(count) for count in options["connections"].split(","))
+
+        if options["mode"] is None:
+            for mode in MODES:
+                subprocess.run(
+                    [sys.executable, sys.argv[0], "bench_connection_memory", "--mode", mode, "--connections", options["connections"]],
+                    check=True,
+                )
+            return
+
+        if not User.objects.exists():
+            raise CommandError("No users to connect as, seed some data first (manage.py seed_dataset)")
+
+        with override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}):
+            asyncio.run(self.run(options["mode"], counts))
+
+    def load(self, mode, count):
+        """
+        `count` users as connections would hold them, each a separate instance loaded from
+        the database the way the auth middleware does (cycling through the users if needed)
+        """
+        loaded = []
+        while len(loaded) < count:
+            users = User.objects.order_by("id")[: count - len(loaded)]
+            if mode == "model":
+                loaded += users
+            else:
+                loaded += (SessionUser(*row) for row in users.values_list(*SessionUser.FIELDS))
+        return loaded
+
+    async def run(self, mode, counts):
+        # these clients never answer pings; keep them from being reaped mid-run
+        heartbeats.interval, heartbeats.timeout = 3600, float("inf")
+        communicators = []
+        gc.collect()
+        baseline = rss_kb()
+        started = time.perf_counter()
+
+        # the consumer prints a line per connect and disconnect; self.stdout keeps the real stream
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            try:
+                for count in counts:
+                    await self.connect(mode, count - len(communicators), communicators)
+
+                    gc.collect()
+                    grown = rss_kb() - baseline
+                    self.stdout.write(
+                        f"{mode:>7}: {count:>6} idle connections  rss +{grown / 1024:7.1f}MB  "
+                        f"{grown * 1024 / count:7.0f} B/connection  ({time.perf_counter() - started:.0f}s)"
+                    )
+            finally:
+                # disconnect() sets the users offline again
+                for index in range(0, len(communicators), 100):
+                    await asyncio.gather(*(communicator.disconnect(timeout=60) for communicator in communicators[index : index + 100]))
+
+    async def connect(self, mode, count, communicators):
+        for user in await database_sync_to_async(self.load)(mode, count):
+            communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+            communicator.scope["user"] = user
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError("connection refused")
+            communicators.append(communicator)
+            await communicator.receive_json_from(timeout=30)
+
+        # frames "sent" to these clients pile up in the test harness, not the server
+        for communicator in communicators:
+            while not communicator.output_queue.empty():
+                communicator.output_queue.get_nowait()
@@ -0,0 +1,108 @@
+import multiprocessing
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.test import override_settings
+
+from chats.models import IdBlock, Message
+from chats import sharding
+from chats.sharding import IdAllocator, shard_for
+
+# IdBlock counter the benchmark's messages draw ids from, deleted afterwards, so the run
+# doesn't reserve (and burn) real message ids on the default database
+BENCH_ALLOCATOR = "bench.message"
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure direct-message write throughput against the number of message shards. For each "
+        "shard count, fresh SQLite shard databases are created in a temporary directory and "
+        "concurrent writer processes store messages the way the chat consumer does (one transaction per "
+        "message on the conversation's shard). Runs on its own databases, no seeded data needed; "
+        "message ids come from a counter of its own that is removed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", default="1,2,4", help="comma-separated shard counts")
+        parser.add_argument("--writers", type=int, default=8, help="concurrent writer processes")
+        parser.add_argument("--messages", type=int, default=4000, help="messages per run")
+        parser.add_argument("--users", type=int, default=1000, help="conversations are drawn between this many user ids")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        allocator = IdAllocator(BENCH_ALLOCATOR, "chats.Message")
+        try:
+            with mock.patch("chats.sharding.message_ids", allocator):
+                self.run_all(options)
+        finally:
+            IdBlock.objects.filter(name=BENCH_ALLOCATOR).delete()
+
+    def run_all(self, options):
+        baseline = None
+        with tempfile.TemporaryDirectory() as directory:
+            for count in sorted(int(count) for count in options["shards"].split(",")):
+                aliases = self.create_shards(Path(directory), count)
+                with override_settings(MESSAGE_SHARDS=aliases):
+                    for alias in aliases:
+                        call_command("migrate", "chats", database=alias, verbosity=0)
+                    rate, latencies = self.run(aliases, options)
+                connections.close_all()
+
+                baseline = baseline or rate
+                self.stdout.write(
+                    f"{count} shard(s): {rate:,.0f} messages/s ({rate / baseline:.2f}x), "
+                    f"p50 {statistics.median(latencies) * 1000:.1f} ms, "
+                    f"p99 {statistics.quantiles(latencies, n=100)[98] * 1000:.1f} ms per write"
+                )
+
+    def create_shards(self, directory, count):
+        aliases = [f"bench_{count}_{index}" for index in range(count)]
+        databases = {"default": connections.settings["default"]}
+        for alias in aliases:
+            # writers queue for the file lock instead of failing with "database is locked"
+            databases[alias] = {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": directory / f"{alias}.sqlite3",
+                "OPTIONS": {"timeout": 60, "transaction_mode": "IMMEDIATE"},
+            }
+        connections.settings.update(connections.configure_settings(databases))
+        return aliases
+
+    def run(self, aliases, options):
+        rng = random.Random(options["seed"])
+        pairs = []
+        while len(pairs) < options["messages"]:
+            sender_id, recipient_id = rng.randint(1, options["users"]), rng.randint(1, options["users"])
+            if sender_id != recipient_id:
+                pairs.append((sender_id, recipient_id))
+
+        writers = options["writers"]
+        # processes rather than threads, so the writers contend for the database and not the GIL
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(writers) as pool:
+            started = time.perf_counter()
+            latencies = pool.map(write_messages, [pairs[index::writers] for index in range(writers)])
+            elapsed = time.perf_counter() - started
+
+        return len(pairs) / elapsed, [latency for timings in latencies for latency in timings]
+
+
+def write_messages(pairs):
+    timings = []
+    for sender_id, recipient_id in pairs:
+        started = time.perf_counter()
+        shard = shard_for(sender_id, recipient_id)
+        message_id = sharding.message_ids.next()
+        with transaction.atomic(using=shard):
+            Message.objects.using(shard).create(id=message_id, sender_id=sender_id, recipient_id=recipient_id, message="bench")
+        timings.append(time.perf_counter() - started)
+    connections.close_all()
+    return timings
@@ -0,0 +1,48 @@
+import json
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.broadcast import BROADCAST_GROUP, broadcast_event
+
+
+def user_ids(value):
+    try:
+        return [int(user_id) for user_id in value.split(",") if user_id]
+    except ValueError:
+        raise CommandError(f"Not a comma-separated list of user IDs: {value}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Push a notice (maintenance, feature flags...) to every connected client, or to an audience "
+        "of them, with one channel-layer group_send. Clients get "
+        '{"type": "broadcast", "kind", "payload", "timestamp"}.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", help='what the notice is, e.g. "maintenance" or "feature_flags"')
+        parser.add_argument("--payload", default="{}", help="JSON object sent to clients")
+        parser.add_argument("--user-ids", type=user_ids, default=None, help="only these users (comma-separated ids)")
+        parser.add_argument("--exclude-user-ids", type=user_ids, default=None, help="not these users (comma-separated ids)")
+        parser.add_argument("--percent", type=float, default=None, help="only users whose id %% 100 is below this")
+
+    def handle(self, *args, **options):
+        try:
+            payload = json.loads(options["payload"])
+        except ValueError as e:
+            raise CommandError(f"--payload is not JSON: {e}")
+        if not isinstance(payload, dict):
+            raise CommandError("--payload must be a JSON object")
+
+        audience = {
+            field: options[field] for field in ("user_ids", "exclude_user_ids", "percent") if options[field] is not None
+        }
+        try:
+            event = broadcast_event(options["kind"], payload, audience)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        async_to_sync(get_channel_layer().group_send)(BROADCAST_GROUP, event)
+        self.stdout.write(f"📣 Broadcast {event['broadcast_id']} ({options['kind']}) sent to {audience or 'everyone'}")
@@ -0,0 +1,32 @@
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from chats.outbox import OutboxDispatcher, get_outbox_settings
+
+
+class Command(BaseCommand):
+    help = "Send pending outbox events to the channel layer until stopped (run one or more alongside the web workers)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="send what is due now and exit")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options["once"]))
+
+    async def run(self, once):
+        dispatcher = OutboxDispatcher(**get_outbox_settings())
+
+        if once:
+            while await dispatcher.dispatch_batch():
+                pass
+        else:
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            self.stdout.write("📤 Dispatching outbox events")
+            await dispatcher.run(stop)
+
+        self.stdout.write(f"sent={dispatcher.sent} failed={dispatcher.failed}")
@@ -0,0 +1,100 @@
+import time
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from chats.models import Message
+from chats.sharding import get_message_shards, shard_for
+
+from .seed_dataset import explicit_timestamps
+
+
+class Command(BaseCommand):
+    help = (
+        "Move direct messages to the shard their conversation hashes to under the current "
+        "MESSAGE_SHARDS, after shards were added or removed. Scans each source database in id "
+        "order and copies misplaced messages (with their attachment links) before deleting them "
+        "from the source. Messages keep their ids. Rerunning after an interruption skips messages "
+        "already copied."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            default=None,
+            help="comma-separated database aliases to scan (default: MESSAGE_SHARDS); include a shard being removed",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true", help="count what would move without moving it")
+
+    def handle(self, *args, **options):
+        shards = get_message_shards()
+        sources = options["source"].split(",") if options["source"] else shards
+        unknown = [alias for alias in sources if alias not in connections.settings]
+        if unknown:
+            raise CommandError(f"Not in DATABASES: {', '.join(unknown)}")
+
+        moved = Counter()
+        started = time.perf_counter()
+        for source in sources:
+            scanned = self.rebalance(source, shards, options["batch_size"], options["dry_run"], moved)
+            self.stdout.write(f"{source}: scanned {scanned:,} messages")
+
+        for (source, target), count in sorted(moved.items()):
+            self.stdout.write(f"  {source} -> {target}: {count:,}")
+
+        elapsed = time.perf_counter() - started
+        total = sum(moved.values())
+        verb = "would move" if options["dry_run"] else "moved"
+        rate = f", {total / elapsed:,.0f}/s" if total and elapsed else ""
+        self.stdout.write(f"{verb} {total:,} messages in {elapsed:.1f}s{rate}")
+
+    def rebalance(self, source, shards, batch_size, dry_run, moved):
+        scanned = 0
+        last_id = 0
+        while True:
+            batch = list(Message.objects.using(source).filter(id__gt=last_id).order_by("id")[:batch_size])
+            if not batch:
+                return scanned
+            scanned += len(batch)
+            last_id = batch[-1].id
+
+            misplaced = defaultdict(list)
+            for message in batch:
+                target = shard_for(message.sender_id, message.recipient_id, shards)
+                if target != source:
+                    misplaced[target].append(message)
+
+            for target, messages in misplaced.items():
+                if not dry_run:
+                    self.move(source, target, messages)
+                moved[source, target] += len(messages)
+
+    def move(self, source, target, messages):
+        through = Message.attachments.through
+        links = defaultdict(list)
+        for message_id, attachment_id in through.objects.using(source).filter(message_id__in=[m.id for m in messages]).values_list(
+            "message_id", "attachment_id"
+        ):
+            links[message_id].append(attachment_id)
+
+        # copied by an earlier run that stopped before deleting them from the source
+        already_copied = set(Message.objects.using(target).filter(id__in=[m.id for m in messages]).values_list("id", flat=True))
+        # ids are unique across shards (chats/sharding.py), a moved message keeps its id
+        copies = [
+            Message(id=m.id, sender_id=m.sender_id, recipient_id=m.recipient_id, message=m.message, timestamp=m.timestamp, is_read=m.is_read, temp_id=m.temp_id)
+            for m in messages
+            if m.id not in already_copied
+        ]
+
+        with transaction.atomic(using=target), explicit_timestamps(Message._meta.get_field("timestamp")):
+            Message.objects.using(target).bulk_create(copies)
+            through.objects.using(target).bulk_create(
+                [through(message_id=copy.id, attachment_id=attachment_id) for copy in copies for attachment_id in links[copy.id]]
+            )
+
+        # the delete collector also removes the source's attachment links
+        with transaction.atomic(using=source):
+            Message.objects.using(source).filter(id__in=[m.id for m in messages]).delete()
+
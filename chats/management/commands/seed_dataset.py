@@ -0,0 +1,276 @@
+import bisect
+import itertools
+import random
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from accounts.models import UserSearchTerm, UserTrigram
+from accounts.phones import hash_phone
+from accounts.search import search_terms, trigrams_of_terms
+from chats.models import Message
+from chats.sharding import get_message_shards, message_ids, shard_for
+from friends.models import FriendRequest, Friendship
+from friends.views import friendship_pair
+
+User = get_user_model()
+
+# seeded users get <username>@SEED_EMAIL_DOMAIN; --clear only deletes users carrying it.
+# ".invalid" is reserved (RFC 2606), no real account can have such an address.
+SEED_EMAIL_DOMAIN = "seed.invalid"
+
+WORDS = (
+    "hey hi ok yes no sure thanks lol haha see you tomorrow tonight later soon coffee lunch dinner "
+    "meeting call running late on my way where are what time sounds good great nice cool awesome "
+    "did get the file photo link just landed home work weekend plans movie game nope maybe"
+).split()
+
+
+@contextmanager
+def explicit_timestamps(*fields):
+    """Let bulk_create keep the timestamps we generate instead of stamping auto_now(_add) ones"""
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field, _, _ in saved:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic dataset for performance work: users with a power-law friend graph, "
+        "pending friend requests and messages concentrated on a few busy conversations. "
+        "The same --seed and --until always produce the same rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--mean-friends", type=float, default=20, help="average friends per user")
+        parser.add_argument("--max-friends", type=int, default=2000)
+        parser.add_argument("--alpha", type=float, default=2.1, help="power-law exponent of the friend-count distribution")
+        parser.add_argument("--pending", type=float, default=2, help="average pending requests received per user")
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument("--conversation-skew", type=float, default=1.1, help="Zipf exponent of messages per conversation")
+        parser.add_argument("--days", type=int, default=90, help="messages are spread over this many days")
+        parser.add_argument("--until", default=None, help="ISO date the data ends at (default: today, UTC)")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--prefix", default="seed", help="username prefix of the seeded users")
+        parser.add_argument("--password", default="seed-password", help="password of every seeded user")
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help=f"delete users this command seeded under --prefix (their email is @{SEED_EMAIL_DOMAIN}), and their rows, first",
+        )
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        self.prefix = options["prefix"]
+
+        until = options["until"]
+        until = datetime.fromisoformat(until) if until else datetime.now(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.until = until if until.tzinfo else until.replace(tzinfo=dt_timezone.utc)
+        self.since = self.until - timedelta(days=options["days"])
+
+        named = User.objects.filter(username__startswith=self.prefix)
+        if unmarked := named.exclude(id__in=self.seeded_users().values("id")).count():
+            raise CommandError(
+                f"{unmarked} users named {self.prefix}* were not created by seed_dataset (their email isn't "
+                f"@{SEED_EMAIL_DOMAIN}), pick another --prefix"
+            )
+
+        if options["clear"]:
+            self.step("clear", self.clear)
+        elif named.exists():
+            raise CommandError(f"Users named {self.prefix}* already exist, pass --clear to replace them")
+
+        user_ids = self.step("users", self.create_users, options["users"], options["password"])
+        edges = self.step("friendships", self.create_friendships, user_ids, options["mean_friends"], options["max_friends"], options["alpha"])
+        self.step("friend requests", self.create_requests, user_ids, edges, options["pending"])
+        self.step("messages", self.create_messages, edges, options["messages"], options["conversation_skew"])
+
+    def step(self, label, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        count = len(result) if isinstance(result, (list, set)) else result
+        rate = f", {count / elapsed:,.0f}/s" if isinstance(count, int) and elapsed else ""
+        self.stdout.write(f"{label}: {count if count is not None else 'done'} in {elapsed:.1f}s{rate}")
+        return result
+
+    def batches(self, rows):
+        iterator = iter(rows)
+        while batch := list(itertools.islice(iterator, self.batch_size)):
+            yield batch
+
+    def seeded_users(self):
+        return User.objects.filter(username__startswith=self.prefix, email__endswith=f"@{SEED_EMAIL_DOMAIN}")
+
+    def clear(self):
+        with transaction.atomic():
+            seeded = self.seeded_users()
+            # messages may sit on other databases (chats/sharding.py), where a subquery can't reach
+            for ids in self.batches(seeded.values_list("id", flat=True).iterator()):
+                for shard in get_message_shards():
+                    Message.objects.using(shard).filter(sender_id__in=ids).delete()
+            return seeded.delete()[0]
+
+    def create_users(self, count, password):
+        # hashing is what makes real signups slow; every seeded user shares one hash
+        password = make_password(password)
+        now = self.until
+
+        def rows():
+            for i in range(count):
+                phone_number = f"+1555{i:07d}"
+                yield User(
+                    username=f"{self.prefix}{i}",
+                    password=password,
+                    email=f"{self.prefix}{i}@{SEED_EMAIL_DOMAIN}",
+                    first_name=self.rng.choice(WORDS).title(),
+                    phone_number=phone_number,
+                    # bulk_create skips User.save(), fill what it would derive
+                    phone_number_normalized=phone_number,
+                    phone_number_hash=hash_phone(phone_number),
+                    date_joined=now - timedelta(days=self.rng.randrange(365)),
+                )
+
+        for batch in self.batches(rows()):
+            User.objects.bulk_create(batch)
+
+        # not every backend returns ids from bulk_create, read the users back for the search index
+        seeded = self.seeded_users().only("id", "username", "first_name", "last_name").order_by("id")
+        for batch in self.batches(seeded.iterator(chunk_size=self.batch_size)):
+            terms, user_trigrams = [], []
+            for user in batch:
+                user_terms = search_terms(user)
+                terms.extend(UserSearchTerm(user_id=user.id, term=term) for term in user_terms)
+                user_trigrams.extend(UserTrigram(user_id=user.id, trigram=trigram) for trigram in trigrams_of_terms(user_terms))
+            with transaction.atomic():
+                UserSearchTerm.objects.bulk_create(terms)
+                UserTrigram.objects.bulk_create(user_trigrams)
+
+        return list(seeded.values_list("id", flat=True))
+
+    def create_friendships(self, user_ids, mean_friends, max_friends, alpha):
+        """
+        Configuration model: each user draws a power-law friend count, friend "stubs" are
+        paired at random, and self-pairs and duplicates are dropped.
+        """
+        raw = [self.rng.paretovariate(alpha - 1) for _ in user_ids]
+
+        # rescale until the capped and rounded counts average out at mean_friends
+        scale = mean_friends / (sum(raw) / len(raw))
+        for _ in range(5):
+            degrees = [min(max_friends, max(1, round(weight * scale))) for weight in raw]
+            scale *= mean_friends / (sum(degrees) / len(degrees))
+
+        stubs = []
+        for user_id, degree in zip(user_ids, degrees):
+            stubs.extend([user_id] * degree)
+        self.rng.shuffle(stubs)
+
+        edges = set()
+        for user1_id, user2_id in zip(stubs[::2], stubs[1::2]):
+            if user1_id != user2_id:
+                edges.add(friendship_pair(user1_id, user2_id))
+        edges = sorted(edges)
+
+        def rows():
+            for user1_id, user2_id in edges:
+                yield Friendship(user1_id=user1_id, user2_id=user2_id, created_at=self.random_time())
+
+        with explicit_timestamps(Friendship._meta.get_field("created_at")):
+            for batch in self.batches(rows()):
+                Friendship.objects.bulk_create(batch)
+        return edges
+
+    def create_requests(self, user_ids, edges, mean_pending):
+        friends = set(edges)
+        seen = set()
+        target = int(len(user_ids) * mean_pending)
+
+        def rows():
+            attempts = 0
+            while len(seen) < target and attempts < target * 10:
+                attempts += 1
+                from_user_id, to_user_id = self.rng.choice(user_ids), self.rng.choice(user_ids)
+                pair = friendship_pair(from_user_id, to_user_id)
+                if from_user_id == to_user_id or pair in friends or pair in seen:
+                    continue
+                seen.add(pair)
+                created_at = self.random_time()
+                yield FriendRequest(from_user_id=from_user_id, to_user_id=to_user_id, status="pending", created_at=created_at, updated_at=created_at)
+
+        with explicit_timestamps(FriendRequest._meta.get_field("created_at"), FriendRequest._meta.get_field("updated_at")):
+            for batch in self.batches(rows()):
+                FriendRequest.objects.bulk_create(batch)
+        return len(seen)
+
+    def create_messages(self, edges, count, skew):
+        """
+        Messages only flow between friends. Conversations get Zipf-distributed shares, so a
+        few are very busy and most see a handful of messages; timestamps are spread evenly
+        and everything older than a day is read.
+        """
+        if not edges or not count:
+            return 0
+
+        conversations = list(edges)
+        self.rng.shuffle(conversations)
+        cumulative = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(len(conversations))))
+        total = cumulative[-1]
+        window = (self.until - self.since).total_seconds()
+        read_before = self.until - timedelta(days=1)
+
+        # Message rows skip the ORM: building millions of model instances costs several times
+        # more than the INSERTs themselves
+        fields = [Message._meta.get_field(name) for name in ("id", "sender", "recipient", "message", "timestamp", "is_read")]
+        quote = connection.ops.quote_name
+        sql = (
+            f"INSERT INTO {quote(Message._meta.db_table)} ({', '.join(quote(field.column) for field in fields)}) "
+            f"VALUES ({', '.join(['%s'] * len(fields))})"
+        )
+        adapt_timestamp = connection.ops.adapt_datetimefield_value
+
+        def rows():
+            for _ in range(count):
+                user1_id, user2_id = conversations[bisect.bisect(cumulative, self.rng.random() * total)]
+                if self.rng.random() < 0.5:
+                    user1_id, user2_id = user2_id, user1_id
+                timestamp = self.since + timedelta(seconds=self.rng.random() * window)
+                yield (
+                    user1_id,
+                    user2_id,
+                    " ".join(self.rng.choices(WORDS, k=self.rng.randint(1, 12))),
+                    adapt_timestamp(timestamp),
+                    timestamp < read_before or self.rng.random() < 0.5,
+                )
+
+        created = 0
+        for batch in self.batches(rows()):
+            by_shard = defaultdict(list)
+            # ids are unique across shards, see chats/sharding.py
+            for message_id, row in zip(message_ids.take(len(batch)), batch):
+                by_shard[shard_for(row[0], row[1])].append((message_id, *row))
+            # the SQL is built for the default database, shards run the same engine
+            for shard, shard_rows in by_shard.items():
+                with transaction.atomic(using=shard), connections[shard].cursor() as cursor:
+                    cursor.executemany(sql, shard_rows)
+            created += len(batch)
+            if created % (self.batch_size * 100) == 0:
+                self.stdout.write(f"  {created:,} messages")
+        return created
+
+    def random_time(self):
+        return self.since + timedelta(seconds=self.rng.random() * (self.until - self.since).total_seconds())
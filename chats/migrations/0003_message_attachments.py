@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-19 05:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0001_initial'),
+        ('chats', '0002_rooms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attachments',
+            field=models.ManyToManyField(blank=True, related_name='messages', to='attachments.attachment'),
+        ),
+    ]
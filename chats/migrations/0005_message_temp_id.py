@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-19 06:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0001_initial'),
+        ('chats', '0004_outbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='temp_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('temp_id__isnull', False)), fields=('sender', 'recipient', 'temp_id'), name='unique_message_temp_id'),
+        ),
+    ]
@@ -4,16 +4,132 @@ from django.contrib.auth import get_user_model
 User = get_user_model()
 
 
+class MessageQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        from .sharding import message_ids
+
+        objs = list(objs)
+        missing = [obj for obj in objs if obj.id is None]
+        for obj, message_id in zip(missing, message_ids.take(len(missing)) if missing else ()):
+            obj.id = message_id
+        return super().bulk_create(objs, *args, **kwargs)
+
+
 class Message(models.Model):
-    sender = models.ForeignKey(User, related_name="sent_messages", on_delete=models.CASCADE)
-    recipient = models.ForeignKey(User, related_name="received_messages", on_delete=models.CASCADE)
+    # no database-level foreign keys: messages may live on a shard without the users and
+    # attachments tables (chats/sharding.py)
+    sender = models.ForeignKey(User, related_name="sent_messages", on_delete=models.CASCADE, db_constraint=False)
+    recipient = models.ForeignKey(User, related_name="received_messages", on_delete=models.CASCADE, db_constraint=False)
     message = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
+    attachments = models.ManyToManyField("attachments.Attachment", related_name="messages", blank=True, db_constraint=False)
+    # the client's id for the send, so a retried chat_message isn't stored twice; unique per
+    # conversation, clients that number sends per chat reuse it across recipients
+    temp_id = models.CharField(max_length=64, null=True, blank=True)
+
+    objects = MessageQuerySet.as_manager()
 
     class Meta:
         ordering = ["-timestamp"]
         indexes = [models.Index(fields=["sender", "recipient", "-timestamp"])]
+        constraints = [
+            models.UniqueConstraint(fields=["sender", "recipient", "temp_id"], condition=models.Q(temp_id__isnull=False), name="unique_message_temp_id"),
+        ]
 
     def __str__(self):
         return f"{self.sender.username} -> {self.recipient.username}: {self.message[:20]}"
+
+    def save(self, *args, **kwargs):
+        # ids are allocated across shards rather than by the shard's sequence, see chats/sharding.py
+        if self.id is None:
+            from .sharding import message_ids
+
+            self.id = message_ids.next()
+            kwargs.setdefault("force_insert", True)
+        super().save(*args, **kwargs)
+
+
+class Room(models.Model):
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(User, related_name="created_rooms", on_delete=models.SET_NULL, null=True)
+    members = models.ManyToManyField(User, through="RoomMembership", related_name="rooms")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return self.name
+
+
+class RoomMembership(models.Model):
+    room = models.ForeignKey(Room, related_name="memberships", on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name="room_memberships", on_delete=models.CASCADE)
+    # read watermark: id of the newest room message this member has read
+    last_read_message_id = models.BigIntegerField(default=0)
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("room", "user")
+
+    def __str__(self):
+        return f"{self.user.username} in {self.room.name}"
+
+
+class RoomMessage(models.Model):
+    """A group message, stored once per room regardless of member count"""
+
+    room = models.ForeignKey(Room, related_name="messages", on_delete=models.CASCADE)
+    sender = models.ForeignKey(User, related_name="sent_room_messages", on_delete=models.CASCADE)
+    message = models.TextField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-timestamp"]
+        indexes = [models.Index(fields=["room", "-timestamp"])]
+
+    def __str__(self):
+        return f"{self.sender.username} -> {self.room.name}: {self.message[:20]}"
+
+
+class OutboxEvent(models.Model):
+    """
+    A channel-layer message recorded in the same transaction as the change it announces.
+    chats.outbox.OutboxDispatcher sends it after commit, see chats/outbox.py.
+    """
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed")]
+
+    group = models.CharField(max_length=100)
+    message = models.JSONField()
+    # at most one pending event per key; None never collides
+    dedupe_key = models.CharField(max_length=200, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # not before this time: retry backoff, or a dispatcher's lease on a claimed event
+    available_at = models.DateTimeField(auto_now_add=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "available_at"])]
+        constraints = [
+            models.UniqueConstraint(fields=["dedupe_key"], condition=models.Q(status="pending"), name="unique_pending_outbox_dedupe_key"),
+        ]
+
+    def __str__(self):
+        return f"{self.message.get('type')} -> {self.group} ({self.status})"
+
+
+class IdBlock(models.Model):
+    """Next unreserved id of a chats.sharding.IdAllocator"""
+
+    name = models.CharField(max_length=100, primary_key=True)
+    next_id = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_id}"
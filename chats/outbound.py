@@ -0,0 +1,164 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+# Shed levels: frames with a higher level are dropped earlier when a client falls behind.
+KEEP = 0
+PRESENCE = 1
+EPHEMERAL = 2
+
+# Lanes, in the order the writer serves them. Frames keep their order within a lane.
+# Chat carries messages, acks, errors and typing; friend events carry friend request
+# notifications; presence carries user_status, one entry per user (the latest state).
+LANE_CHAT = 0
+LANE_EVENTS = 1
+LANE_PRESENCE = 2
+
+
+class OutboundQueue:
+    """
+    Per-connection buffer between channel-layer handlers and the websocket.
+
+    Handlers only append here, so the consumer keeps reading its channel-layer queue
+    (where overflow is dropped silently) even when the client reads slowly.
+
+    The writer always takes chat frames first, then friend events, then presence, so a
+    burst of presence (a reconnect storm among the user's friends) never holds up a
+    message. Presence is coalesced per user_id: a newer status replaces the queued one.
+    Presence waits `presence_linger` seconds after the first queued status so a burst
+    leaves as one frame; get() returns a single user_status frame as is, or several as
+    {"type": "user_status_batch", "statuses": [...]}.
+
+    The depth of this queue is what tells us the writer is falling behind:
+    - at `shed_at // 2` frames, ephemeral frames (typing, viewing) are discarded
+    - at `shed_at` frames, presence frames are discarded too and counted
+    - at `close_at` frames, put() refuses and the consumer closes the socket
+
+    Depth only grows while the writer's send() is pending. Servers that wait for the
+    socket to drain in send() (uvicorn with websockets) stall it for a slow client, so
+    there this bounds what a slow client costs. Daphne hands the frame to Twisted and
+    returns at once, with nothing the application can read back about the socket's
+    buffer: there it only bounds a burst the writer can't encode and hand over fast enough
+    (a reconnect storm, a large broadcast), and a client that stops reading is caught by
+    the heartbeat instead (chats/heartbeat.py).
+    """
+
+    def __init__(self, shed_at=200, close_at=1000, presence_linger=0.05):
+        self.shed_at = shed_at
+        self.close_at = close_at
+        self.presence_linger = presence_linger
+        self.dropped = 0
+        self._lanes = (deque(), deque())
+        # user_id -> status frame
+        self._presence = OrderedDict()
+        self._presence_since = 0.0
+        # shed-flagged frames in the lanes; everything in _presence is sheddable too
+        self._sheddable = 0
+        # shed level the queue was last put at; frames at or above it are refused on the way in,
+        # so the lanes only need scanning when the depth crosses into a higher level
+        self._level = None
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._lanes[LANE_CHAT]) + len(self._lanes[LANE_EVENTS]) + len(self._presence)
+
+    def shed_level(self, depth):
+        if depth >= self.shed_at:
+            return PRESENCE
+        if depth >= self.shed_at // 2:
+            return EPHEMERAL
+        return None
+
+    def put(self, frame, shed=KEEP, lane=LANE_CHAT):
+        """Queue a frame. Returns False if the connection is too far behind to keep."""
+        if lane == LANE_PRESENCE:
+            shed = PRESENCE
+            if frame["user_id"] in self._presence:
+                # coalesced: only the latest state goes out
+                self._presence[frame["user_id"]] = frame
+                return True
+
+        depth = len(self)
+
+        if depth >= self.close_at:
+            return False
+
+        level = self.shed_level(depth)
+        if level is not None:
+            if shed >= level:
+                self._count_dropped(shed)
+                return True
+            crossed = self._level is None or level < self._level
+            if crossed and (self._sheddable or self._presence):
+                self._shed(level)
+        self._level = level
+
+        if lane == LANE_PRESENCE:
+            if not self._presence:
+                self._presence_since = time.monotonic()
+            self._presence[frame["user_id"]] = frame
+        else:
+            self._lanes[lane].append((frame, shed))
+            if shed:
+                self._sheddable += 1
+        self._ready.set()
+        return True
+
+    def _count_dropped(self, shed):
+        # ephemeral frames are stale within seconds, the client isn't told about them
+        if shed < EPHEMERAL:
+            self.dropped += 1
+
+    def _shed(self, level):
+        # coalesced presence is the cheapest to lose, it goes first
+        if level <= PRESENCE:
+            self.dropped += len(self._presence)
+            self._presence.clear()
+
+        for frames in self._lanes:
+            kept = deque()
+            for item in frames:
+                if item[1] >= level:
+                    self._count_dropped(item[1])
+                    self._sheddable -= 1
+                else:
+                    kept.append(item)
+            frames.clear()
+            frames.extend(kept)
+
+    async def get(self):
+        while True:
+            for frames in self._lanes:
+                if frames:
+                    frame, shed = frames.popleft()
+                    if shed:
+                        self._sheddable -= 1
+                    return frame
+
+            self._ready.clear()
+            if not self._presence:
+                await self._ready.wait()
+                continue
+
+            linger = self._presence_since + self.presence_linger - time.monotonic()
+            if linger <= 0:
+                return self._take_presence()
+            # wake early for chat or events; otherwise let the burst gather
+            try:
+                await asyncio.wait_for(self._ready.wait(), linger)
+            except asyncio.TimeoutError:
+                pass
+
+    def _take_presence(self):
+        statuses = list(self._presence.values())
+        self._presence.clear()
+        if len(statuses) == 1:
+            return statuses[0]
+        return {"type": "user_status_batch", "statuses": [{key: value for key, value in status.items() if key != "type"} for status in statuses]}
+
+    def take_dropped(self):
+        """Return and reset the dropped count once the backlog has drained"""
+        if not self.dropped or len(self) > self.shed_at // 2:
+            return 0
+        dropped, self.dropped = self.dropped, 0
+        return dropped
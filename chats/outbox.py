@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+# longest wait, in seconds, between dispatch rounds that keep failing
+MAX_BACKOFF = 30
+
+
+def get_outbox_settings():
+    return {
+        "batch_size": 200,
+        "poll_interval": 0.2,
+        "lease": 30,
+        "max_attempts": 8,
+        "retry_backoff": 1,
+        "retention": 3600,
+        **getattr(settings, "REALTIME_OUTBOX", {}),
+    }
+
+
+def publish(group, message, dedupe_key=None):
+    """Record a channel-layer message for `group`, sent once the surrounding transaction commits"""
+    publish_many([group], message, dedupe_key)
+
+
+def publish_many(groups, message, dedupe_key=None):
+    """
+    Record the same message for several groups in one INSERT. With a `dedupe_key`, each
+    group's event is keyed "<dedupe_key>:<group>" and skipped while an identical one is
+    still pending, so a retried request doesn't notify twice.
+    """
+    events = [
+        OutboxEvent(group=group, message=message, dedupe_key=f"{dedupe_key}:{group}" if dedupe_key else None) for group in groups
+    ]
+    if events:
+        OutboxEvent.objects.bulk_create(events, ignore_conflicts=dedupe_key is not None)
+
+
+class OutboxDispatcher:
+    """
+    Moves pending outbox events to the channel layer, off the request path.
+
+    Each round claims up to `batch_size` due events (holding a `lease` so concurrent
+    dispatchers skip them), drops duplicate keys within the batch, and sends them: groups
+    in parallel, each group's events in order. Sent events are marked sent; failed ones
+    are retried after retry_backoff * 2^attempts seconds and marked failed after
+    `max_attempts`. Sent events are deleted after `retention` seconds.
+
+    Delivery is at least once: a dispatcher that dies between sending and marking leaves
+    its batch to be sent again when the lease runs out. The event id goes out as
+    "outbox_id" for clients that want to drop repeats.
+    """
+
+    def __init__(self, channel_layer=None, batch_size=200, poll_interval=0.2, lease=30, max_attempts=8, retry_backoff=1, retention=3600):
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retention = retention
+        self.sent = 0
+        self.failed = 0
+
+    async def run(self, stop=None):
+        """
+        Dispatch until `stop` is set. A round that fails (the database locked or gone, say)
+        is logged and retried after poll_interval * 2^failures seconds, at most MAX_BACKOFF.
+        """
+        pruned_at = 0
+        failures = 0
+        while stop is None or not stop.is_set():
+            try:
+                claimed = await self.dispatch_batch()
+                if time.monotonic() - pruned_at > 60:
+                    await database_sync_to_async(self.prune)()
+                    pruned_at = time.monotonic()
+            except Exception as e:
+                failures += 1
+                backoff = min(self.poll_interval * 2**failures, MAX_BACKOFF)
+                print(f"⚠️ Outbox dispatch failed ({failures} in a row), retrying in {backoff:g}s: {e}")
+                await asyncio.sleep(backoff)
+                continue
+
+            failures = 0
+            if not claimed:
+                await asyncio.sleep(self.poll_interval)
+
+    async def dispatch_batch(self):
+        """Send one batch; returns how many events were claimed"""
+        events = await database_sync_to_async(self.claim)()
+        if not events:
+            return 0
+
+        by_group = defaultdict(list)
+        seen_keys = set()
+        duplicate_ids = []
+        for event in events:
+            if event.dedupe_key is not None and event.dedupe_key in seen_keys:
+                duplicate_ids.append(event.id)
+                continue
+            seen_keys.add(event.dedupe_key)
+            by_group[event.group].append(event)
+
+        results = await asyncio.gather(*(self.send_group(group, group_events) for group, group_events in by_group.items()))
+
+        sent_ids = duplicate_ids
+        failures = {}
+        for group_sent, group_failures in results:
+            sent_ids += group_sent
+            failures.update(group_failures)
+
+        await database_sync_to_async(self.complete)(sent_ids, failures, {event.id: event.attempts for event in events})
+        self.sent += len(sent_ids)
+        self.failed += len(failures)
+        return len(events)
+
+    async def send_group(self, group, events):
+        sent_ids, failures = [], {}
+        for index, event in enumerate(events):
+            try:
+                await self.channel_layer.group_send(group, {**event.message, "outbox_id": event.id})
+            except Exception as e:
+                # keep the group's order: everything after a failure waits for the retry
+                for later in events[index:]:
+                    failures[later.id] = str(e) if later is event else "an earlier event in the group failed"
+                break
+            sent_ids.append(event.id)
+        return sent_ids, failures
+
+    def claim(self):
+        now = timezone.now()
+        with transaction.atomic():
+            due = OutboxEvent.objects.filter(status=OutboxEvent.PENDING, available_at__lte=now).order_by("id")
+            if connection.features.has_select_for_update_skip_locked:
+                due = due.select_for_update(skip_locked=True)
+            events = list(due[: self.batch_size])
+            if events:
+                OutboxEvent.objects.filter(id__in=[event.id for event in events]).update(available_at=now + timedelta(seconds=self.lease))
+        return events
+
+    def complete(self, sent_ids, failures, attempts):
+        now = timezone.now()
+        with transaction.atomic():
+            if sent_ids:
+                OutboxEvent.objects.filter(id__in=sent_ids).update(status=OutboxEvent.SENT, available_at=now)
+            for event_id, error in failures.items():
+                tries = attempts[event_id] + 1
+                OutboxEvent.objects.filter(id=event_id).update(
+                    attempts=tries,
+                    last_error=error,
+                    status=OutboxEvent.FAILED if tries >= self.max_attempts else OutboxEvent.PENDING,
+                    available_at=now + timedelta(seconds=self.retry_backoff * 2**tries),
+                )
+
+    def prune(self):
+        cutoff = timezone.now() - timedelta(seconds=self.retention)
+        OutboxEvent.objects.filter(status=OutboxEvent.SENT, available_at__lt=cutoff).delete()
@@ -0,0 +1,53 @@
+from django.db import DEFAULT_DB_ALIAS
+
+from .sharding import get_message_shards, shard_for
+
+# direct messages and their attachment links; everything else lives on "default"
+SHARDED_MODELS = {"chats.message", "chats.message_attachments"}
+
+
+def is_sharded_model(model):
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+class MessageShardRouter:
+    """
+    Routes Message rows to the shard of their conversation (settings.MESSAGE_SHARDS, see
+    chats/sharding.py) and keeps every other model on the default database.
+
+    A Message that was loaded or saved stays on its database, including its attachment
+    links; a new one goes to shard_for(sender, recipient). Querysets have no instance to go
+    by, so reads spanning conversations must pick a shard with .using() — a plain
+    Message.objects query only sees the default database. Users and attachments reached
+    from a message are read from the default database.
+
+    Shard databases only get the message tables; migrate each one with
+    `manage.py migrate --database=<alias>`.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints.get("instance"))
+
+    def route(self, model, instance):
+        if instance is None or not is_sharded_model(type(instance)):
+            return None
+        if not is_sharded_model(model):
+            return DEFAULT_DB_ALIAS
+        if instance._state.db:
+            return instance._state.db
+        if getattr(instance, "sender_id", None) and getattr(instance, "recipient_id", None):
+            return shard_for(instance.sender_id, instance.recipient_id)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded_model(type(obj1)) or is_sharded_model(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in get_message_shards():
+            return None
+        return f"{app_label}.{model_name}" in SHARDED_MODELS
@@ -1,6 +1,8 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
-from .models import Message
+from accounts.snapshots import user_snapshots
+from attachments.serializers import AttachmentSerializer
+from .models import Message, Room, RoomMessage
 
 User = get_user_model()
 
@@ -11,14 +13,69 @@ class MessageSenderSerializer(serializers.ModelSerializer):
         fields = ["id", "username", "profile_picture"]
 
 
+class UserSnapshotField(serializers.Field):
+    """
+    Renders a user id (e.g. source="sender_id") as the user's cached snapshot, without
+    loading the User. SnapshotListSerializer looks up a whole page with one get_many.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, user_id):
+        snapshots = self.context.get("user_snapshots", {})
+        if user_id in snapshots:
+            return snapshots[user_id]
+        return user_snapshots.get(user_id)
+
+
+class SnapshotListSerializer(serializers.ListSerializer):
+    """Fetches the snapshots for every row's `snapshot_id_field` in one go"""
+
+    def to_representation(self, data):
+        rows = list(data.all() if hasattr(data, "all") else data)
+        snapshots = self.context.setdefault("user_snapshots", {})
+        # async views pass the snapshots in, there is nothing left to look up
+        missing = {getattr(row, self.child.snapshot_id_field) for row in rows} - snapshots.keys()
+        if missing:
+            snapshots.update(user_snapshots.get_many(missing))
+        return super().to_representation(rows)
+
+
 class MessageSerializer(serializers.ModelSerializer):
-    sender = MessageSenderSerializer(read_only=True)
+    sender = UserSnapshotField(source="sender_id")
+    attachments = AttachmentSerializer(many=True, read_only=True)
+
+    snapshot_id_field = "sender_id"
 
     class Meta:
         model = Message
-        fields = ["id", "sender", "recipient", "message", "timestamp", "is_read"]
+        list_serializer_class = SnapshotListSerializer
+        fields = ["id", "sender", "recipient", "message", "timestamp", "is_read", "attachments"]
         read_only_fields = ["id", "timestamp"]
 
 
 class ChatHistorySerializer(serializers.Serializer):
     messages = MessageSerializer(many=True, read_only=True)
+
+
+class RoomMessageSerializer(serializers.ModelSerializer):
+    sender = UserSnapshotField(source="sender_id")
+
+    snapshot_id_field = "sender_id"
+
+    class Meta:
+        model = RoomMessage
+        list_serializer_class = SnapshotListSerializer
+        fields = ["id", "room", "sender", "message", "timestamp"]
+        read_only_fields = ["id", "timestamp"]
+
+
+class RoomSerializer(serializers.ModelSerializer):
+    members = MessageSenderSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Room
+        fields = ["id", "name", "members", "created_by", "created_at"]
+        read_only_fields = ["id", "created_by", "created_at"]
@@ -0,0 +1,185 @@
+import itertools
+import os
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Max, Q, prefetch_related_objects
+
+from .layers import HashRing
+
+# Direct messages live on the database their conversation hashes to. A conversation is the
+# unordered pair of users, so both directions and every read of it go to one shard; the
+# per-user views (recent chats, attachment access) fan in over the shards.
+#
+# Message ids come from message_ids below rather than a shard's own sequence, so they are
+# unique across shards and a message keeps its id when rebalance_messages moves it.
+
+_rings = {}
+
+
+def get_message_shards():
+    return list(getattr(settings, "MESSAGE_SHARDS", [DEFAULT_DB_ALIAS]))
+
+
+def is_sharded():
+    return get_message_shards() != [DEFAULT_DB_ALIAS]
+
+
+def conversation_key(user_a_id, user_b_id):
+    low, high = sorted((int(user_a_id), int(user_b_id)))
+    return f"{low}:{high}"
+
+
+def shard_for(user_a_id, user_b_id, shards=None):
+    """The database alias holding the conversation between the two users"""
+    shards = tuple(shards or get_message_shards())
+    if len(shards) == 1:
+        return shards[0]
+
+    # a consistent hash ring, so adding a shard only moves the conversations it takes over
+    ring = _rings.get(shards)
+    if ring is None:
+        ring = _rings[shards] = HashRing(shards)
+    return shards[ring.get(conversation_key(user_a_id, user_b_id))]
+
+
+class IdAllocator:
+    """
+    Globally unique ids for a model spread over shards.
+
+    Each process reserves blocks of `block_size` ids from a counter row (IdBlock) on the
+    default database and hands them out locally, so the default database sees one UPDATE
+    per block rather than one per row. Ids increase within a process, not across
+    processes, and blocks a process exits with are never reused: order by timestamp.
+
+    A reservation commits on its own, so take ids before opening the transaction that
+    stores the rows: reserving inside an atomic block on the default database raises.
+    """
+
+    def __init__(self, name, model_label, block_size=1000):
+        self.name = name
+        self.model_label = model_label
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.pid = None
+        self.block = iter(())
+
+    def next(self):
+        return self.take(1)[0]
+
+    def take(self, count):
+        """`count` unused ids"""
+        with self.lock:
+            # a forked child must not hand out its parent's block
+            if self.pid != os.getpid():
+                self.pid, self.block = os.getpid(), iter(())
+            ids = list(itertools.islice(self.block, count))
+            if len(ids) < count:
+                wanted = count - len(ids)
+                block = self.reserve(max(wanted, self.block_size))
+                ids += block[:wanted]
+                self.block = iter(block[wanted:])
+            return ids
+
+    def reserve(self, count):
+        from .models import IdBlock
+
+        blocks = IdBlock.objects.using(DEFAULT_DB_ALIAS)
+        # durable: refuses to run inside a caller's transaction, whose rollback would undo the
+        # counter bump while this process keeps the block and another one reserves it again
+        with transaction.atomic(using=DEFAULT_DB_ALIAS, durable=True):
+            # the UPDATE comes first: it takes the row (or SQLite's write) lock before the read
+            if not blocks.filter(name=self.name).update(next_id=F("next_id") + count):
+                blocks.get_or_create(name=self.name, defaults={"next_id": self.first_free_id()})
+                blocks.filter(name=self.name).update(next_id=F("next_id") + count)
+            end = blocks.get(name=self.name).next_id
+        return range(end - count, end)
+
+    def first_free_id(self):
+        """Above every id on every shard, for rows stored before the counter existed"""
+        from django.apps import apps
+
+        model = apps.get_model(self.model_label)
+        return max((model.objects.using(shard).aggregate(id=Max("id"))["id"] or 0 for shard in get_message_shards()), default=0) + 1
+
+
+message_ids = IdAllocator("chats.message", "chats.Message")
+
+
+def delete_user_messages(sender, instance, using, **kwargs):
+    """
+    pre_delete receiver for users: their messages on the other shards. Message has no
+    database-level foreign keys, and the delete collector only cascades on the database
+    the user is deleted from.
+    """
+    from .models import Message
+
+    for shard in get_message_shards():
+        if shard != using:
+            Message.objects.using(shard).filter(Q(sender_id=instance.pk) | Q(recipient_id=instance.pk)).delete()
+
+
+def partners_by_shard(user_id, partner_ids):
+    """{shard: [partner ids]} for the user's conversations with `partner_ids`"""
+    by_shard = defaultdict(list)
+    for partner_id in partner_ids:
+        by_shard[shard_for(user_id, partner_id)].append(partner_id)
+    return by_shard
+
+
+def conversation_messages(user_id, friend_id):
+    """Messages between the two users, both directions, on the conversation's shard"""
+    from .models import Message
+
+    return Message.objects.using(shard_for(user_id, friend_id)).filter(
+        Q(sender_id=user_id, recipient_id=friend_id) | Q(sender_id=friend_id, recipient_id=user_id)
+    )
+
+
+def prefetch_attachments(messages):
+    """
+    prefetch_related("attachments") for messages that may come from several shards.
+
+    Attachments stay on the default database, so with shards configured the link rows are
+    read on each message's shard and the attachments in one more query.
+    """
+    from attachments.models import Attachment
+
+    from .models import Message
+
+    if not messages:
+        return
+    if not is_sharded():
+        prefetch_related_objects(messages, "attachments")
+        return
+
+    ids_by_shard = defaultdict(list)
+    for message in messages:
+        ids_by_shard[message._state.db].append(message.id)
+
+    links = defaultdict(list)
+    through = Message.attachments.through
+    for shard, ids in ids_by_shard.items():
+        for message_id, attachment_id in through.objects.using(shard).filter(message_id__in=ids).values_list("message_id", "attachment_id"):
+            links[shard, message_id].append(attachment_id)
+
+    attachments = Attachment.objects.in_bulk({attachment_id for ids in links.values() for attachment_id in ids}) if links else {}
+
+    for message in messages:
+        found = [attachments[attachment_id] for attachment_id in links.get((message._state.db, message.id), ()) if attachment_id in attachments]
+        set_prefetched_attachments(message, found)
+
+
+def set_prefetched_attachments(message, attachments):
+    """Make message.attachments.all() return `attachments` without a query"""
+    from attachments.models import Attachment
+
+    # same order the relation would load them in (Attachment.Meta.ordering)
+    queryset = Attachment.objects.filter(messages=message.id)
+    queryset._result_cache = sorted(attachments, key=lambda attachment: attachment.created_at, reverse=True)
+    queryset._prefetch_done = True
+    if not hasattr(message, "_prefetched_objects_cache"):
+        message._prefetched_objects_cache = {}
+    message._prefetched_objects_cache["attachments"] = queryset
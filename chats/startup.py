@@ -0,0 +1,204 @@
+import asyncio
+import json
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+
+# Imported by config/asgi.py before Django is set up: keep module-level imports light.
+
+
+def get_startup_settings():
+    return {
+        "readiness_path": "/ready/",
+        "stage_timeout": 10,
+        "serializers": [],
+        **getattr(settings, "WORKER_STARTUP", {}),
+    }
+
+
+def warm_urls():
+    from django.urls import get_resolver
+
+    # imports ROOT_URLCONF and every view module it includes
+    get_resolver().reverse_dict
+
+
+def warm_rest_framework():
+    from django.utils.module_loading import import_string
+    from rest_framework.settings import api_settings
+
+    # the authentication, permission and renderer classes are imported on first access
+    for name in ("DEFAULT_AUTHENTICATION_CLASSES", "DEFAULT_PERMISSION_CLASSES", "DEFAULT_RENDERER_CLASSES", "DEFAULT_PARSER_CLASSES"):
+        getattr(api_settings, name)
+    for path in get_startup_settings()["serializers"]:
+        import_string(path)().fields
+
+
+def warm_databases():
+    from django.db import connections
+
+    for alias in connections:
+        with connections[alias].cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+
+def warm_caches():
+    from django.core.cache import caches
+
+    for alias in settings.CACHES:
+        caches[alias].get("worker_startup:warm")
+
+
+def warm_password_hashing():
+    from accounts.hashing import get_pool
+
+    get_pool().warm()
+
+
+async def warm_channel_layer():
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    # channels_redis keeps a pool per event loop, so this has to run on the server's loop
+    for index in range(getattr(layer, "ring_size", 0)):
+        await layer.connection(index).ping()
+
+
+# (stage, function); plain functions run on asgiref's shared sync thread, which websocket
+# consumers' database_sync_to_async calls also use, so with CONN_MAX_AGE set consumers reuse
+# the database connections opened here. Django runs each HTTP request on a thread of its own
+# (ThreadSensitiveContext), so for requests the databases stage only checks every database answers.
+WARM_STAGES = [
+    ("url resolver", warm_urls),
+    ("rest framework", warm_rest_framework),
+    ("databases", warm_databases),
+    ("caches", warm_caches),
+    ("password hashing", warm_password_hashing),
+    ("channel layer", warm_channel_layer),
+]
+
+
+class WorkerStartup:
+    """
+    Startup of this worker process, stage by stage: the imports and setup done while the
+    ASGI application is loaded (timed with stage()), then warm(), which checks database,
+    cache and channel-layer connections and fills Django's and DRF's lazy state, so the
+    first requests and connects after a deploy don't pay for it.
+
+    The worker is ready once every warm-up stage succeeded. A stage that failed (Redis not
+    up yet, say) is retried by the next warm() call; StartupMiddleware makes one whenever a
+    request reaches a worker that isn't ready, normally the load balancer's readiness probe.
+    """
+
+    def __init__(self, stages=WARM_STAGES):
+        self.started = time.perf_counter()
+        self.warm_stages = stages
+        # stage -> {"ms": duration, "error": message or None}, in the order they ran
+        self.stages = {}
+        self.ready = False
+        self.ready_after = None
+        self.task = None
+
+    @contextmanager
+    def stage(self, name):
+        """Time a setup stage; errors propagate, the worker can't run without it"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    def record(self, name, started, error=None):
+        ms = round((time.perf_counter() - started) * 1000, 1)
+        self.stages[name] = {"ms": ms, "error": error}
+        if error:
+            print(f"⚠️ Startup stage '{name}' failed after {ms} ms: {error}")
+        else:
+            print(f"⏱️ Startup stage '{name}': {ms} ms")
+
+    async def warm(self):
+        timeout = get_startup_settings()["stage_timeout"]
+        for name, function in self.warm_stages:
+            if self.stages.get(name, {"error": "pending"})["error"] is None:
+                continue
+            started = time.perf_counter()
+            try:
+                if iscoroutinefunction(function):
+                    await asyncio.wait_for(function(), timeout)
+                else:
+                    await asyncio.wait_for(sync_to_async(function, thread_sensitive=True)(), timeout)
+            except Exception as e:
+                self.record(name, started, f"{type(e).__name__}: {e}" if str(e) else type(e).__name__)
+            else:
+                self.record(name, started)
+
+        if not self.ready and all(self.stages[name]["error"] is None for name, _ in self.warm_stages):
+            self.ready = True
+            self.ready_after = round(time.perf_counter() - self.started, 3)
+            print(f"✅ Worker ready {self.ready_after}s after startup")
+        return self.ready
+
+    def ensure_warming(self):
+        """Start warm() on the running loop unless the worker is ready or it is running"""
+        if not self.ready and (self.task is None or self.task.done()):
+            self.task = asyncio.get_running_loop().create_task(self.warm())
+
+    def status(self):
+        """Public readiness report; stage errors are only in the worker's log, not here"""
+        return {
+            "ready": self.ready,
+            "ready_after": self.ready_after,
+            "uptime": round(time.perf_counter() - self.started, 3),
+            "stages": {name: {"ms": stage["ms"], "ok": stage["error"] is None} for name, stage in self.stages.items()},
+        }
+
+
+worker_startup = WorkerStartup()
+
+
+class StartupMiddleware:
+    """
+    Outermost ASGI application: answers the readiness probe (200 once the worker is warm,
+    503 before) without going through Django, so it never queues behind the warm-up on
+    the sync thread, and starts the warm-up on the first request or on lifespan startup.
+    """
+
+    def __init__(self, app, startup=None):
+        self.app = app
+        self.startup = startup or worker_startup
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        self.startup.ensure_warming()
+        if scope["type"] == "http" and scope["path"] == get_startup_settings()["readiness_path"]:
+            return await self.readiness(send)
+        return await self.app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        # servers speaking lifespan (uvicorn, hypercorn) wait for the warm-up before serving;
+        # Daphne doesn't, there the first readiness probe starts it
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup.ensure_warming()
+                if self.startup.task is not None:
+                    await self.startup.task
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def readiness(self, send):
+        body = json.dumps(self.startup.status()).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200 if self.startup.ready else 503,
+                "headers": [(b"content-type", b"application/json"), (b"cache-control", b"no-store")],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -1,3 +1,1100 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, transaction
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.profiling import install_profiling, load_profile
+from accounts.session import SessionUser
+from friends.models import Friendship
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import async_views, views
+from .broadcast import BROADCAST_GROUP, audience_of, broadcast_event, parse_audience
+from .codecs import CompactCodec
+from .ephemeral import EphemeralCoalescer, coalescer
+from .consumers import HEARTBEAT_TIMEOUT_CLOSE_CODE, SLOW_CONSUMER_CLOSE_CODE, RealtimeConsumer
+from .heartbeat import heartbeats
+from .history import ConversationHistoryCache, conversation_history
+from .idempotency import recent_sends
+from .layers import HybridChannelLayer
+from .management.commands.seed_dataset import SEED_EMAIL_DOMAIN
+from .outbound import LANE_EVENTS, LANE_PRESENCE, OutboundQueue
+from .models import IdBlock, Message, OutboxEvent, Room, RoomMembership, RoomMessage
+from .outbox import OutboxDispatcher, publish
+from .routers import MessageShardRouter
+from .serializers import MessageSerializer
+from .sharding import IdAllocator, delete_user_messages, shard_for
+from .startup import WARM_STAGES, StartupMiddleware, WorkerStartup
+
+User = get_user_model()
+
+
+class FlakyChannelLayer(InMemoryChannelLayer):
+    """Fails the first `failures` group sends"""
+
+    def __init__(self, failures=1, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    async def group_send(self, group, message):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("redis went away")
+        await super().group_send(group, message)
+
+
+class OutboxTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="sender")
+        self.recipient = User.objects.create(username="recipient")
+        self.client = APIClient()
+        self.client.force_authenticate(self.sender)
+
+    def listen(self, layer, group):
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(group, channel)
+        return channel
+
+    def test_rolled_back_transaction_records_nothing(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            publish("user_1", {"type": "friend_request_handler", "data": {}})
+            raise RuntimeError()
+
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_request_records_event_and_dispatcher_sends_it(self):
+        response = self.client.post("/api/friends/request/", {"to_user_id": self.recipient.id}, format="json")
+        self.assertEqual(response.status_code, 201)
+
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.group, f"user_{self.recipient.id}")
+        self.assertEqual(event.status, OutboxEvent.PENDING)
+
+        layer = InMemoryChannelLayer()
+        channel = self.listen(layer, f"user_{self.recipient.id}")
+        async_to_sync(OutboxDispatcher(layer).dispatch_batch)()
+
+        message = async_to_sync(layer.receive)(channel)
+        self.assertEqual(message["type"], "friend_request_handler")
+        self.assertEqual(message["data"]["from_user"]["id"], self.sender.id)
+        self.assertEqual(message["outbox_id"], event.id)
+        event.refresh_from_db()
+        self.assertEqual(event.status, OutboxEvent.SENT)
+
+    async def test_dispatcher_survives_a_failed_round(self):
+        await database_sync_to_async(publish)(f"user_{self.recipient.id}", {"type": "friend_request_handler", "data": {}})
+        layer = InMemoryChannelLayer()
+        channel = await layer.new_channel()
+        await layer.group_add(f"user_{self.recipient.id}", channel)
+
+        dispatcher = OutboxDispatcher(layer, poll_interval=0.01)
+        claim = dispatcher.claim
+        calls = []
+
+        def locked_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError("database is locked")
+            return claim()
+
+        dispatcher.claim = locked_once
+        stop = asyncio.Event()
+        runner = asyncio.ensure_future(dispatcher.run(stop))
+        try:
+            self.assertEqual((await asyncio.wait_for(layer.receive(channel), 5))["type"], "friend_request_handler")
+        finally:
+            stop.set()
+            await asyncio.wait_for(runner, 5)
+        self.assertGreater(len(calls), 1)
+
+    def test_pending_duplicates_are_recorded_once(self):
+        for _ in range(3):
+            self.client.post("/api/friends/request/", {"to_user_id": self.recipient.id}, format="json")
+
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+    def test_failed_send_is_retried_with_backoff(self):
+        self.client.post("/api/friends/request/", {"to_user_id": self.recipient.id}, format="json")
+        layer = FlakyChannelLayer(failures=1)
+        channel = self.listen(layer, f"user_{self.recipient.id}")
+        dispatcher = OutboxDispatcher(layer, retry_backoff=60)
+
+        async_to_sync(dispatcher.dispatch_batch)()
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (OutboxEvent.PENDING, 1))
+        self.assertGreater(event.available_at, timezone.now() + timedelta(seconds=60))
+        self.assertEqual(async_to_sync(dispatcher.dispatch_batch)(), 0)
+
+        OutboxEvent.objects.update(available_at=timezone.now())
+        async_to_sync(dispatcher.dispatch_batch)()
+        self.assertEqual(async_to_sync(layer.receive)(channel)["outbox_id"], event.id)
+        self.assertEqual(OutboxEvent.objects.get().status, OutboxEvent.SENT)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class IdempotentSendTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="sender")
+        self.recipient = User.objects.create(username="recipient")
+        Friendship.objects.create(user1=self.sender, user2=self.recipient)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = SessionUser.from_user(user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())["type"], "connection")
+        return communicator
+
+    def send(self, temp_id):
+        return {"type": "chat_message", "recipient_id": self.recipient.id, "message": "hi", "temp_id": temp_id}
+
+    async def test_retry_gets_original_ack_without_second_message(self):
+        recipient = await self.connect(self.recipient)
+        sender = await self.connect(self.sender)
+        await recipient.receive_json_from()  # sender came online
+
+        await sender.send_json_to(self.send("abc"))
+        ack = await sender.receive_json_from()
+        self.assertEqual((await recipient.receive_json_from())["id"], ack["id"])
+
+        # the same worker remembers the ack
+        await sender.send_json_to(self.send("abc"))
+        self.assertEqual(await sender.receive_json_from(), ack)
+
+        # another worker (or an expired entry) falls back to the unique constraint
+        recent_sends.entries.clear()
+        await sender.send_json_to(self.send("abc"))
+        self.assertEqual(await sender.receive_json_from(), ack)
+
+        self.assertTrue(await recipient.receive_nothing())
+        self.assertEqual(await Message.objects.acount(), 1)
+
+        await sender.send_json_to(self.send("def"))
+        self.assertNotEqual((await sender.receive_json_from())["id"], ack["id"])
+        self.assertEqual(await Message.objects.acount(), 2)
+
+        await sender.disconnect()
+        await recipient.disconnect()
+
+    async def test_temp_id_is_scoped_to_the_conversation(self):
+        other = await User.objects.acreate(username="other")
+        await Friendship.objects.acreate(user1=self.sender, user2=other)
+        sender = await self.connect(self.sender)
+
+        await sender.send_json_to(self.send("1"))
+        first = await sender.receive_json_from()
+        # a client numbering its sends per chat reuses the temp_id for another recipient
+        await sender.send_json_to({**self.send("1"), "recipient_id": other.id})
+        second = await sender.receive_json_from()
+        self.assertNotEqual(second["id"], first["id"])
+
+        # and without this worker's memory of the acks, a retry still finds its own message
+        recent_sends.entries.clear()
+        await sender.send_json_to({**self.send("1"), "recipient_id": other.id})
+        self.assertEqual(await sender.receive_json_from(), second)
+        self.assertEqual(
+            sorted([recipient async for recipient in Message.objects.values_list("recipient_id", flat=True)]),
+            sorted([self.recipient.id, other.id]),
+        )
+
+        await sender.disconnect()
+
+
+class RoomTests(TestCase):
+    def setUp(self):
+        self.owner, self.alice, self.bob, self.outsider = [User.objects.create(username=name) for name in ("owner", "alice", "bob", "outsider")]
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        response = self.client.post("/api/chat/rooms/", {"name": "team", "member_ids": [self.alice.id, self.bob.id]}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.room = Room.objects.get(id=response.json()["id"])
+
+    def as_user(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def rooms_of(self, user):
+        return {entry["room"]["id"]: entry for entry in self.as_user(user).get("/api/chat/rooms/").json()["rooms"]}
+
+    def test_create_adds_the_creator_and_tells_each_member(self):
+        self.assertEqual(set(self.room.members.values_list("id", flat=True)), {self.owner.id, self.alice.id, self.bob.id})
+        events = OutboxEvent.objects.filter(message__type="room_joined_handler")
+        self.assertEqual({event.group for event in events}, {f"user_{user.id}" for user in (self.owner, self.alice, self.bob)})
+
+        response = self.client.post("/api/chat/rooms/", {"name": "ghosts", "member_ids": [999999]}, format="json")
+        self.assertEqual(response.status_code, 404)
+
+    def test_only_members_see_the_room(self):
+        self.assertEqual(self.as_user(self.outsider).get(f"/api/chat/rooms/{self.room.id}/").status_code, 404)
+        self.assertNotIn(self.room.id, self.rooms_of(self.outsider))
+
+        self.as_user(self.alice).post(f"/api/chat/rooms/{self.room.id}/members/", {"user_ids": [self.outsider.id]}, format="json")
+        self.assertEqual(self.as_user(self.outsider).get(f"/api/chat/rooms/{self.room.id}/").status_code, 200)
+
+        self.as_user(self.outsider).delete(f"/api/chat/rooms/{self.room.id}/members/")
+        self.assertEqual(self.as_user(self.outsider).get(f"/api/chat/rooms/{self.room.id}/").status_code, 404)
+
+    def test_unread_counts_messages_from_others_above_the_watermark(self):
+        for user in (self.alice, self.alice, self.bob, self.owner):
+            RoomMessage.objects.create(room=self.room, sender=user, message=f"from {user.username}")
+
+        self.assertEqual(self.rooms_of(self.owner)[self.room.id]["unread_count"], 3)
+        self.assertEqual(self.rooms_of(self.alice)[self.room.id]["unread_count"], 2)
+        self.assertEqual(self.rooms_of(self.alice)[self.room.id]["last_message"]["message"], "from owner")
+
+        self.as_user(self.alice).post(f"/api/chat/rooms/{self.room.id}/mark-read/")
+        self.assertEqual(self.rooms_of(self.alice)[self.room.id]["unread_count"], 0)
+        self.assertEqual(self.rooms_of(self.bob)[self.room.id]["unread_count"], 3)
+
+    def test_watermark_only_moves_forward_and_stops_at_the_newest_message(self):
+        first, second = [RoomMessage.objects.create(room=self.room, sender=self.alice, message=text) for text in ("one", "two")]
+        url = f"/api/chat/rooms/{self.room.id}/mark-read/"
+
+        self.assertEqual(self.client.post(url, {"message_id": second.id}, format="json").json()["last_read_message_id"], second.id)
+        self.assertEqual(self.client.post(url, {"message_id": first.id}, format="json").json()["last_read_message_id"], second.id)
+
+        # a client can't mark messages that don't exist yet as read
+        self.assertEqual(self.client.post(url, {"message_id": second.id + 1000}, format="json").json()["last_read_message_id"], second.id)
+        RoomMessage.objects.create(room=self.room, sender=self.alice, message="three")
+        self.assertEqual(self.rooms_of(self.owner)[self.room.id]["unread_count"], 1)
+
+        self.assertEqual(self.client.post(url, {"message_id": "latest"}, format="json").status_code, 400)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class RoomFanOutTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f"member{i}") for i in range(3)]
+        self.room = Room.objects.create(name="team", created_by=self.users[0])
+        RoomMembership.objects.bulk_create([RoomMembership(room=self.room, user=user) for user in self.users])
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = SessionUser.from_user(user)
+        self.assertTrue((await communicator.connect())[0])
+        self.assertEqual((await communicator.receive_json_from())["type"], "connection")
+        return communicator
+
+    async def test_room_message_is_one_group_send_to_every_other_member(self):
+        sender, *others = [await self.connect(user) for user in self.users]
+        layer = get_channel_layer()
+
+        with mock.patch.object(layer, "group_send", wraps=layer.group_send) as group_send:
+            await sender.send_json_to({"type": "room_message", "room_id": self.room.id, "message": "hello", "temp_id": "t1"})
+            ack = await sender.receive_json_from()
+            received = [await other.receive_json_from() for other in others]
+
+        self.assertEqual((ack["type"], ack["temp_id"]), ("message_sent", "t1"))
+        self.assertEqual(group_send.call_count, 1)
+        self.assertEqual(group_send.call_args.args[0], f"room_{self.room.id}")
+        for frame in received:
+            self.assertEqual((frame["type"], frame["id"], frame["message"]), ("room_message", ack["id"], "hello"))
+        # the sender has its ack, not a copy
+        self.assertTrue(await sender.receive_nothing())
+        self.assertEqual(await RoomMessage.objects.acount(), 1)
+
+        for communicator in (sender, *others):
+            await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ConsumerBackpressureTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="sender")
+        self.recipient = User.objects.create(username="recipient")
+        Friendship.objects.create(user1=self.sender, user2=self.recipient)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = SessionUser.from_user(user)
+        self.assertTrue((await communicator.connect())[0])
+        return communicator
+
+    @override_settings(REALTIME_THROTTLE_RATES={"connection": {"default": (0.01, 2)}, "user": {"default": (0.01, 10)}})
+    async def test_burst_over_the_token_bucket_is_rejected(self):
+        communicator = await self.connect(self.sender)
+        self.assertEqual((await communicator.receive_json_from())["type"], "connection")
+
+        for temp_id in ("a", "b", "c"):
+            await communicator.send_json_to({"type": "chat_message", "recipient_id": self.recipient.id, "message": "hi", "temp_id": temp_id})
+        frames = [await communicator.receive_json_from() for _ in range(3)]
+
+        self.assertEqual([frame["type"] for frame in frames], ["message_sent", "message_sent", "error"])
+        self.assertEqual((frames[2]["code"], frames[2]["temp_id"]), ("throttled", "c"))
+        self.assertGreater(frames[2]["retry_after"], 0)
+        self.assertEqual(await Message.objects.acount(), 2)
+
+        # heartbeats aren't charged, an empty bucket or not
+        await communicator.send_json_to({"type": "ping"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "pong"})
+        await communicator.disconnect()
+
+    @override_settings(REALTIME_OUTBOUND_QUEUE={"shed_at": 4, "close_at": 8, "presence_linger": 0})
+    async def test_overfull_outbound_queue_closes_the_socket(self):
+        stalled = asyncio.Event()
+
+        async def stalled_write(consumer, data):
+            # a server whose send() waits for the socket to drain, and a client that stopped reading
+            await stalled.wait()
+            return True
+
+        with mock.patch.object(RealtimeConsumer, "write_frame", stalled_write):
+            communicator = await self.connect(self.recipient)
+            for n in range(20):
+                await get_channel_layer().group_send(f"user_{self.recipient.id}", {"type": "chat_message_handler", "data": {"type": "chat_message", "n": n}})
+
+            closed = await communicator.receive_output(timeout=1)
+            self.assertEqual((closed["type"], closed["code"]), ("websocket.close", SLOW_CONSUMER_CLOSE_CODE))
+            await communicator.disconnect()
+
+
+class EphemeralCoalescerTests(SimpleTestCase):
+    def test_repeats_go_out_once_per_min_interval(self):
+        coalescer = EphemeralCoalescer(min_interval=3, max_entries=10)
+        with mock.patch("chats.ephemeral.time.monotonic") as monotonic:
+            sent = []
+            for now, event in ((0, "typing"), (1, "typing"), (2.9, "typing"), (3.1, "typing"), (3.2, "stopped_typing"), (3.3, "typing")):
+                monotonic.return_value = now
+                sent.append(coalescer.should_send(1, 2, event))
+            # another recipient is coalesced on its own
+            self.assertTrue(coalescer.should_send(1, 3, "typing"))
+
+        self.assertEqual(sent, [True, False, False, True, True, True])
+
+    def test_entries_are_bounded(self):
+        coalescer = EphemeralCoalescer(min_interval=3, max_entries=2)
+        for recipient_id in (2, 3, 4):
+            coalescer.should_send(1, recipient_id, "typing")
+        self.assertEqual(list(coalescer.entries), [(1, 3), (1, 4)])
+        # the evicted pair starts over
+        self.assertTrue(coalescer.should_send(1, 2, "typing"))
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    REALTIME_EPHEMERAL={"min_interval": 3, "ttl": 0.2},
+)
+class EphemeralRelayTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create(username="typist")
+        self.recipient = User.objects.create(username="reader")
+        coalescer.entries.clear()
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = SessionUser.from_user(user)
+        self.assertTrue((await communicator.connect())[0])
+        self.assertEqual((await communicator.receive_json_from())["type"], "connection")
+        return communicator
+
+    async def test_typing_is_coalesced_and_expires_to_stopped_typing(self):
+        recipient = await self.connect(self.recipient)
+        sender = await self.connect(self.sender)
+
+        for _ in range(5):
+            await sender.send_json_to({"type": "typing", "recipient_id": self.recipient.id})
+        self.assertEqual(await recipient.receive_json_from(), {"type": "typing", "user_id": self.sender.id})
+
+        # not refreshed within the ttl: the recipient's side ends it
+        self.assertEqual(await recipient.receive_json_from(timeout=1), {"type": "stopped_typing", "user_id": self.sender.id})
+        self.assertTrue(await recipient.receive_nothing(timeout=0.3))
+
+        await sender.disconnect()
+        await recipient.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class BroadcastTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f"user{i}") for i in range(3)]
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = SessionUser.from_user(user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())["type"], "connection")
+        return communicator
+
+    async def test_broadcast_reaches_its_audience(self):
+        communicators = [await self.connect(user) for user in self.users]
+        layer = get_channel_layer()
+
+        await layer.group_send(BROADCAST_GROUP, broadcast_event("maintenance", {"at": "02:00"}))
+        for communicator in communicators:
+            frame = await communicator.receive_json_from()
+            self.assertEqual((frame["type"], frame["kind"], frame["payload"]), ("broadcast", "maintenance", {"at": "02:00"}))
+
+        audience = {"user_ids": [self.users[0].id, self.users[1].id], "exclude_user_ids": [self.users[1].id]}
+        await layer.group_send(BROADCAST_GROUP, broadcast_event("feature_flags", {"dark_mode": True}, audience))
+        self.assertEqual((await communicators[0].receive_json_from())["kind"], "feature_flags")
+        self.assertTrue(await communicators[1].receive_nothing())
+        self.assertTrue(await communicators[2].receive_nothing())
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def test_unencodable_frame_does_not_stop_the_writer(self):
+        communicator = await self.connect(self.users[0])
+        layer = get_channel_layer()
+
+        await layer.group_send(BROADCAST_GROUP, broadcast_event("flags", {"ids": {1, 2}}))
+        await layer.group_send(BROADCAST_GROUP, broadcast_event("maintenance", {"at": "02:00"}))
+        self.assertEqual((await communicator.receive_json_from())["kind"], "maintenance")
+        await communicator.disconnect()
+
+    def test_staff_endpoint_publishes_one_event(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        self.assertEqual(client.post("/api/chat/broadcast/", {"kind": "maintenance"}, format="json").status_code, 403)
+
+        self.users[0].is_staff = True
+        self.users[0].save()
+        response = client.post("/api/chat/broadcast/", {"kind": "maintenance", "audience": {"percent": 150}}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+        response = client.post("/api/chat/broadcast/", {"kind": "maintenance", "payload": {"at": "02:00"}, "audience": {"percent": 10}}, format="json")
+        self.assertEqual(response.status_code, 200)
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.group, BROADCAST_GROUP)
+        self.assertEqual((event.message["broadcast_id"], event.message["audience"]), (response.json()["broadcast_id"], {"percent": 10}))
+
+
+class BroadcastFanOutTests(SimpleTestCase):
+    def test_audience_filters(self):
+        audience = audience_of(broadcast_event("flags", audience={"percent": 25, "exclude_user_ids": [110]}))
+        self.assertEqual([user_id for user_id in (5, 24, 25, 99, 110, 124) if audience.includes(user_id)], [5, 24, 124])
+        for invalid in ({"percent": True}, {"user_ids": "1,2"}, {"everyone": True}, []):
+            with self.assertRaises(ValueError):
+                parse_audience(invalid)
+
+    def test_hybrid_layer_hands_a_broadcast_to_local_members(self):
+        layer = HybridChannelLayer(hosts=[("127.0.0.1", 6379)])
+        members = {f"specific.{layer.client_prefix}!{i}" for i in range(3)}
+        layer.local_groups[BROADCAST_GROUP] = set(members)
+
+        self.assertFalse(layer.deliver_broadcast(f"specific.{layer.client_prefix}!0", {"type": "broadcast_handler"}))
+        self.assertTrue(layer.deliver_broadcast(layer.broadcast_channel(BROADCAST_GROUP), {"type": "broadcast_handler"}))
+        self.assertEqual({channel for channel in members if layer.receive_buffer[channel].qsize() == 1}, members)
+
+
+class FakeRedis:
+    """Just the group reads HybridChannelLayer makes, counting them"""
+
+    def __init__(self, members):
+        self.members = members
+        self.reads = 0
+
+    def pipeline(self):
+        return self
+
+    def zremrangebyscore(self, *args, **kwargs):
+        pass
+
+    def zrange(self, *args):
+        pass
+
+    async def execute(self):
+        self.reads += 1
+        return [0, [member.encode() for member in self.members]]
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+    def layer(self, remote_members=(), **config):
+        layer = HybridChannelLayer(hosts=[("127.0.0.1", 6379)], **config)
+        layer.redis = FakeRedis(list(remote_members))
+        layer.connection = lambda index: layer.redis
+        layer.send_to_remote_channels = mock.AsyncMock()
+        return layer
+
+    async def test_group_without_remote_members_is_read_from_redis_once_per_ttl(self):
+        layer = self.layer(membership_ttl=60)
+        local = f"specific.{layer.client_prefix}!1"
+        layer.local_groups["user_1"].add(local)
+        # our own listing in Redis is not a remote member
+        layer.redis.members.append(local)
+
+        for _ in range(3):
+            await layer.group_send("user_1", {"type": "hello"})
+        self.assertEqual(layer.receive_buffer[local].qsize(), 3)
+        self.assertEqual(layer.redis.reads, 1)
+        layer.send_to_remote_channels.assert_not_called()
+
+    async def test_remote_members_get_the_redis_delivery(self):
+        layer = self.layer(["specific.otherworker!7"], membership_ttl=0)
+        await layer.group_send("user_7", {"type": "hello"})
+        await layer.group_send("user_7", {"type": "hello"})
+        self.assertEqual(layer.redis.reads, 2)
+        layer.send_to_remote_channels.assert_awaited_with("user_7", ["specific.otherworker!7"], {"type": "hello"})
+
+    async def test_member_joining_on_another_worker_gets_the_next_send(self):
+        layer = self.layer()
+        await layer.group_send("user_7", {"type": "hello"})
+        layer.send_to_remote_channels.assert_not_called()
+
+        # another worker's group_add lands in Redis; the very next send must reach it
+        layer.redis.members.append("specific.otherworker!7")
+        await layer.group_send("user_7", {"type": "hello"})
+        layer.send_to_remote_channels.assert_awaited_once_with("user_7", ["specific.otherworker!7"], {"type": "hello"})
+
+    async def test_configured_user_groups_skip_redis_for_local_only_sends(self):
+        config = {key: value for key, value in settings.CHANNEL_LAYERS["default"]["CONFIG"].items() if key != "hosts"}
+        layer = self.layer(**config)
+        local = f"specific.{layer.client_prefix}!1"
+        layer.local_groups["user_1"].add(local)
+        layer.local_groups["room_1"].add(local)
+
+        await layer.group_send("user_1", {"type": "hello"})
+        reads = layer.redis.reads
+        # within the ttl, a send to a user connected only here never reaches Redis
+        await layer.group_send("user_1", {"type": "hello"})
+        self.assertEqual(layer.redis.reads, reads)
+        self.assertEqual(layer.receive_buffer[local].qsize(), 2)
+
+        # rooms are read every time
+        await layer.group_send("room_1", {"type": "hello"})
+        await layer.group_send("room_1", {"type": "hello"})
+        self.assertEqual(layer.redis.reads, reads + 2)
+        layer.send_to_remote_channels.assert_not_called()
+
+    def test_hash_ring_is_opt_in(self):
+        hosts = [("127.0.0.1", 6379), ("127.0.0.2", 6379), ("127.0.0.3", 6379)]
+        stock = RedisChannelLayer(hosts=hosts)
+        default, ring = HybridChannelLayer(hosts=hosts), HybridChannelLayer(hosts=hosts, hash_ring=True)
+        groups = [f"user_{user_id}" for user_id in range(50)]
+        self.assertEqual([default.consistent_hash(group) for group in groups], [stock.consistent_hash(group) for group in groups])
+        self.assertEqual([ring.consistent_hash(group) for group in groups], [ring.ring.get(group) for group in groups])
+
+    async def test_broadcast_listing_is_refreshed_while_there_are_local_members(self):
+        layer = self.layer(group_expiry=0.02)
+        channel = f"specific.{layer.client_prefix}!1"
+        with mock.patch.object(RedisChannelLayer, "group_add") as group_add, mock.patch.object(RedisChannelLayer, "group_discard"):
+            await layer.group_add(BROADCAST_GROUP, channel)
+            await asyncio.sleep(0.1)
+            self.assertGreater(group_add.await_count, 2)
+            group_add.assert_awaited_with(BROADCAST_GROUP, layer.broadcast_channel(BROADCAST_GROUP))
+
+            await layer.group_discard(BROADCAST_GROUP, channel)
+            refreshed = group_add.await_count
+            await asyncio.sleep(0.05)
+            self.assertEqual(group_add.await_count, refreshed)
+            self.assertEqual(layer.broadcast_refreshers, {})
+
+
+class CompactCodecTests(SimpleTestCase):
+    def roundtrip(self, data):
+        codec = CompactCodec(compress_threshold=None)
+        return codec.decode(**codec.encode(data))
+
+    def test_frame_timestamps_become_epoch_milliseconds(self):
+        frame = {"type": "user_status", "user_id": 7, "is_online": True, "timestamp": "2026-01-01T00:00:00+00:00"}
+        self.assertEqual(self.roundtrip(frame), dict(frame, timestamp=1767225600000))
+
+    def test_payloads_are_sent_as_given(self):
+        data = broadcast_event("maintenance", {"timestamp": "Sunday 02:00 UTC", "type": "chat_message", "at": "2026-01-01T00:00:00"})["data"]
+        decoded = self.roundtrip(data)
+        self.assertEqual(decoded["payload"], {"timestamp": "Sunday 02:00 UTC", "type": "chat_message", "at": "2026-01-01T00:00:00"})
+        self.assertIsInstance(decoded["timestamp"], int)
+
+    def test_unparseable_timestamp_passes_through(self):
+        self.assertEqual(self.roundtrip({"type": "error", "timestamp": "soon"})["timestamp"], "soon")
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def status(self, user_id, is_online):
+        return {"type": "user_status", "user_id": user_id, "is_online": is_online, "timestamp": "2026-01-01T00:00:00+00:00"}
+
+    async def drain(self, queue):
+        frames = []
+        while len(queue):
+            frames.append(await queue.get())
+        return frames
+
+    async def test_chat_goes_before_friend_events_before_presence(self):
+        queue = OutboundQueue(presence_linger=0)
+        queue.put(self.status(1, True), lane=LANE_PRESENCE)
+        queue.put({"type": "friend_request"}, lane=LANE_EVENTS)
+        queue.put({"type": "chat_message", "id": 1})
+        queue.put({"type": "chat_message", "id": 2})
+
+        frames = await self.drain(queue)
+        self.assertEqual([frame["type"] for frame in frames], ["chat_message", "chat_message", "friend_request", "user_status"])
+        self.assertEqual([frames[0]["id"], frames[1]["id"]], [1, 2])
+
+    async def test_presence_is_coalesced_into_one_batch(self):
+        queue = OutboundQueue(presence_linger=0.05)
+        for user_id in range(50):
+            queue.put(self.status(user_id, True), lane=LANE_PRESENCE)
+        queue.put(self.status(7, False), lane=LANE_PRESENCE)
+        self.assertEqual(len(queue), 50)
+
+        batch = await queue.get()
+        self.assertEqual(batch["type"], "user_status_batch")
+        self.assertEqual(len(batch["statuses"]), 50)
+        self.assertEqual(batch["statuses"][7], {"user_id": 7, "is_online": False, "timestamp": "2026-01-01T00:00:00+00:00"})
+        self.assertEqual(len(queue), 0)
+
+    def test_queued_presence_is_shed_for_chat(self):
+        queue = OutboundQueue(shed_at=4, close_at=10)
+        for user_id in range(4):
+            queue.put(self.status(user_id, True), lane=LANE_PRESENCE)
+
+        # nothing else sheddable is queued: the presence itself has to go
+        queue.put({"type": "chat_message", "id": 1})
+        self.assertEqual((len(queue), queue.dropped), (1, 4))
+
+    def test_queue_is_only_rescanned_when_crossing_a_shed_level(self):
+        queue = OutboundQueue(shed_at=10, close_at=100)
+        for n in range(5):
+            queue.put({"type": "chat_message", "id": n})
+        with mock.patch.object(queue, "_shed", wraps=queue._shed) as shed:
+            # past shed_at // 2: presence is still taken, without a scan per frame
+            for user_id in range(5):
+                queue.put(self.status(user_id, True), lane=LANE_PRESENCE)
+            self.assertEqual(shed.call_count, 0)
+
+            # reaching shed_at sheds the queued presence once
+            queue.put({"type": "chat_message", "id": 5})
+            queue.put({"type": "chat_message", "id": 6})
+            self.assertEqual(shed.call_count, 1)
+        self.assertEqual((len(queue), queue.dropped), (7, 5))
+
+    async def test_chat_does_not_wait_for_lingering_presence(self):
+        queue = OutboundQueue(presence_linger=10)
+        queue.put(self.status(1, True), lane=LANE_PRESENCE)
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        queue.put({"type": "chat_message", "id": 1})
+        self.assertEqual((await asyncio.wait_for(getter, 1))["type"], "chat_message")
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ConversationHistoryCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="me")
+        cls.friend = User.objects.create(username="friend")
+        Friendship.objects.create(user1=cls.user, user2=cls.friend)
+        for i in range(60):
+            sender, recipient = (cls.friend, cls.user) if i % 2 else (cls.user, cls.friend)
+            Message.objects.create(sender=sender, recipient=recipient, message=f"m{i}")
+
+    def setUp(self):
+        caches["default"].clear()
+        conversation_history.local.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f"/api/chat/{self.friend.id}/"
+
+    def history(self):
+        return self.client.get(self.url).json()["messages"]
+
+    def test_first_page_is_served_without_the_database(self):
+        loaded = self.history()
+        self.assertEqual(len(loaded), 50)
+        hits = conversation_history.hits
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.history(), loaded)
+        self.assertEqual(conversation_history.hits, hits + 1)
+
+    def test_stored_messages_are_appended_to_the_cached_page(self):
+        self.history()
+        message = Message.objects.create(sender=self.friend, recipient=self.user, message="new")
+        conversation_history.append(message, MessageSerializer(message).data)
+
+        with self.assertNumQueries(0):
+            messages = self.history()
+        self.assertEqual(len(messages), 50)
+        self.assertEqual([m["message"] for m in messages[-2:]], ["m59", "new"])
+        conversation_history.local.clear()
+        self.assertEqual(messages, self.history())
+
+    def test_page_loaded_between_commit_and_append_keeps_the_message_once(self):
+        message = Message.objects.create(sender=self.friend, recipient=self.user, message="new")
+        # the page is read from the database after the commit, before the sender's append bumps the version
+        loaded = self.history()
+        conversation_history.append(message, MessageSerializer(message).data)
+
+        with self.assertNumQueries(0):
+            messages = self.history()
+        self.assertEqual([m["id"] for m in messages], [m["id"] for m in loaded])
+        self.assertEqual([m["message"] for m in messages].count("new"), 1)
+
+    def test_marking_read_updates_the_cached_page(self):
+        self.assertFalse(all(m["is_read"] for m in self.history()))
+        self.client.post(f"/api/chat/{self.friend.id}/mark-read/")
+
+        with self.assertNumQueries(0):
+            messages = self.history()
+        self.assertTrue(all(m["is_read"] for m in messages if m["sender"]["id"] == self.friend.id))
+
+    def test_change_through_another_worker_is_a_miss(self):
+        self.history()
+        Message.objects.filter(sender=self.friend).update(is_read=True)
+        ConversationHistoryCache().mark_read(self.user.id, self.friend.id)
+
+        misses = conversation_history.misses
+        self.assertTrue(all(m["is_read"] for m in self.history() if m["sender"]["id"] == self.friend.id))
+        self.assertEqual(conversation_history.misses, misses + 1)
+
+
+@override_settings(MESSAGE_SHARDS=["default", "messages_1", "messages_2"])
+class MessageShardingTests(SimpleTestCase):
+    def test_both_directions_of_a_conversation_share_a_shard(self):
+        shards = {shard_for(a, b) for a in range(1, 40) for b in range(1, 40) if a != b}
+        self.assertEqual(shards, {"default", "messages_1", "messages_2"})
+        for a, b in ((1, 2), (17, 3), (250, 9)):
+            self.assertEqual(shard_for(a, b), shard_for(b, a))
+
+    def test_adding_a_shard_only_moves_conversations_to_it(self):
+        pairs = [(a, b) for a in range(1, 60) for b in range(a + 1, 60)]
+        before = {pair: shard_for(*pair) for pair in pairs}
+        after = {pair: shard_for(*pair, shards=["default", "messages_1", "messages_2", "messages_3"]) for pair in pairs}
+        moved = {pair for pair in pairs if before[pair] != after[pair]}
+        self.assertTrue(moved)
+        self.assertEqual({after[pair] for pair in moved}, {"messages_3"})
+        self.assertLess(len(moved), len(pairs) / 2)
+
+    def test_router_keeps_messages_on_their_shard_and_users_on_default(self):
+        router = MessageShardRouter()
+        message = Message(sender_id=1, recipient_id=2, message="hi")
+        self.assertEqual(router.db_for_write(Message, instance=message), shard_for(1, 2))
+
+        message._state.db = "messages_2"
+        self.assertEqual(router.db_for_write(Message.attachments.through, instance=message), "messages_2")
+        self.assertEqual(router.db_for_read(User, instance=message), "default")
+        self.assertIsNone(router.db_for_read(Message))
+
+        self.assertTrue(router.allow_migrate("messages_1", "chats", "message"))
+        self.assertTrue(router.allow_migrate("messages_1", "chats", "message_attachments"))
+        self.assertFalse(router.allow_migrate("messages_1", "chats", "room"))
+        self.assertFalse(router.allow_migrate("messages_1", "accounts", None))
+        self.assertIsNone(router.allow_migrate("default", "chats", "room"))
+
+
+class MessageIdTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="user")
+        self.friend = User.objects.create(username="friend")
+
+    def test_ids_come_from_blocks_above_existing_messages(self):
+        existing = Message.objects.create(sender=self.user, recipient=self.friend, message="before")
+        IdBlock.objects.all().delete()
+
+        allocator = IdAllocator("test", "chats.Message", block_size=3)
+        self.assertEqual(allocator.take(2), [existing.id + 1, existing.id + 2])
+        self.assertEqual(allocator.take(2), [existing.id + 3, existing.id + 4])
+        # a second process reserves its own block
+        self.assertEqual(IdAllocator("test", "chats.Message", block_size=3).next(), existing.id + 7)
+        self.assertEqual(allocator.next(), existing.id + 5)
+        self.assertEqual(IdBlock.objects.get(name="test").next_id, existing.id + 10)
+
+    def test_forked_process_does_not_reuse_the_parents_block(self):
+        allocator = IdAllocator("test", "chats.Message", block_size=10)
+        first = allocator.next()
+        allocator.pid = -1
+        self.assertEqual(allocator.next(), first + 10)
+
+    def test_saved_and_bulk_created_messages_get_allocated_ids(self):
+        saved = Message.objects.create(sender=self.user, recipient=self.friend, message="saved")
+        bulk = Message.objects.bulk_create([Message(sender=self.user, recipient=self.friend, message=str(n)) for n in range(3)])
+        ids = [saved.id, *(message.id for message in bulk)]
+        self.assertEqual(len(set(ids)), 4)
+        self.assertEqual(set(Message.objects.values_list("id", flat=True)), set(ids))
+
+    def test_deleting_a_user_deletes_their_messages_on_other_shards(self):
+        other = User.objects.create(username="other")
+        Message.objects.create(sender=self.user, recipient=self.friend, message="sent")
+        Message.objects.create(sender=self.friend, recipient=self.user, message="received")
+        kept = Message.objects.create(sender=self.friend, recipient=other, message="kept")
+
+        # as if the user were deleted on another database: the receiver clears "default"
+        delete_user_messages(User, self.user, using="users")
+        self.assertEqual(list(Message.objects.all()), [kept])
+
+
+
+class MessageIdReservationTests(TransactionTestCase):
+    def test_a_rolled_back_send_does_not_give_its_block_back(self):
+        user = User.objects.create(username="user")
+        friend = User.objects.create(username="friend")
+        # stored with an explicit id, so no block is reserved yet
+        Message.objects.create(id=1, sender=user, recipient=friend, message="first", temp_id="dup")
+
+        allocator = IdAllocator("chats.message", "chats.Message", block_size=10)
+        with mock.patch("chats.consumers.message_ids", allocator), mock.patch("chats.sharding.message_ids", allocator):
+            # the duplicate temp_id rolls the send's transaction back
+            message, created = async_to_sync(RealtimeConsumer().save_message)(user.id, friend, "again", temp_id="dup")
+        self.assertEqual((message.id, created), (1, False))
+
+        # the rest of our block stays ours: another process reserves past it
+        ours = allocator.next()
+        self.assertGreaterEqual(IdAllocator("chats.message", "chats.Message", block_size=10).next(), ours + 9)
+
+    def test_ids_are_not_reserved_inside_a_transaction(self):
+        allocator = IdAllocator("test", "chats.Message")
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            allocator.next()
+
+class SeedDatasetTests(TestCase):
+    def seed(self, **options):
+        call_command("seed_dataset", users=30, messages=200, mean_friends=3, pending=1, stdout=StringIO(), **options)
+
+    def test_clear_replaces_seeded_users_only(self):
+        self.seed()
+        self.assertEqual(User.objects.filter(email__endswith=f"@{SEED_EMAIL_DOMAIN}").count(), 30)
+        self.assertEqual(Message.objects.count(), 200)
+        bystander = User.objects.create(username="bystander", email="bystander@example.com")
+
+        self.seed(clear=True)
+        self.assertEqual(User.objects.filter(username__startswith="seed").count(), 30)
+        self.assertEqual(Message.objects.count(), 200)
+        self.assertTrue(User.objects.filter(id=bystander.id).exists())
+
+    def test_clear_refuses_users_it_did_not_seed(self):
+        self.seed()
+        real = User.objects.create(username="seedling", email="seedling@example.com")
+
+        with self.assertRaisesMessage(CommandError, "1 users named seed* were not created by seed_dataset"):
+            self.seed(clear=True)
+        self.assertTrue(User.objects.filter(id=real.id).exists())
+        self.assertEqual(User.objects.filter(username__startswith="seed").count(), 31)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class WebsocketProfilingTests(TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(PROFILING={**settings.PROFILING, "enabled": True, "directory": directory.name})
+        override.enable()
+        self.addCleanup(override.disable)
+        install_profiling()
+
+        self.sender = User.objects.create(username="sender")
+        self.recipient = User.objects.create(username="recipient")
+
+    async def test_toggled_user_gets_a_profile_per_frame(self):
+        communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = SessionUser.from_user(self.sender)
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await get_channel_layer().group_send(f"user_{self.sender.id}", {"type": "profiling_handler", "enabled": True})
+        await communicator.send_json_to({"type": "chat_message", "recipient_id": self.recipient.id, "message": "hi", "temp_id": 1})
+        self.assertEqual((await communicator.receive_json_from())["type"], "message_sent")
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame["type"], frame["event"]), ("profile", "chat_message"))
+        profile = load_profile(frame["profile_id"])
+        self.assertEqual(profile["user_id"], self.sender.id)
+        self.assertTrue(any(query["sql"].startswith("INSERT") for query in profile["queries"]))
+
+        await get_channel_layer().group_send(f"user_{self.sender.id}", {"type": "profiling_handler", "enabled": False})
+        await communicator.send_json_to({"type": "ping"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "pong"})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class HeartbeatTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="phone")
+        self.friend = User.objects.create(username="friend")
+        Friendship.objects.create(user1=self.user, user2=self.friend)
+        self.saved = heartbeats.interval, heartbeats.timeout
+        heartbeats.interval, heartbeats.timeout = 0.05, 0.2
+
+    def tearDown(self):
+        heartbeats.interval, heartbeats.timeout = self.saved
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(RealtimeConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = SessionUser.from_user(user)
+        self.assertTrue((await communicator.connect())[0])
+        await communicator.receive_json_from()
+        return communicator
+
+    async def test_ping_is_answered(self):
+        communicator = await self.connect(self.user)
+        await communicator.send_json_to({"type": "ping"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "pong"})
+        await communicator.disconnect()
+
+    async def test_silent_connection_is_reaped_and_goes_offline(self):
+        friend = await self.connect(self.friend)
+        phone = await self.connect(self.user)
+        self.assertEqual((await self.receive_status(friend))["is_online"], True)
+        reaped = heartbeats.reaped
+
+        # the friend keeps answering; the phone went silent
+        self.assertEqual(await phone.receive_json_from(timeout=1), {"type": "ping"})
+        closed = None
+        while closed is None:
+            await friend.send_json_to({"type": "pong"})
+            output = await phone.receive_output(timeout=1)
+            if output["type"] == "websocket.close":
+                closed = output
+
+        self.assertEqual(closed["code"], HEARTBEAT_TIMEOUT_CLOSE_CODE)
+        self.assertEqual(heartbeats.reaped, reaped + 1)
+        status = await self.receive_status(friend)
+        self.assertEqual((status["user_id"], status["is_online"]), (self.user.id, False))
+        self.assertFalse((await User.objects.aget(id=self.user.id)).is_online)
+
+        # the late disconnect doesn't clean up a second time
+        await phone.disconnect()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.receive_status(friend), 0.3)
+        await friend.disconnect()
+
+    async def test_any_frame_counts_as_alive(self):
+        phone = await self.connect(self.user)
+        reaped = heartbeats.reaped
+
+        # a client that never answers pings but keeps typing, for well past the timeout
+        deadline = asyncio.get_running_loop().time() + heartbeats.timeout * 3
+        while asyncio.get_running_loop().time() < deadline:
+            await phone.send_json_to({"type": "typing", "recipient_id": self.friend.id})
+            # a timed-out receive_output() would cancel the consumer, so peek first
+            if not await phone.receive_nothing(timeout=heartbeats.interval):
+                self.assertNotEqual((await phone.receive_output())["type"], "websocket.close")
+
+        self.assertEqual(heartbeats.reaped, reaped)
+        await phone.disconnect()
+
+    async def receive_status(self, communicator):
+        while (frame := await communicator.receive_json_from())["type"] == "ping":
+            await communicator.send_json_to({"type": "pong"})
+        return frame
+
+    async def test_other_connection_keeps_user_online(self):
+        first = await self.connect(self.user)
+        second = await self.connect(self.user)
+        await first.disconnect()
+        self.assertTrue((await User.objects.aget(id=self.user.id)).is_online)
+        await second.disconnect()
+        self.assertFalse((await User.objects.aget(id=self.user.id)).is_online)
+
+
+urlpatterns = [
+    path("sync/recent/", views.recent_chats),
+    path("async/recent/", async_views.recent_chats),
+    path("sync/<int:friend_id>/", views.chat_history),
+    path("async/<int:friend_id>/", async_views.chat_history),
+]
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+)
+class WorkerStartupTests(TestCase):
+    async def downstream(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    def probe(self, application, path="/ready/"):
+        return HttpCommunicator(application, "GET", path).get_response()
+
+    async def test_ready_only_once_every_stage_warmed(self):
+        attempts = []
+
+        def redis_coming_up():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionError("connection refused")
+
+        startup = WorkerStartup(stages=[("databases", lambda: None), ("channel layer", redis_coming_up)])
+        application = StartupMiddleware(self.downstream, startup)
+
+        # the first probe starts the warm-up and is answered before it finishes
+        self.assertEqual((await self.probe(application))["status"], 503)
+        await startup.task
+        self.assertEqual(startup.stages["channel layer"]["error"], "ConnectionError: connection refused")
+        response = await self.probe(application)
+        self.assertEqual(response["status"], 503)
+        # the probe is unauthenticated: stage names and outcome only, never the exception
+        self.assertEqual(json.loads(response["body"])["stages"]["channel layer"]["ok"], False)
+        self.assertNotIn(b"refused", response["body"])
+        self.assertNotIn(b"ConnectionError", response["body"])
+
+        # the failed stage is retried, the others are not
+        await startup.task
+        response = await self.probe(application)
+        self.assertEqual((response["status"], len(attempts)), (200, 2))
+        self.assertEqual(list(json.loads(response["body"])["stages"]), ["databases", "channel layer"])
+        self.assertEqual((await self.probe(application, "/api/chat/recent/"))["status"], 204)
+
+    def test_default_stages_warm(self):
+        startup = WorkerStartup(stages=WARM_STAGES)
+        self.assertTrue(async_to_sync(startup.warm)())
+        self.assertEqual([name for name, stage in startup.stages.items() if stage["error"]], [])
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="me")
+        friends = [User.objects.create(username=f"friend{i}") for i in range(3)]
+        for i, friend in enumerate(friends):
+            Friendship.objects.create(user1=cls.user, user2=friend)
+            for j in range(i + 1):
+                Message.objects.create(sender=friend, recipient=cls.user, message=f"{i}.{j}")
+        Message.objects.create(sender=cls.user, recipient=friends[0], message="reply")
+        cls.friend = friends[0]
+        cls.headers = {"Authorization": f"Bearer {RefreshToken.for_user(cls.user).access_token}"}
+
+    async def test_async_views_answer_like_sync_ones(self):
+        client = AsyncClient()
+        for url in ("recent/", f"{self.friend.id}/"):
+            sync_response = await client.get(f"/sync/{url}", headers=self.headers)
+            async_response = await client.get(f"/async/{url}", headers=self.headers)
+            self.assertEqual(async_response.status_code, 200)
+            self.assertEqual(async_response.json(), sync_response.json())
+
+        chats = (await client.get("/async/recent/", headers=self.headers)).json()["chats"]
+        self.assertEqual([chat["last_message"]["message"] for chat in chats], ["reply", "2.2", "1.1"])
+        self.assertEqual([chat["unread_count"] for chat in chats], [1, 3, 2])
+
+    @override_settings(MESSAGE_SHARDS=["default", "default"])
+    async def test_async_recent_chats_fan_in_answers_like_the_sync_one(self):
+        # two aliases for one database: the sharded code path, with every shard reachable
+        client = AsyncClient()
+        sync_response = await client.get("/sync/recent/", headers=self.headers)
+        async_response = await client.get("/async/recent/", headers=self.headers)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(async_response.json(), sync_response.json())
+        self.assertEqual(len(async_response.json()["chats"]), 3)
+
+    async def test_async_views_require_authentication(self):
+        response = await AsyncClient().get("/async/recent/")
+        self.assertEqual(response.status_code, 401)
+
+    def test_recent_chats_query_count_is_fixed(self):
+        # token user, friendships with last message ids and unread counts, messages, attachments
+        with self.assertNumQueries(4):
+            response = APIClient(headers=self.headers).get("/sync/recent/")
+        self.assertEqual(len(response.json()["chats"]), 3)
@@ -0,0 +1,103 @@
+import time
+from django.conf import settings
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second and holding at most `burst` tokens.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, tokens=1):
+        """Seconds until `tokens` are available (0 if they already are)"""
+        self.refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens=1):
+        self.tokens -= tokens
+
+
+class FrameThrottle:
+    """
+    One token bucket per client frame type, built lazily from a rates mapping:
+    {"chat_message": (rate, burst), ..., "default": (rate, burst)}.
+    Frame types without their own entry share the "default" bucket, so a client
+    can't grow this dict by inventing frame types.
+    """
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.buckets = {}
+
+    def bucket_for(self, frame_type):
+        key = frame_type if frame_type in self.rates else "default"
+        if key not in self.buckets:
+            rate = self.rates.get(key)
+            if rate is None:
+                return None
+            self.buckets[key] = TokenBucket(*rate)
+        return self.buckets[key]
+
+
+class UserThrottleRegistry:
+    """
+    Process-local per-user throttles shared by all of a user's connections on this worker.
+    Entries are reference counted and dropped when the user's last connection closes.
+    """
+
+    def __init__(self):
+        self._throttles = {}
+        self._refs = {}
+
+    def acquire(self, user_id, rates):
+        if user_id not in self._throttles:
+            self._throttles[user_id] = FrameThrottle(rates)
+            self._refs[user_id] = 0
+        self._refs[user_id] += 1
+        return self._throttles[user_id]
+
+    def release(self, user_id):
+        if user_id not in self._refs:
+            return
+        self._refs[user_id] -= 1
+        if self._refs[user_id] <= 0:
+            del self._refs[user_id]
+            del self._throttles[user_id]
+
+
+user_throttles = UserThrottleRegistry()
+
+
+def get_throttle_rates(scope):
+    """Rates for "connection" or "user" scope from settings.REALTIME_THROTTLE_RATES"""
+    return getattr(settings, "REALTIME_THROTTLE_RATES", {}).get(scope, {})
+
+
+def check_throttles(frame_type, *throttles):
+    """
+    Charge one token to every throttle's bucket for `frame_type`.
+    Nothing is charged unless all buckets have a token; returns the longest wait otherwise.
+    """
+    buckets = [bucket for bucket in (throttle.bucket_for(frame_type) for throttle in throttles) if bucket is not None]
+
+    retry_after = max((bucket.wait_time() for bucket in buckets), default=0.0)
+    if retry_after:
+        return retry_after
+
+    for bucket in buckets:
+        bucket.consume()
+    return 0.0
@@ -1,8 +1,17 @@
+from django.conf import settings
 from django.urls import path
-from .views import chat_history, recent_chats,mark_messages_read
+from .views import broadcast, chat_history, recent_chats, mark_messages_read, rooms, room_history, mark_room_read, room_members
+
+if settings.ASYNC_API_VIEWS:
+    from .async_views import chat_history, recent_chats, mark_messages_read
 
 urlpatterns = [
     path("recent/", recent_chats, name="recent_chats"),
     path("<int:friend_id>/", chat_history, name="chat_history"),
     path("<int:friend_id>/mark-read/", mark_messages_read, name="mark_messages_read"),
+    path("rooms/", rooms, name="rooms"),
+    path("rooms/<int:room_id>/", room_history, name="room_history"),
+    path("rooms/<int:room_id>/mark-read/", mark_room_read, name="mark_room_read"),
+    path("rooms/<int:room_id>/members/", room_members, name="room_members"),
+    path("broadcast/", broadcast, name="broadcast"),
 ]
@@ -1,12 +1,20 @@
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, When, Window
+from django.db.models.functions import Coalesce, RowNumber
 from django.contrib.auth import get_user_model
+from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
+from accounts.snapshots import user_snapshots
 from friends.models import Friendship
-from .models import Message
-from .serializers import MessageSerializer
+from .broadcast import BROADCAST_GROUP, broadcast_event
+from .history import PAGE_SIZE, conversation_history, with_senders
+from .models import Message, Room, RoomMembership, RoomMessage
+from .outbox import publish, publish_many
+from .serializers import MessageSerializer, RoomMessageSerializer, RoomSerializer
+from .sharding import conversation_messages, is_sharded, partners_by_shard, prefetch_attachments, shard_for
 
 User = get_user_model()
 
@@ -19,11 +27,17 @@ def chat_history(request, friend_id):
     """
     user = request.user
 
+    rows, version = conversation_history.get(user.id, friend_id)
+    if rows is not None:
+        return Response({"messages": with_senders(rows, user_snapshots.get_many({sender_id for sender_id, _ in rows}))})
+
     # get messages where user and friend are either sender or recipient
-    messages = Message.objects.filter(Q(sender=user, recipient_id=friend_id) | Q(sender_id=friend_id, recipient=user)).order_by("-timestamp")[:50]
-    messages = list(reversed(messages))  # reverse so oldest is first
+    messages = list(conversation_messages(user.id, friend_id).order_by("-timestamp")[:PAGE_SIZE])
+    messages.reverse()  # oldest first
+    prefetch_attachments(messages)
 
     serializer = MessageSerializer(messages, many=True)
+    conversation_history.store(user.id, friend_id, version, messages, serializer.data)
 
     return Response({"messages": serializer.data})
 
@@ -36,33 +50,129 @@ def recent_chats(request):
     """
     user = request.user
 
-    friendships = Friendship.objects.filter(Q(user1=user) | Q(user2=user))
+    return Response({"chats": build_recent_chats(user, recent_conversations(user))})
 
-    chats = []
 
-    for friendship in friendships:
-        friend = friendship.user2 if friendship.user1 == user else friendship.user1
-        last_message = Message.objects.filter(Q(sender=user, recipient=friend) | Q(sender=friend, recipient=user)).order_by("-timestamp").first()
-
-        if last_message:
-            unread_count = Message.objects.filter(sender=friend, recipient=user, is_read=False).count()
-
-            chats.append(
-                {
-                    "friend": {
-                        "id": friend.id,
-                        "username": friend.username,
-                        "profile_picture": friend.profile_picture,
-                        "is_online": friend.is_online,
-                    },
-                    "last_message": MessageSerializer(last_message).data,
-                    "unread_count": unread_count,
-                }
-            )
+def recent_conversations(user):
+    """
+    The user's friendships that have messages, each with friend_id, last_message (its
+    attachments prefetched) and unread_count. Costs a fixed number of queries per message
+    shard however many friends.
+    """
+    if not is_sharded():
+        conversations = list(recent_chats_queryset(user))
+        last_messages = Message.objects.in_bulk([f.last_message_id for f in conversations])
+        for conversation in conversations:
+            conversation.last_message = last_messages[conversation.last_message_id]
+    else:
+        conversations = sharded_recent_conversations(user)
+
+    prefetch_attachments([conversation.last_message for conversation in conversations])
+    return conversations
 
-    chats.sort(key=lambda x: x["last_message"]["timestamp"], reverse=True)
 
-    return Response({"chats": chats})
+def recent_chats_queryset(user):
+    """
+    The user's friendships that have messages, annotated with friend_id, last_message_id
+    and unread_count, so the list costs a fixed number of queries however many friends
+    """
+    conversation = Message.objects.filter(Q(sender=user, recipient_id=OuterRef("friend_id")) | Q(sender_id=OuterRef("friend_id"), recipient=user))
+    unread = (
+        Message.objects.filter(sender_id=OuterRef("friend_id"), recipient=user, is_read=False)
+        .order_by()
+        .values("recipient")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    return (
+        Friendship.objects.filter(Q(user1=user) | Q(user2=user))
+        .select_related("user1", "user2")
+        .annotate(friend_id=Case(When(user1=user, then=F("user2_id")), default=F("user1_id")))
+        .annotate(
+            last_message_id=Subquery(conversation.order_by("-timestamp").values("id")[:1]),
+            unread_count=Coalesce(Subquery(unread), 0),
+        )
+        .filter(last_message_id__isnull=False)
+    )
+
+
+def sharded_recent_conversations(user):
+    """
+    recent_conversations() across shards: the friendships come from the default database,
+    then each shard holding some of the conversations answers for its share with the last
+    message per conversation (a window query) and the unread counts.
+    """
+    friendships = {friendship.friend_id: friendship for friendship in friendships_with_friend_id(user)}
+
+    conversations = []
+    for shard, friend_ids in partners_by_shard(user.id, friendships).items():
+        unread_counts = dict(shard_unread_counts(user, shard, friend_ids))
+        for message in shard_last_messages(user, shard, friend_ids):
+            conversations.append(with_last_message(friendships[message.friend_id], message, unread_counts))
+
+    return conversations
+
+
+def friendships_with_friend_id(user):
+    return (
+        Friendship.objects.filter(Q(user1=user) | Q(user2=user))
+        .select_related("user1", "user2")
+        .annotate(friend_id=Case(When(user1=user, then=F("user2_id")), default=F("user1_id")))
+    )
+
+
+def shard_last_messages(user, shard, friend_ids):
+    """The last message of each of the user's conversations with `friend_ids` held on `shard`"""
+    return (
+        Message.objects.using(shard)
+        .filter(Q(sender_id=user.id, recipient_id__in=friend_ids) | Q(sender_id__in=friend_ids, recipient_id=user.id))
+        .annotate(friend_id=Case(When(sender_id=user.id, then=F("recipient_id")), default=F("sender_id")))
+        .annotate(rank=Window(RowNumber(), partition_by=F("friend_id"), order_by=F("timestamp").desc()))
+        .filter(rank=1)
+    )
+
+
+def shard_unread_counts(user, shard, friend_ids):
+    """(sender_id, count) of the user's unread messages from `friend_ids` held on `shard`"""
+    return (
+        Message.objects.using(shard)
+        .filter(sender_id__in=friend_ids, recipient_id=user.id, is_read=False)
+        .order_by()
+        .values("sender_id")
+        .annotate(count=Count("id"))
+        .values_list("sender_id", "count")
+    )
+
+
+def with_last_message(friendship, message, unread_counts):
+    friendship.last_message = message
+    friendship.unread_count = unread_counts.get(message.friend_id, 0)
+    return friendship
+
+
+def build_recent_chats(user, conversations, context=None):
+    """The recent chats list from recent_conversations(); `context` goes to MessageSerializer"""
+    last_messages = [conversation.last_message for conversation in conversations]
+    serialized = MessageSerializer(last_messages, many=True, context=context or {}).data
+
+    chats = []
+    for friendship, last_message in zip(conversations, serialized):
+        friend = friendship.user2 if friendship.user1_id == user.id else friendship.user1
+        chats.append(
+            {
+                "friend": {
+                    "id": friend.id,
+                    "username": friend.username,
+                    "profile_picture": friend.profile_picture,
+                    "is_online": friend.is_online,
+                },
+                "last_message": last_message,
+                "unread_count": friendship.unread_count,
+            }
+        )
+
+    chats.sort(key=lambda x: x["last_message"]["timestamp"], reverse=True)
+    return chats
 
 
 @api_view(["POST"])
@@ -73,6 +183,209 @@ def mark_messages_read(request, friend_id):
     """
     user = request.user
 
-    updated = Message.objects.filter(sender_id=friend_id, recipient=user, is_read=False).update(is_read=True)
+    updated = Message.objects.using(shard_for(user.id, friend_id)).filter(sender_id=friend_id, recipient=user, is_read=False).update(is_read=True)
+    if updated:
+        conversation_history.mark_read(user.id, friend_id)
 
     return Response({"marked_read": updated})
+
+
+# ==================== ROOMS ====================
+
+
+@api_view(["GET", "POST"])
+@permission_classes([IsAuthenticated])
+def rooms(request):
+    """
+    GET: list the user's rooms, newest activity first, with last message and unread count.
+    POST: create a room. Expects {"name": str, "member_ids": [int]}; the creator is always a member.
+    """
+    if request.method == "POST":
+        return create_room(request)
+
+    user = request.user
+
+    # unread = messages from others above the member's read watermark
+    unread_count = (
+        RoomMessage.objects.filter(room_id=OuterRef("room_id"), id__gt=OuterRef("last_read_message_id"))
+        .exclude(sender_id=OuterRef("user_id"))
+        .order_by()
+        .values("room_id")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    last_message_id = RoomMessage.objects.filter(room_id=OuterRef("room_id")).order_by("-id").values("id")[:1]
+
+    memberships = list(
+        RoomMembership.objects.filter(user=user)
+        .select_related("room")
+        .annotate(unread_count=Coalesce(Subquery(unread_count), 0), last_message_id=Subquery(last_message_id))
+    )
+    last_messages = RoomMessage.objects.in_bulk([m.last_message_id for m in memberships if m.last_message_id])
+    context = {"user_snapshots": user_snapshots.get_many({m.sender_id for m in last_messages.values()})}
+
+    room_list = []
+    for membership in sorted(memberships, key=lambda m: m.last_message_id or 0, reverse=True):
+        last_message = last_messages.get(membership.last_message_id)
+        room_list.append(
+            {
+                "room": {"id": membership.room.id, "name": membership.room.name},
+                "last_message": RoomMessageSerializer(last_message, context=context).data if last_message else None,
+                "unread_count": membership.unread_count,
+                "last_read_message_id": membership.last_read_message_id,
+            }
+        )
+
+    return Response({"rooms": room_list})
+
+
+def create_room(request):
+    user = request.user
+    name = (request.data.get("name") or "").strip()
+
+    if not name:
+        return Response({"error": "A room 'name' is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    member_ids = parse_user_ids(request.data.get("member_ids", []))
+    if member_ids is None:
+        return Response({"error": "'member_ids' must be a list of user IDs."}, status=status.HTTP_400_BAD_REQUEST)
+
+    found_ids = set(User.objects.filter(id__in=member_ids).values_list("id", flat=True))
+    if found_ids != member_ids:
+        return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    member_ids.add(user.id)
+    with transaction.atomic():
+        room = Room.objects.create(name=name, created_by=user)
+        RoomMembership.objects.bulk_create([RoomMembership(room=room, user_id=member_id) for member_id in member_ids])
+        notify_room_membership(room.id, member_ids, "room_joined")
+
+    room = Room.objects.prefetch_related("members").get(id=room.id)
+    return Response(RoomSerializer(room).data, status=status.HTTP_201_CREATED)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def room_history(request, room_id):
+    """
+    Get last 50 messages in a room the user is a member of
+    """
+    membership = RoomMembership.objects.filter(room_id=room_id, user=request.user).first()
+    if membership is None:
+        return Response({"error": "Room does not exist."}, status=status.HTTP_404_NOT_FOUND)
+
+    messages = RoomMessage.objects.filter(room_id=room_id).order_by("-timestamp")[:50]
+    messages = list(reversed(messages))  # reverse so oldest is first
+
+    return Response(
+        {
+            "messages": RoomMessageSerializer(messages, many=True).data,
+            "last_read_message_id": membership.last_read_message_id,
+        }
+    )
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def mark_room_read(request, room_id):
+    """
+    Move the user's read watermark forward to "message_id" (default, and at most: the newest message in the room)
+    """
+    membership = RoomMembership.objects.filter(room_id=room_id, user=request.user).first()
+    if membership is None:
+        return Response({"error": "Room does not exist."}, status=status.HTTP_404_NOT_FOUND)
+
+    message_id = request.data.get("message_id")
+    try:
+        message_id = None if message_id is None else int(message_id)
+    except (TypeError, ValueError):
+        return Response({"error": "'message_id' must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+    # never past the newest message, or messages sent later would never count as unread
+    latest_id = RoomMessage.objects.filter(room_id=room_id).order_by("-id").values_list("id", flat=True).first() or 0
+    message_id = latest_id if message_id is None else min(message_id, latest_id)
+
+    # the watermark only moves forward
+    RoomMembership.objects.filter(id=membership.id, last_read_message_id__lt=message_id).update(last_read_message_id=message_id)
+
+    return Response({"last_read_message_id": max(message_id, membership.last_read_message_id)})
+
+
+@api_view(["POST", "DELETE"])
+@permission_classes([IsAuthenticated])
+def room_members(request, room_id):
+    """
+    POST: add {"user_ids": [int]} to a room the user is a member of.
+    DELETE: leave the room.
+    """
+    user = request.user
+
+    if not RoomMembership.objects.filter(room_id=room_id, user=user).exists():
+        return Response({"error": "Room does not exist."}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == "DELETE":
+        with transaction.atomic():
+            RoomMembership.objects.filter(room_id=room_id, user=user).delete()
+            notify_room_membership(room_id, {user.id}, "room_left")
+        return Response({"message": "Left room."})
+
+    user_ids = parse_user_ids(request.data.get("user_ids"))
+    if not user_ids:
+        return Response({"error": "'user_ids' must be a non-empty list of user IDs."}, status=status.HTTP_400_BAD_REQUEST)
+
+    found_ids = set(User.objects.filter(id__in=user_ids).values_list("id", flat=True))
+    if found_ids != user_ids:
+        return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    existing_ids = set(RoomMembership.objects.filter(room_id=room_id, user_id__in=user_ids).values_list("user_id", flat=True))
+    added_ids = user_ids - existing_ids
+    with transaction.atomic():
+        RoomMembership.objects.bulk_create([RoomMembership(room_id=room_id, user_id=user_id) for user_id in added_ids], ignore_conflicts=True)
+        notify_room_membership(room_id, added_ids, "room_joined")
+
+    return Response({"added": sorted(added_ids)})
+
+
+def parse_user_ids(value):
+    """Turn a JSON list of user ids (ints or numeric strings) into a set, or None if malformed"""
+    if not isinstance(value, list):
+        return None
+    try:
+        return {int(user_id) for user_id in value}
+    except (TypeError, ValueError):
+        return None
+
+
+def notify_room_membership(room_id, user_ids, event):
+    """
+    Tell each user's connections to join/leave the room group ("room_joined"/"room_left").
+    Call inside the transaction that changes the membership.
+    """
+    publish_many([f"user_{user_id}" for user_id in user_ids], {"type": f"{event}_handler", "room_id": room_id})
+
+
+# ==================== BROADCAST ====================
+
+
+@api_view(["POST"])
+@permission_classes([IsAdminUser])
+def broadcast(request):
+    """
+    Push a notice to every connected client (or an audience of them).
+    Expects {"kind": str, "payload": object, "audience": {"user_ids", "exclude_user_ids", "percent"}};
+    clients get {"type": "broadcast", "kind", "payload", "timestamp"}. See chats/broadcast.py.
+    """
+    kind = request.data.get("kind")
+    payload = request.data.get("payload", {})
+    if not isinstance(kind, str) or not kind or not isinstance(payload, dict):
+        return Response({"error": "'kind' (str) and 'payload' (object) are required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        event = broadcast_event(kind, payload, request.data.get("audience"))
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    with transaction.atomic():
+        publish(BROADCAST_GROUP, event)
+
+    return Response({"broadcast_id": event["broadcast_id"], "audience": event["audience"]})
@@ -1,23 +1,33 @@
 import os
-from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.security.websocket import AllowedHostsOriginValidator
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
-django_asgi_app = get_asgi_application()
 
-import chats.routing
-from accounts.middleware import TokenAuthMiddleware
+from chats.startup import StartupMiddleware, worker_startup
 
-application = ProtocolTypeRouter(
-    {
-        "http": get_asgi_application(),
-        "websocket": AllowedHostsOriginValidator(
-            TokenAuthMiddleware(
-                URLRouter(
-                    chats.routing.websocket_urlpatterns,
+with worker_startup.stage("django setup"):
+    from django.core.asgi import get_asgi_application
+
+    django_asgi_app = get_asgi_application()
+
+with worker_startup.stage("websocket routing"):
+    from channels.routing import ProtocolTypeRouter, URLRouter
+    from channels.security.websocket import AllowedHostsOriginValidator
+
+    import chats.routing
+    from accounts.middleware import TokenAuthMiddleware
+
+# the readiness probe and the warm-up sit in front of everything (chats/startup.py)
+application = StartupMiddleware(
+    ProtocolTypeRouter(
+        {
+            "http": django_asgi_app,
+            "websocket": AllowedHostsOriginValidator(
+                TokenAuthMiddleware(
+                    URLRouter(
+                        chats.routing.websocket_urlpatterns,
+                    )
                 )
-            )
-        ),
-    }
+            ),
+        }
+    )
 )
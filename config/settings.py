@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import sys
 from datetime import timedelta
 from pathlib import Path
 
@@ -48,6 +49,7 @@ INSTALLED_APPS = [
     "accounts",
     "chats",
     "friends",
+    "attachments",
 ]
 
 MIDDLEWARE = [
@@ -56,6 +58,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "accounts.profiling.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -107,15 +110,154 @@ DATABASES = {
     }
 }
 
+# Direct messages are spread over these DATABASES aliases by a consistent hash of the
+# conversation pair (chats/sharding.py); everything else stays on "default". To add a
+# shard, add its DATABASES entry and alias here, `migrate --database=<alias>`, then run
+# `manage.py rebalance_messages` to move the conversations it now owns.
+MESSAGE_SHARDS = ["default"]
+
+DATABASE_ROUTERS = ["chats.routers.MessageShardRouter"]
+
+# HybridChannelLayer delivers to channels on the same worker in-process and places groups
+# on "hosts" by consistent hashing, so more Redis hosts can be listed to shard the layer.
+# hash_ring places keys differently from stock channels_redis: change it only with every
+# worker stopped, or workers on either side of a rolling deploy won't find each other's groups.
+# membership_ttl lets a send to user_<id> reuse, for that many seconds, what Redis said about the
+# user's sockets on other workers, so messages to a user connected only here skip Redis. The
+# trade-off: for that long after a socket reconnects to another worker, messages sent to the user
+# from this one aren't pushed to it (they're stored, and load with the chat history).
+# Room groups span workers and are read on every send.
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chats.layers.HybridChannelLayer",
         "CONFIG": {
             "hosts": [("127.0.0.1", 6379)],
+            "hash_ring": True,
+            "membership_ttl": {"user_": 0.5},
         },
     },
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/1",
+    },
+}
+
+# the test suite runs without Redis: give it a real cache rather than connection errors
+if sys.argv[1:2] == ["test"]:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+# {id, username, profile_picture} summaries of users for messages and notifications:
+# a process-local tier (entries trusted for local_ttl seconds) in front of the shared cache.
+USER_SNAPSHOT_CACHE = {
+    "cache": "default",
+    "ttl": 3600,
+    "local_ttl": 10,
+    "local_max_entries": 50000,
+}
+
+# The first page of chat history of recently opened conversations, serialized, per worker
+# (up to `max_conversations`). Pages are checked against a per-conversation version in the
+# shared cache (kept `version_ttl` seconds); the hit rate is logged every `report_every` lookups.
+CHAT_HISTORY_CACHE = {
+    "cache": "default",
+    "max_conversations": 10000,
+    "version_ttl": 86400,
+    "report_every": 1000,
+}
+
+# Realtime notifications from REST views are written to an outbox table in the request's
+# transaction and sent by `manage.py dispatch_outbox`. Retries back off retry_backoff * 2^attempts
+# seconds; claimed events are leased for `lease` seconds; sent events are kept `retention` seconds.
+REALTIME_OUTBOX = {
+    "batch_size": 200,
+    "poll_interval": 0.2,
+    "lease": 30,
+    "max_attempts": 8,
+    "retry_backoff": 1,
+    "retention": 3600,
+}
+
+# Token buckets for client-sent websocket frames, as (tokens per second, burst).
+# "connection" limits apply to each socket, "user" limits to all of a user's sockets on a worker.
+# Frame types without an entry share "default".
+REALTIME_THROTTLE_RATES = {
+    "connection": {
+        "chat_message": (5, 20),
+        "default": (10, 30),
+    },
+    "user": {
+        "chat_message": (10, 40),
+        "default": (20, 60),
+    },
+}
+
+# Outbound frames buffered per socket: droppable frames are shed at `shed_at`,
+# the socket is closed as a slow consumer at `close_at`. Chat frames go out before friend
+# events, and those before presence; presence is coalesced per user and held `presence_linger`
+# seconds so a burst goes out as one user_status_batch frame. Under Daphne send() never waits
+# for the client, so the depth only reflects a server-side burst (see chats/outbound.py).
+REALTIME_OUTBOUND_QUEUE = {
+    "shed_at": 200,
+    "close_at": 1000,
+    "presence_linger": 0.05,
+}
+
+# Typing/viewing indicators: repeats per (sender, recipient) are relayed at most once per
+# `min_interval` seconds and expire on the recipient's side after `ttl` seconds.
+REALTIME_EPHEMERAL = {
+    "min_interval": 3,
+    "ttl": 6,
+}
+
+# Connections quiet for `interval` seconds are sent {"type": "ping"} (clients answer "pong");
+# those quiet for `timeout` seconds are closed and their user taken offline, `reap_batch` at a time.
+REALTIME_HEARTBEAT = {
+    "interval": 25,
+    "timeout": 60,
+    "reap_batch": 500,
+}
+
+# A chat_message retried with the same temp_id gets the original message_sent ack instead of
+# being stored and delivered again. Each worker remembers up to `max_entries` recent sends
+# for `ttl` seconds; older retries are caught by a unique (sender, temp_id) constraint.
+REALTIME_IDEMPOTENCY = {
+    "ttl": 300,
+    "max_entries": 50000,
+}
+
+# Clients offering the "konvo.compact.v1" websocket subprotocol get MessagePack frames,
+# deflated once a packed frame reaches `compress_threshold` bytes (None disables it).
+REALTIME_COMPACT_CODEC = {
+    "compress_threshold": 512,
+    "compress_level": 6,
+}
+
+
+# Each worker times its startup stages and then warms up (chats/startup.py): URL resolver, DRF
+# settings and `serializers`, a connection to every database, cache and channel-layer host, the
+# password hashing pool. `readiness_path` answers 503 until that succeeded and 200 after, so the
+# load balancer should route only to workers passing it. A stage taking longer than `stage_timeout`
+# seconds counts as failed and is retried on the next probe. The database connections opened by
+# the warm-up are reused only by websocket consumers, and only with CONN_MAX_AGE set: HTTP requests
+# each run on a thread of their own and open theirs there.
+WORKER_STARTUP = {
+    "readiness_path": "/ready/",
+    "stage_timeout": 10,
+    "serializers": [
+        "accounts.serializers.UserSerializer",
+        "chats.serializers.MessageSerializer",
+        "chats.serializers.RoomSerializer",
+        "chats.serializers.RoomMessageSerializer",
+        "friends.serializers.FriendshipSerializer",
+        "friends.serializers.SlimFriendshipSerializer",
+        "friends.serializers.FriendRequestSerializer",
+        "attachments.serializers.AttachmentSerializer",
+    ],
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -135,6 +277,16 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Password hashing for login/signup runs in a bounded pool ("thread" or "process"; workers=0 hashes
+# inline). With more than max_pending jobs queued, or one taking longer than timeout seconds,
+# login/signup answer 503 instead of tying up request workers.
+PASSWORD_HASHING_POOL = {
+    "kind": "thread",
+    "workers": 4,
+    "max_pending": 64,
+    "timeout": 10,
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.2/topics/i18n/
@@ -153,7 +305,48 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# Attachments: uploads and content-addressed blobs live under ATTACHMENTS_ROOT.
+ATTACHMENTS_ROOT = BASE_DIR / "media" / "attachments"
+ATTACHMENT_MAX_SIZE = 1024 * 1024 * 1024
+# a chunk is staged on disk before it is copied into the upload; larger PUTs get 413
+ATTACHMENTS_MAX_CHUNK = 128 * 1024 * 1024
+# uploads untouched for this long are deleted by `manage.py prune_uploads`
+ATTACHMENTS_UPLOAD_EXPIRY = timedelta(days=1)
+
+# Set to e.g. "X-Accel-Redirect" to let the reverse proxy send attachment files with sendfile;
+# the header value is ATTACHMENTS_SENDFILE_PREFIX + the blob path relative to ATTACHMENTS_ROOT.
+ATTACHMENTS_SENDFILE_HEADER = None
+ATTACHMENTS_SENDFILE_PREFIX = "/protected/attachments/"
+
+# On-demand profiling (accounts/profiling.py): staff send the `header` header or `query_param`
+# query parameter to profile one request; POST /api/accounts/profiles/websocket/ toggles it for a
+# user's websocket frames. cProfile output and the SQL run are saved under `directory`, fetched
+# from /api/accounts/profiles/<id>/. With `enabled` off (the default), none of it is installed:
+# turn it on in the environments where it is wanted.
+PROFILING = {
+    "enabled": False,
+    "directory": BASE_DIR / "profiles",
+    "header": "X-Profile",
+    "query_param": "_profile",
+    "top": 40,
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        # one line per saved profile
+        "accounts.profiling": {"handlers": ["console"], "level": "INFO"},
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Serve chat history, recent chats, mark-read and the friends list from async views
+# (chats/async_views.py, friends/async_views.py) instead of the DRF ones. Only pays off
+# under ASGI, where sync views each take a thread from the executor.
+ASYNC_API_VIEWS = False
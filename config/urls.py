@@ -6,4 +6,5 @@ urlpatterns = [
     path("api/accounts/", include("accounts.urls")),
     path("api/chat/", include("chats.urls")),
     path("api/friends/", include("friends.urls")),
+    path("api/attachments/", include("attachments.urls")),
 ]
@@ -0,0 +1,37 @@
+from asgiref.sync import sync_to_async
+from django.db import models
+from django.http import JsonResponse
+from rest_framework.request import Request
+
+from accounts.async_auth import async_api_view
+from .models import Friendship
+from .pagination import CreatedAtCursorPagination
+from .serializers import FriendshipSerializer, SlimFriendshipSerializer
+from .views import wants_slim
+
+# Async twin of FriendshipListView, served instead of it when settings.ASYNC_API_VIEWS is on.
+
+
+@async_api_view(["GET"])
+async def friends_list(request):
+    """
+    The user's friends, newest first, cursor paginated. Pass ?slim=1 for just the fields
+    the friends list shows.
+
+    Unlike the chat views this one stays sync-backed for its one query: DRF's
+    CursorPagination reads the page inside paginate_queryset() and has no async form, and
+    re-implementing it would fork the cursor format the sync view hands out. Only the page
+    read hops to the ORM thread; the rows are serialized on the event loop (select_related
+    leaves the serializers nothing to query).
+    """
+    # the paginator and serializers want a DRF request; hand it the user we authenticated
+    drf_request = Request(request)
+    drf_request.user = request.user
+
+    queryset = Friendship.objects.filter(models.Q(user1=request.user) | models.Q(user2=request.user)).select_related("user1", "user2")
+    serializer_class = SlimFriendshipSerializer if wants_slim(drf_request) else FriendshipSerializer
+
+    paginator = CreatedAtCursorPagination()
+    friendships = await sync_to_async(paginator.paginate_queryset)(queryset, drf_request)
+    data = serializer_class(friendships, many=True, context={"request": drf_request}).data
+    return JsonResponse(paginator.get_paginated_response(data).data)
@@ -11,17 +11,34 @@ class FriendSerializer(serializers.ModelSerializer):
         fields = ["id", "phone_number", "username", "email", "bio", "profile_picture", "last_seen", "is_online"]
 
 
+class SlimFriendSerializer(serializers.ModelSerializer):
+    """Only what list rows show"""
+
+    class Meta:
+        model = User
+        fields = ["id", "username", "profile_picture", "is_online", "last_seen"]
+
+
 class FriendshipSerializer(serializers.ModelSerializer):
     friend = serializers.SerializerMethodField()
 
+    friend_serializer_class = FriendSerializer
+
     class Meta:
         model = Friendship
         fields = ["friend"]
 
     def get_friend(self, obj):
         me = self.context["request"].user
-        friend = obj.user2 if obj.user1 == me else obj.user1
-        return FriendSerializer(friend, context=self.context).data
+        friend = obj.user2 if obj.user1_id == me.id else obj.user1
+        return self.friend_serializer_class(friend, context=self.context).data
+
+
+class SlimFriendshipSerializer(FriendshipSerializer):
+    friend_serializer_class = SlimFriendSerializer
+
+    class Meta(FriendshipSerializer.Meta):
+        fields = ["friend", "created_at"]
 
 
 class FriendRequestSerializer(serializers.ModelSerializer):
@@ -31,3 +48,13 @@ class FriendRequestSerializer(serializers.ModelSerializer):
     class Meta:
         model = FriendRequest
         fields = ["id", "from_user", "to_user", "status", "created_at"]
+
+
+class SlimFriendRequestSerializer(serializers.ModelSerializer):
+    """Requests received by the user: the sender is all the list needs"""
+
+    from_user = SlimFriendSerializer(read_only=True)
+
+    class Meta:
+        model = FriendRequest
+        fields = ["id", "from_user", "status", "created_at"]
@@ -1,3 +1,228 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from accounts.phones import hash_phone
+from chats.models import OutboxEvent
+from . import async_views
+from .models import FriendRequest, Friendship
+from .views import BULK_LIMIT, CONTACT_MATCH_CHUNK, CONTACT_MATCH_LIMIT, FriendshipListView
+
+User = get_user_model()
+
+
+class ListQueryCountTests(TestCase):
+    """Friend and friend-request lists cost the same number of queries at any page size"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.me = User.objects.create(username="me")
+        others = [User.objects.create(username=f"user{i}") for i in range(30)]
+        for other in others[:15]:
+            Friendship.objects.create(user1=cls.me, user2=other)
+        for other in others[15:]:
+            FriendRequest.objects.create(from_user=other, to_user=cls.me)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def assert_constant_queries(self, url):
+        for params in ({"page_size": 2}, {"page_size": 15}, {"page_size": 2, "slim": 1}, {"page_size": 15, "slim": 1}):
+            with self.assertNumQueries(1):
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data["results"]), params["page_size"])
+
+    def test_friends_list(self):
+        self.assert_constant_queries("/api/friends/")
+
+    def test_friend_request_list(self):
+        self.assert_constant_queries("/api/friends/requests/")
+
+    def test_cursor_walks_every_friend_once(self):
+        seen = []
+        url, params = "/api/friends/", {"page_size": 4, "slim": 1}
+        while url:
+            response = self.client.get(url, params)
+            seen += [row["friend"]["id"] for row in response.data["results"]]
+            url, params = response.data["next"], None
+
+        self.assertEqual(len(seen), 15)
+        self.assertEqual(len(set(seen)), 15)
+
+
+urlpatterns = [
+    path("sync/", FriendshipListView.as_view()),
+    path("async/", async_views.friends_list),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncFriendsListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.me = User.objects.create(username="me")
+        for i in range(5):
+            Friendship.objects.create(user1=cls.me, user2=User.objects.create(username=f"user{i}"))
+        cls.headers = {"Authorization": f"Bearer {RefreshToken.for_user(cls.me).access_token}"}
+
+    async def get(self, url):
+        response = await AsyncClient().get(url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        page = response.json()
+        # links point at the view's own path, the cursor is what has to match
+        return page["results"], page["next"] and page["next"].split("?", 1)[1]
+
+    async def test_async_pages_match_the_sync_view(self):
+        for query in ("page_size=2", "page_size=2&slim=1"):
+            seen = 0
+            while query:
+                results, next_query = await self.get(f"/async/?{query}")
+                self.assertEqual((results, next_query), await self.get(f"/sync/?{query}"))
+                seen += len(results)
+                query = next_query
+            self.assertEqual(seen, 5)
+
+class BulkFriendRequestTests(TestCase):
+    def setUp(self):
+        self.me = User.objects.create(username="me")
+        self.others = [User.objects.create(username=f"user{i}") for i in range(4)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def as_user(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def send(self, ids):
+        return self.client.post("/api/friends/request/bulk/", {"to_user_ids": ids}, format="json")
+
+    def test_at_most_bulk_limit_ids(self):
+        self.assertEqual(self.send(list(range(1, BULK_LIMIT + 2))).status_code, 400)
+        self.assertEqual(self.send([]).status_code, 400)
+        self.assertEqual(self.send(["x"]).status_code, 400)
+        self.assertEqual(self.send([other.id for other in self.others] + list(range(10**6, 10**6 + BULK_LIMIT - 4))).status_code, 201)
+
+    def test_self_missing_and_friends_are_skipped(self):
+        Friendship.objects.create(user1=self.me, user2=self.others[0])
+        response = self.send([self.me.id, 999999, self.others[0].id, self.others[1].id])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            response.json()["skipped"],
+            {str(self.me.id): "self", "999999": "not_found", str(self.others[0].id): "already_friends"},
+        )
+        self.assertEqual([row["to_user"]["id"] for row in response.json()["sent"]], [self.others[1].id])
+
+    def test_repeated_send_reports_pending_requests_as_skipped(self):
+        self.send([self.others[0].id, self.others[1].id])
+        FriendRequest.objects.filter(to_user=self.others[1]).update(status="rejected")
+        OutboxEvent.objects.update(status=OutboxEvent.SENT)
+
+        response = self.send([self.others[0].id, self.others[1].id])
+        self.assertEqual(response.json()["skipped"], {str(self.others[0].id): "already_pending"})
+        self.assertEqual([row["to_user"]["id"] for row in response.json()["sent"]], [self.others[1].id])
+        self.assertEqual(FriendRequest.objects.get(to_user=self.others[1]).status, "pending")
+        # only the re-sent request notifies
+        self.assertEqual(list(OutboxEvent.objects.filter(status=OutboxEvent.PENDING).values_list("group", flat=True)), [f"user_{self.others[1].id}"])
+
+    def test_request_a_concurrent_send_created_first_is_skipped(self):
+        bulk_create = FriendRequest.objects.bulk_create
+
+        def racing_bulk_create(objs, **kwargs):
+            # the other send commits its request to others[0] between our read and our insert
+            FriendRequest.objects.create(from_user=self.me, to_user=self.others[0])
+            return bulk_create(objs, **kwargs)
+
+        with mock.patch.object(FriendRequest.objects, "bulk_create", racing_bulk_create):
+            response = self.send([self.others[0].id, self.others[1].id])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["skipped"], {str(self.others[0].id): "already_pending"})
+        self.assertEqual([row["to_user"]["id"] for row in response.json()["sent"]], [self.others[1].id])
+        self.assertEqual(list(OutboxEvent.objects.values_list("group", flat=True)), [f"user_{self.others[1].id}"])
+
+    def test_events_for_every_recipient_are_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.send([other.id for other in self.others])
+
+        outbox_inserts = [query for query in queries if query["sql"].startswith("INSERT") and f'"{OutboxEvent._meta.db_table}"' in query["sql"]]
+        self.assertEqual(len(outbox_inserts), 1)
+        self.assertEqual(set(OutboxEvent.objects.values_list("group", flat=True)), {f"user_{other.id}" for other in self.others})
+
+    def test_accept_creates_friendships_in_one_insert(self):
+        requests = [FriendRequest.objects.create(from_user=other, to_user=self.me) for other in self.others[:3]]
+        not_mine = FriendRequest.objects.create(from_user=self.me, to_user=self.others[3])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/api/friends/accept/bulk/", {"ids": [r.id for r in requests] + [not_mine.id, 999999]}, format="json")
+
+        self.assertEqual(sorted(response.json()["accepted"]), sorted(r.id for r in requests))
+        self.assertEqual(response.json()["skipped"], sorted([not_mine.id, 999999]))
+        friendship_inserts = [query for query in queries if query["sql"].startswith("INSERT") and f'"{Friendship._meta.db_table}"' in query["sql"]]
+        self.assertEqual(len(friendship_inserts), 1)
+        self.assertEqual(Friendship.objects.count(), 3)
+        self.assertEqual(
+            set(OutboxEvent.objects.filter(message__type="friend_request_accepted_handler").values_list("group", flat=True)),
+            {f"user_{other.id}" for other in self.others[:3]},
+        )
+
+        # accepted requests aren't pending anymore
+        response = self.client.post("/api/friends/reject/bulk/", {"ids": [r.id for r in requests]}, format="json")
+        self.assertEqual(response.json(), {"rejected": [], "skipped": sorted(r.id for r in requests)})
+
+
+class ContactMatchTests(TestCase):
+    def setUp(self):
+        self.me = User.objects.create(username="me", phone_number="+15550000000")
+        self.friend = User.objects.create(username="friend", phone_number="+44 20 7946 0958")
+        self.invited = User.objects.create(username="invited", phone_number="+15550000002")
+        self.inviter = User.objects.create(username="inviter", phone_number="+15550000003")
+        self.stranger = User.objects.create(username="stranger", phone_number="+15550000004")
+        Friendship.objects.create(user1=self.me, user2=self.friend)
+        FriendRequest.objects.create(from_user=self.me, to_user=self.invited)
+        FriendRequest.objects.create(from_user=self.inviter, to_user=self.me)
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    def match(self, **body):
+        return self.client.post("/api/friends/contacts/match/", body, format="json")
+
+    def test_numbers_match_however_they_are_written_with_relationships(self):
+        contacts = ["0044 (20) 7946-0958", "+1 555 000 0002", "+1-555-000-0003", "+1.555.000.0004", "+15550000000", "+19990000000", "not a number", 42]
+        response = self.match(phone_numbers=contacts)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {match["contact"]: (match["user"]["id"], match["relationship"]) for match in response.json()["matches"]},
+            {
+                "0044 (20) 7946-0958": (self.friend.id, "friend"),
+                "+1 555 000 0002": (self.invited.id, "request_sent"),
+                "+1-555-000-0003": (self.inviter.id, "request_received"),
+                "+1.555.000.0004": (self.stranger.id, "none"),
+            },
+        )
+
+    def test_hashes_match_the_normalized_number(self):
+        contacts = [hash_phone("+442079460958").upper(), hash_phone("+15550000004"), hash_phone("+15550000000"), hash_phone("442079460958")]
+        response = self.match(phone_hashes=contacts)
+        self.assertEqual({match["user"]["id"] for match in response.json()["matches"]}, {self.friend.id, self.stranger.id})
+
+    def test_at_most_contact_match_limit_entries(self):
+        self.assertEqual(self.match(phone_numbers=[]).status_code, 400)
+        self.assertEqual(self.match(phone_numbers="+15550000004").status_code, 400)
+        self.assertEqual(self.match().status_code, 400)
+        self.assertEqual(self.match(phone_numbers=["+15550000004"] * (CONTACT_MATCH_LIMIT + 1)).status_code, 400)
+
+        numbers = [f"+1666{n:07d}" for n in range(CONTACT_MATCH_LIMIT - 1)] + ["+15550000004"]
+        with self.assertNumQueries(CONTACT_MATCH_LIMIT // CONTACT_MATCH_CHUNK + 2):
+            response = self.match(phone_numbers=numbers)
+        self.assertEqual([match["user"]["id"] for match in response.json()["matches"]], [self.stranger.id])
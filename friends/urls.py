@@ -1,18 +1,35 @@
+from django.conf import settings
 from django.urls import path
 from .views import (
     FriendshipListView,
     FriendRequestListView,
     FriendRequestAcceptView,
     FriendRequestRejectView,
+    accept_friend_requests,
     friend_suggestions,
+    match_contacts,
+    search_people,
+    reject_friend_requests,
     send_friend_request,
+    send_friend_requests,
 )
 
+if settings.ASYNC_API_VIEWS:
+    from .async_views import friends_list
+else:
+    friends_list = FriendshipListView.as_view()
+
 urlpatterns = [
-    path("", FriendshipListView.as_view(), name="list-friends"),
+    path("", friends_list, name="list-friends"),
     path("request/", send_friend_request, name="send-request"),
     path("requests/", FriendRequestListView.as_view(), name="list-requests"),
     path("suggestions/", friend_suggestions, name="friend-suggestions"),
+    path("contacts/match/", match_contacts, name="match-contacts"),
+    path("search/", search_people, name="search-people"),
+    path("request/bulk/", send_friend_requests, name="send-requests"),
+    # before accept/<str:id>/ and reject/<str:id>/, which would match "bulk" too
+    path("accept/bulk/", accept_friend_requests, name="accept-requests"),
+    path("reject/bulk/", reject_friend_requests, name="reject-requests"),
     path("accept/<str:id>/", FriendRequestAcceptView.as_view(), name="accept-request"),
     path("reject/<str:id>/", FriendRequestRejectView.as_view(), name="reject-request"),
 ]
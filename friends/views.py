@@ -1,8 +1,6 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView
@@ -10,12 +8,24 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
 
+from accounts.phones import normalize_phone
+from accounts.search import MAX_QUERY_LENGTH, search_users
 from accounts.serializers import UserSerializer
+from accounts.snapshots import snapshot_of
+from chats.outbox import publish, publish_many
 from .models import Friendship, FriendRequest
-from .serializers import FriendshipSerializer, FriendRequestSerializer
+from .pagination import CreatedAtCursorPagination
+from .serializers import FriendshipSerializer, FriendRequestSerializer, SlimFriendRequestSerializer, SlimFriendshipSerializer
 
 User = get_user_model()
 
+# most ids one bulk call may act on
+BULK_LIMIT = 200
+
+# most address-book entries per contact match call, and per IN (...) query
+CONTACT_MATCH_LIMIT = 5000
+CONTACT_MATCH_CHUNK = 500
+
 
 # **Send a friend request (create FriendRequest where from_user=me)
 # **List pending friend requests (get all FriendRequest where to_user=me)
@@ -24,18 +34,26 @@ User = get_user_model()
 # **List my friends (get all Friendship)
 
 
+def wants_slim(request):
+    return request.query_params.get("slim", "").lower() in ("1", "true")
+
+
 class FriendshipListView(ListAPIView):
     """
-    API view to return the list of user's friends.
+    API view to return the list of user's friends, newest first, cursor paginated.
+    Pass ?slim=1 for just the fields the friends list shows.
     User must be authenticated.
     """
 
-    serializer_class = FriendshipSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = CreatedAtCursorPagination
+
+    def get_serializer_class(self):
+        return SlimFriendshipSerializer if wants_slim(self.request) else FriendshipSerializer
 
     def get_queryset(self):
         user = self.request.user
-        return Friendship.objects.filter(models.Q(user1=user) | models.Q(user2=user))
+        return Friendship.objects.filter(models.Q(user1=user) | models.Q(user2=user)).select_related("user1", "user2")
 
 
 @api_view(["GET"])
@@ -51,18 +69,53 @@ def friend_suggestions(request):
     return Response(UserSerializer(suggestions, many=True).data)
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def search_people(request):
+    """
+    Search users to befriend by username or name: prefix matches first, then close typo matches.
+    Query parameters:
+    - "q": the search text, 2 to MAX_QUERY_LENGTH (150) characters.
+    - "limit": results to return, 1-50 (default 20).
+    Users that are the requester, already friends, or have a pending request either way
+    are left out (same set as friend_suggestions).
+    """
+    query = request.query_params.get("q", "").strip()
+    if not 2 <= len(query) <= MAX_QUERY_LENGTH:
+        return Response({"error": f"'q' must be 2 to {MAX_QUERY_LENGTH} characters."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = min(max(int(request.query_params.get("limit", 20)), 1), 50)
+    except ValueError:
+        return Response({"error": "'limit' must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+    user = request.user
+    excluded_ids = get_excluded_ids(user)
+    excluded_ids.add(user.id)
+
+    results = search_users(query, excluded_ids, limit)
+    return Response([{**user_summary(match), "first_name": match.first_name, "last_name": match.last_name} for match in results])
+
+
 class FriendRequestListView(ListAPIView):
     """
-    API view to return the list of friend requests sent to user.
+    API view to return the list of friend requests sent to user, newest first, cursor paginated.
+    Pass ?slim=1 to leave out the recipient (the user) and the sender's private fields.
     User must also be authenticated.
     """
 
-    serializer_class = FriendRequestSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = CreatedAtCursorPagination
+
+    def get_serializer_class(self):
+        return SlimFriendRequestSerializer if wants_slim(self.request) else FriendRequestSerializer
 
     def get_queryset(self):
         user = self.request.user
-        return FriendRequest.objects.filter(to_user=user, status="pending")
+        queryset = FriendRequest.objects.filter(to_user=user, status="pending")
+        if wants_slim(self.request):
+            return queryset.select_related("from_user")
+        return queryset.select_related("from_user", "to_user")
 
 
 @api_view(["POST"])
@@ -103,32 +156,23 @@ def send_friend_request(request):
     if user_is_friend(request.user, to_user):
         return Response({"error": "User is already a friend."}, status=status.HTTP_400_BAD_REQUEST)
 
-    friend_request, created = FriendRequest.objects.get_or_create(from_user=request.user, to_user=to_user, defaults={"status": "pending"})
+    with transaction.atomic():
+        friend_request, created = FriendRequest.objects.get_or_create(from_user=request.user, to_user=to_user, defaults={"status": "pending"})
+
+        if not created:
+            friend_request.status = "pending"
+            friend_request.save()
 
-    if not created:
-        friend_request.status = "pending"
-        friend_request.save()
+        # real-time notification to recipient, sent by the outbox dispatcher after commit
+        publish(
+            f"user_{to_user.id}",
+            {"type": "friend_request_handler", "data": {"type": "friend_request", "from_user": user_summary(request.user)}},
+            dedupe_key=f"friend_request_from:{request.user.id}",
+        )
 
     data = FriendRequestSerializer(friend_request).data
     print(f"FRIEND REQUEST SENT TO {to_user_id}")
 
-    # real-time notification to recipient
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        f"user_{to_user_id}",
-        {
-            "type": "friend_request_handler",
-            "data": {
-                "type": "friend_request",
-                "from_user": {
-                    "id": request.user.id,
-                    "username": request.user.username,
-                    "profile_picture": request.user.profile_picture,
-                },
-            },
-        },
-    )
-
     return Response(data, status=status.HTTP_201_CREATED)
 
 
@@ -167,27 +211,21 @@ class FriendRequestAcceptView(APIView):
         except FriendRequest.DoesNotExist:
             return Response({"error": "Friend request does not exist."}, status=status.HTTP_404_NOT_FOUND)
 
-        friend_request.status = "accepted"
-        friend_request.save()
-
-        get_or_create_friendship(request.user, friend_request.from_user)
-
-        # real-time notification to sender (requester)
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{friend_request.from_user.id}",
-            {
-                "type": "friend_request_accepted_handler",
-                "data": {
-                    "type": "friend_request_accepted",
-                    "accepted_by": {
-                        "id": request.user.id,
-                        "username": request.user.username,
-                        "profile_picture": request.user.profile_picture,
-                    },
+        with transaction.atomic():
+            friend_request.status = "accepted"
+            friend_request.save()
+
+            get_or_create_friendship(request.user, friend_request.from_user)
+
+            # real-time notification to sender (requester)
+            publish(
+                f"user_{friend_request.from_user_id}",
+                {
+                    "type": "friend_request_accepted_handler",
+                    "data": {"type": "friend_request_accepted", "accepted_by": user_summary(request.user)},
                 },
-            },
-        )
+                dedupe_key=f"friend_request_accepted_by:{request.user.id}",
+            )
 
         return Response({"message": "Friend request accepted."})
 
@@ -216,29 +254,263 @@ class FriendRequestRejectView(APIView):
         except FriendRequest.DoesNotExist:
             return Response({"error": "Friend request does not exist."}, status=status.HTTP_404_NOT_FOUND)
 
-        friend_request.status = "rejected"
-        friend_request.save()
-
-        # real-time notification to sender (requester)
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{friend_request.from_user.id}",
-            {
-                "type": "friend_request_rejected_handler",
-                "data": {
-                    "type": "friend_request_rejected",
-                    "rejected_by": {
-                        "id": request.user.id,
-                        "username": request.user.username,
-                        "profile_picture": request.user.profile_picture,
-                    },
+        with transaction.atomic():
+            friend_request.status = "rejected"
+            friend_request.save()
+
+            # real-time notification to sender (requester)
+            publish(
+                f"user_{friend_request.from_user_id}",
+                {
+                    "type": "friend_request_rejected_handler",
+                    "data": {"type": "friend_request_rejected", "rejected_by": user_summary(request.user)},
                 },
-            },
-        )
+                dedupe_key=f"friend_request_rejected_by:{request.user.id}",
+            )
 
         return Response({"message": "Friend request rejected."})
 
 
+# ==================== BULK OPERATIONS ====================
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def send_friend_requests(request):
+    """
+    Send friend requests from the authenticated user to many users at once.
+    Expects a JSON body with "to_user_ids": a list of user IDs (at most BULK_LIMIT).
+    Behavior:
+    - Targets are validated together: unknown users, self, existing friends and users
+      with a request from this user still pending are skipped and reported under
+      "skipped" as {id: reason}.
+    - New requests are created with one bulk_create, earlier requests to the same
+      users are reset to "pending" with one bulk_update, in a single transaction.
+      A request a concurrent send created first is reported as "already_pending".
+    - Each recipient gets one realtime "friend_request" event, recorded in the same transaction.
+    Response:
+    - 201 Created with {"sent": [FriendRequest, ...], "skipped": {...}}.
+    - 400 Bad Request if "to_user_ids" is missing, malformed or too long.
+    """
+    to_user_ids = parse_ids(request.data.get("to_user_ids"))
+    if not to_user_ids:
+        return Response({"error": f"'to_user_ids' must be a list of 1 to {BULK_LIMIT} user IDs."}, status=status.HTTP_400_BAD_REQUEST)
+
+    user = request.user
+    skipped = {}
+
+    if user.id in to_user_ids:
+        skipped[user.id] = "self"
+
+    existing_ids = set(User.objects.filter(id__in=to_user_ids).values_list("id", flat=True))
+    skipped.update({user_id: "not_found" for user_id in to_user_ids - existing_ids})
+
+    friend_ids = get_friend_ids(user, to_user_ids)
+    skipped.update({user_id: "already_friends" for user_id in friend_ids})
+
+    target_ids = existing_ids - friend_ids - {user.id}
+
+    with transaction.atomic():
+        previous = list(FriendRequest.objects.select_for_update().filter(from_user=user, to_user_id__in=target_ids))
+        # still waiting on an answer: nothing to send, and nothing to notify again
+        pending_ids = {friend_request.to_user_id for friend_request in previous if friend_request.status == "pending"}
+        skipped.update({user_id: "already_pending" for user_id in pending_ids})
+        target_ids -= pending_ids
+        previous = [friend_request for friend_request in previous if friend_request.to_user_id not in pending_ids]
+
+        now = timezone.now()
+        for friend_request in previous:
+            friend_request.status = "pending"
+            friend_request.updated_at = now
+        FriendRequest.objects.bulk_update(previous, ["status", "updated_at"])
+
+        # select_for_update() can't lock rows that don't exist yet: a concurrent send may insert
+        # the same (from_user, to_user) first. Its rows are kept and reported as already pending.
+        previous_ids = {friend_request.to_user_id for friend_request in previous}
+        created = FriendRequest.objects.bulk_create(
+            [FriendRequest(from_user=user, to_user_id=to_user_id, status="pending") for to_user_id in target_ids - previous_ids],
+            ignore_conflicts=True,
+        )
+        ours = {friend_request.to_user_id: friend_request.created_at for friend_request in created}
+        lost_ids = {
+            to_user_id
+            for to_user_id, created_at in FriendRequest.objects.filter(from_user=user, to_user_id__in=ours).values_list("to_user_id", "created_at")
+            if created_at != ours[to_user_id]
+        }
+        skipped.update({user_id: "already_pending" for user_id in lost_ids})
+        target_ids -= lost_ids
+
+        publish_many(
+            [f"user_{to_user_id}" for to_user_id in target_ids],
+            {"type": "friend_request_handler", "data": {"type": "friend_request", "from_user": user_summary(user)}},
+            dedupe_key=f"friend_request_from:{user.id}",
+        )
+
+    sent = FriendRequest.objects.filter(from_user=user, to_user_id__in=target_ids).select_related("from_user", "to_user")
+
+    return Response(
+        {"sent": FriendRequestSerializer(sent, many=True).data, "skipped": skipped},
+        status=status.HTTP_201_CREATED,
+    )
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def accept_friend_requests(request):
+    """
+    Accept many pending friend requests addressed to the authenticated user.
+    Expects a JSON body with "ids": a list of FriendRequest IDs (at most BULK_LIMIT).
+    Behavior:
+    - Requests that don't exist, aren't addressed to the user or aren't pending are
+      reported under "skipped".
+    - Statuses are updated with one bulk_update and friendships created with one
+      bulk_create, in a single transaction.
+    - Each requester gets one realtime "friend_request_accepted" event, recorded in the same transaction.
+    Response:
+    - 200 OK with {"accepted": [ids], "skipped": [ids]}.
+    - 400 Bad Request if "ids" is missing, malformed or too long.
+    """
+    ids = parse_ids(request.data.get("ids"))
+    if not ids:
+        return Response({"error": f"'ids' must be a list of 1 to {BULK_LIMIT} friend request IDs."}, status=status.HTTP_400_BAD_REQUEST)
+
+    user = request.user
+
+    with transaction.atomic():
+        friend_requests = list(FriendRequest.objects.select_for_update().filter(id__in=ids, to_user=user, status="pending"))
+        now = timezone.now()
+        for friend_request in friend_requests:
+            friend_request.status = "accepted"
+            friend_request.updated_at = now
+        FriendRequest.objects.bulk_update(friend_requests, ["status", "updated_at"])
+
+        requester_ids = {friend_request.from_user_id for friend_request in friend_requests}
+        Friendship.objects.bulk_create(
+            [Friendship(user1_id=user1_id, user2_id=user2_id) for user1_id, user2_id in (friendship_pair(user.id, i) for i in requester_ids)],
+            ignore_conflicts=True,
+        )
+
+        publish_many(
+            [f"user_{requester_id}" for requester_id in requester_ids],
+            {"type": "friend_request_accepted_handler", "data": {"type": "friend_request_accepted", "accepted_by": user_summary(user)}},
+            dedupe_key=f"friend_request_accepted_by:{user.id}",
+        )
+
+    accepted = [friend_request.id for friend_request in friend_requests]
+    return Response({"accepted": accepted, "skipped": sorted(ids - set(accepted))})
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def reject_friend_requests(request):
+    """
+    Reject many pending friend requests addressed to the authenticated user.
+    Expects a JSON body with "ids": a list of FriendRequest IDs (at most BULK_LIMIT).
+    Behavior mirrors accept_friend_requests, without creating friendships.
+    Response:
+    - 200 OK with {"rejected": [ids], "skipped": [ids]}.
+    - 400 Bad Request if "ids" is missing, malformed or too long.
+    """
+    ids = parse_ids(request.data.get("ids"))
+    if not ids:
+        return Response({"error": f"'ids' must be a list of 1 to {BULK_LIMIT} friend request IDs."}, status=status.HTTP_400_BAD_REQUEST)
+
+    user = request.user
+
+    with transaction.atomic():
+        friend_requests = list(FriendRequest.objects.select_for_update().filter(id__in=ids, to_user=user, status="pending"))
+        now = timezone.now()
+        for friend_request in friend_requests:
+            friend_request.status = "rejected"
+            friend_request.updated_at = now
+        FriendRequest.objects.bulk_update(friend_requests, ["status", "updated_at"])
+
+        publish_many(
+            [f"user_{requester_id}" for requester_id in {friend_request.from_user_id for friend_request in friend_requests}],
+            {"type": "friend_request_rejected_handler", "data": {"type": "friend_request_rejected", "rejected_by": user_summary(user)}},
+            dedupe_key=f"friend_request_rejected_by:{user.id}",
+        )
+
+    rejected = [friend_request.id for friend_request in friend_requests]
+    return Response({"rejected": rejected, "skipped": sorted(ids - set(rejected))})
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def match_contacts(request):
+    """
+    Find which of the authenticated user's address-book contacts are on the service.
+    Expects a JSON body with one of (at most CONTACT_MATCH_LIMIT entries):
+    - "phone_numbers": E.164 numbers ("+15551234567"; spaces, dashes and brackets are ignored)
+    - "phone_hashes": hex SHA-256 of the normalized numbers, see accounts.phones.hash_phone
+    Behavior:
+    - Contacts are resolved against indexed normalized/hashed phone columns in chunks of
+      CONTACT_MATCH_CHUNK, so 2,000 contacts take a handful of queries rather than 2,000.
+    - Each match carries the relationship with the user: "friend", "request_sent",
+      "request_received" or "none". The user's own number is never matched.
+    Response:
+    - 200 OK with {"matches": [{"contact": <number or hash as sent>, "user": {...}, "relationship": ...}]}.
+    - 400 Bad Request if neither list is given, or it is malformed or too long.
+    """
+    phone_numbers = request.data.get("phone_numbers")
+    phone_hashes = request.data.get("phone_hashes")
+
+    if phone_numbers is not None:
+        contacts, field = phone_numbers, "phone_number_normalized"
+    elif phone_hashes is not None:
+        contacts, field = phone_hashes, "phone_number_hash"
+    else:
+        contacts, field = None, None
+
+    if not isinstance(contacts, list) or not 0 < len(contacts) <= CONTACT_MATCH_LIMIT:
+        return Response(
+            {"error": f"'phone_numbers' or 'phone_hashes' must be a list of 1 to {CONTACT_MATCH_LIMIT} entries."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    # lookup key -> contact as the client sent it
+    keys = {}
+    for contact in contacts:
+        if not isinstance(contact, str):
+            continue
+        key = normalize_phone(contact) if field == "phone_number_normalized" else contact.lower()
+        if key:
+            keys.setdefault(key, contact)
+
+    user = request.user
+    matched = []
+    for chunk in chunked(list(keys), CONTACT_MATCH_CHUNK):
+        matched.extend(
+            User.objects.filter(**{f"{field}__in": chunk}).exclude(id=user.id).only("id", "username", "profile_picture", field)
+        )
+
+    relationships = get_relationships(user, {match.id for match in matched})
+    matches = [
+        {
+            "contact": keys[getattr(match, field)],
+            "user": user_summary(match),
+            "relationship": relationships.get(match.id, "none"),
+        }
+        for match in matched
+    ]
+    return Response({"matches": matches})
+
+
+def parse_ids(value):
+    """Turn a JSON list of ids (ints or numeric strings) into a set, or None if malformed or too long"""
+    if not isinstance(value, list) or len(value) > BULK_LIMIT:
+        return None
+    try:
+        return {int(item) for item in value}
+    except (TypeError, ValueError):
+        return None
+
+
+def user_summary(user):
+    # callers already hold a loaded user, no need to go through the snapshot cache
+    return snapshot_of(user)
+
+
 # ==================== DATABASE OPERATIONS ====================
 
 
@@ -259,6 +531,52 @@ def get_or_create_friendship(user1, user2):
         return Friendship.objects.get_or_create(user1=user2, user2=user1)
 
 
+def friendship_pair(user1_id, user2_id):
+    """
+    (user1_id, user2_id) in the order get_or_create_friendship stores them.
+    Existing rows were written with this (string) ordering, so it has to stay.
+    """
+    if str(user1_id) < str(user2_id):
+        return user1_id, user2_id
+    return user2_id, user1_id
+
+
+def get_friend_ids(user, among_ids):
+    """
+    IDs from `among_ids` that are already friends with user, in one query
+    """
+    pairs = Friendship.objects.filter(
+        models.Q(user1=user, user2_id__in=among_ids) | models.Q(user2=user, user1_id__in=among_ids)
+    ).values_list("user1_id", "user2_id")
+    return {user2 if user1 == user.id else user1 for user1, user2 in pairs}
+
+
+def get_relationships(user, user_ids):
+    """
+    {user_id: "friend" | "request_sent" | "request_received"} for those of `user_ids`
+    that have a friendship or pending request with user, in one pair of queries per chunk
+    """
+    relationships = {}
+    for chunk in chunked(list(user_ids), CONTACT_MATCH_CHUNK):
+        pending = FriendRequest.objects.filter(
+            models.Q(from_user=user, to_user_id__in=chunk) | models.Q(to_user=user, from_user_id__in=chunk), status="pending"
+        ).values_list("from_user_id", "to_user_id")
+        for from_user_id, to_user_id in pending:
+            if from_user_id == user.id:
+                relationships[to_user_id] = "request_sent"
+            else:
+                relationships.setdefault(from_user_id, "request_received")
+
+        for friend_id in get_friend_ids(user, chunk):
+            relationships[friend_id] = "friend"
+    return relationships
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
 def get_excluded_ids(user):
     friend_pairs = Friendship.objects.filter(models.Q(user1=user) | models.Q(user2=user)).values_list("user1_id", "user2_id")
     friend_ids = set()